@@ -0,0 +1,69 @@
+"""
+Time and memory of isolated global contexts.
+
+    python -m benchmarks.bench_fork --count 10000
+
+Makes `count` contexts with the stdlib in each of three ways, copying
+the builtins with copy.deepcopy (what eval_program did), copying the
+loaded stdlib context, and forking it, and evaluates a short program
+in each. Reports the time per context and the memory they all hold.
+"""
+import argparse
+import copy
+import time
+import tracemalloc
+
+from lisp.cache import load_stdlib
+from lisp.compiler import Print, context_base, eval_program
+
+PROGRAM = "(define square (lambda (x) (* x x))) (fold + 0 (map square '(1 2 3)))"
+
+
+def deepcopy_base(env):
+    return copy.deepcopy(context_base)
+
+def shallow_copy(env):
+    return type(env)(env.keys(), env.values())
+
+def fork(env):
+    return env.fork()
+
+WAYS = {"deepcopy builtins": deepcopy_base, "copy stdlib": shallow_copy, "fork stdlib": fork}
+
+
+def measure(make, env, count, mode, program):
+    "Seconds per context made, and per evaluation in it; bytes held by all of them."
+    start = time.perf_counter()
+    contexts = [make(env) for _ in range(count)]
+    made = time.perf_counter() - start
+
+    del contexts
+    tracemalloc.start() # slows down allocations: not while timing
+    contexts = [make(env) for _ in range(count)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for ctx in contexts:
+        eval_program(program, ctx, Print.NOTHING, mode=mode)
+    evaluated = time.perf_counter() - start
+    return made / count, evaluated / count, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--mode", default="closure")
+    args = parser.parse_args()
+
+    env = load_stdlib(args.mode)
+    for name, make in WAYS.items():
+        # The builtins alone don't have `fold` and `map`
+        program = PROGRAM if make is not deepcopy_base else "(* 6 7)"
+        made, evaluated, size = measure(make, env, args.count, args.mode, program)
+        print(f"{name:>18}  make: {made * 1e6:8.2f}us  evaluate: {evaluated * 1e6:8.2f}us  "
+              f"memory: {size / 2**20:7.2f}MiB for {args.count}")
+
+
+if __name__ == "__main__":
+    main()
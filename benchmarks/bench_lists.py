@@ -0,0 +1,51 @@
+"""
+Scaling of the list functions of the stdlib, native and in Lisp.
+
+    python -m benchmarks.bench_lists --sizes 100000 1000000
+
+Times each of them on lists of every size as the builtin (lisp.native)
+and as its Lisp definition (lisp/reference.lisp). With O(1) cons and
+tail the time per element stays flat as lists grow.
+"""
+import argparse
+import time
+
+from lisp.cache import load_stdlib
+from lisp.compiler import evalS
+from lisp.native import reference_context
+
+PROGRAMS = {
+    "seq": "(seq 0 {n})",
+    "length": "(length bench-list)",
+    "last": "(last bench-list)",
+    "reverse": "(reverse bench-list)",
+    "filter": "(filter (lambda (x) (= (mod x 3) 0)) bench-list)",
+    "zip": "(zip bench-list bench-list)",
+}
+
+
+def timed(program, ctx, mode):
+    start = time.perf_counter()
+    evalS(program, ctx, mode=mode)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--mode", default="closure")
+    args = parser.parse_args()
+
+    native, reference = load_stdlib(args.mode).fork(), reference_context(args.mode)
+    for n in args.sizes:
+        for ctx in (native, reference):
+            evalS(f"(define bench-list (seq 0 {n}))", ctx, mode=args.mode)
+        for name, program in PROGRAMS.items():
+            program = program.format(n=n)
+            fast, slow = timed(program, native, args.mode), timed(program, reference, args.mode)
+            print(f"{name:>8} {n:8d}: native {fast / n * 1e6:6.3f}us/element  "
+                  f"lisp {slow / n * 1e6:6.3f}us/element  ({slow / fast:5.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Runs the Mandelbrot examples under each evaluation mode.
+
+    python -m benchmarks.bench_mandelbrot --size 64 --modes tree closure vm
+
+The "array" program is lisp/mandelbrot.lisp, working on numeric arrays;
+the "scalar" one is lisp/mandelbrot_scalar.lisp, one pixel at a time,
+computing its rows with `pmap` in `--workers` processes. `--opt-level`
+runs them through lisp.optimizer, `--jit` compiles the procedures called
+that many times to Python (see lisp.jit; closure mode only).
+
+The image is shrunk to `size`x`size` pixels by rewriting the
+width-pixel/height-pixel defines, and written in a temporary directory.
+"""
+import argparse
+import contextlib
+import io
+import os
+import re
+import tempfile
+import time
+
+from lisp import jit, parallel
+from lisp.compiler import STDLIB_PATH, ev, eval_program, Print
+
+PROGRAMS = {
+    "array": STDLIB_PATH.parent / "mandelbrot.lisp",
+    "scalar": STDLIB_PATH.parent / "mandelbrot_scalar.lisp",
+}
+
+
+def mandelbrot_program(size: int, path=PROGRAMS["array"]) -> str:
+    with open(path, "r") as f:
+        program = f.read()
+    return re.sub(r"\(define (width|height)-pixel \d+\)",
+                  lambda m: f"(define {m.group(1)}-pixel {size})", program)
+
+
+def run(program: str, mode: str, opt_level=0) -> float:
+    "Seconds taken by one run of `program`, stdlib loading excluded."
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(tmp)
+        try:
+            ctx = ev("", what_to_print=Print.NOTHING, mode=mode)
+            start = time.perf_counter()
+            eval_program(program, ctx, what_to_print=Print.NOTHING, mode=mode, opt_level=opt_level)
+            return time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--modes", nargs="+", default=["tree", "closure", "vm"])
+    parser.add_argument("--programs", nargs="+", default=["array", "scalar"],
+                        choices=sorted(PROGRAMS))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes used by pmap (default: one per core)")
+    parser.add_argument("--opt-level", type=int, default=0, help="level of lisp.optimizer")
+    parser.add_argument("--jit", type=int, default=None, metavar="CALLS",
+                        help="threshold of lisp.jit (default: off)")
+    args = parser.parse_args()
+    parallel.WORKERS, jit.THRESHOLD = args.workers, args.jit
+
+    for name in args.programs:
+        program = mandelbrot_program(args.size, PROGRAMS[name])
+        for mode in args.modes:
+            best = min(run(program, mode, args.opt_level) for _ in range(args.repeat))
+            print(f"{name:>7} {mode:>8}: {best:7.2f}s  ({args.size}x{args.size} pixels)")
+
+
+if __name__ == "__main__":
+    main()
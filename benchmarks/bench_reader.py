@@ -0,0 +1,60 @@
+"""
+Parse throughput of the reader over multi-megabyte programs.
+
+    python -m benchmarks.bench_reader --mb 1 4 16
+"""
+import argparse
+import random
+import time
+
+from lisp.compiler import STDLIB_PATH, Reader, tokenize
+
+
+def generate_program(size: int, seed: int = 0) -> str:
+    "A program of about `size` characters mixing stdlib code and random data."
+    rnd = random.Random(seed)
+    stdlib = STDLIB_PATH.read_text()
+
+    def form(depth):
+        if depth == 0 or rnd.random() < 0.3:
+            return rnd.choice([str(rnd.randint(-1000, 1000)),
+                               str(rnd.random()),
+                               "foo-bar", "'sym", '"a string ; with (parens)"'])
+        return "(" + " ".join(form(depth - 1) for _ in range(rnd.randint(1, 5))) + ")"
+
+    chunks, total = [], 0
+    while total < size:
+        chunk = stdlib if rnd.random() < 0.2 else form(6) + "\n"
+        chunks.append(chunk)
+        total += len(chunk)
+    return "".join(chunks)
+
+
+def bench(program: str):
+    start = time.perf_counter()
+    forms = sum(1 for _ in Reader(program))
+    reader_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tokens = tokenize(program)
+    tokenize_time = time.perf_counter() - start
+
+    return forms, len(tokens), reader_time, tokenize_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mb", type=float, nargs="+", default=[1, 4])
+    args = parser.parse_args()
+
+    for mb in args.mb:
+        program = generate_program(int(mb * 1024 * 1024))
+        forms, tokens, reader_time, tokenize_time = bench(program)
+        size = len(program) / (1024 * 1024)
+        print(f"{size:6.2f} MB  {forms:7d} forms  {tokens:8d} tokens  "
+              f"read: {reader_time:6.2f}s ({size / reader_time:5.2f} MB/s)  "
+              f"tokenize: {tokenize_time:6.2f}s ({size / tokenize_time:5.2f} MB/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Time to get a global context with the stdlib loaded.
+
+    python -m benchmarks.bench_startup --repeat 50
+
+For each evaluation mode, compares evaluating the stdlib with loading
+its snapshot from the cache file and from memory, and then times whole
+interpreter starts, `python -c "...ev('')"`, without and with a
+snapshot on disk.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from lisp import cache
+from lisp.cache import load_stdlib
+
+
+def best_of(repeat: int, func) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def from_disk(mode):
+    cache._snapshots.clear()
+    load_stdlib(mode)
+
+
+def process_start(mode: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c",
+                    f"from lisp.compiler import ev, Print; ev('', Print.NOTHING, mode={mode!r})"],
+                   check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["tree", "closure"])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["MYLISP_CACHE_DIR"] = tmp
+
+        for mode in args.modes:
+            evaluate = best_of(args.repeat, lambda: load_stdlib(mode, cache=False))
+            disk = best_of(args.repeat, lambda: from_disk(mode))
+            memory = best_of(args.repeat, lambda: load_stdlib(mode))
+            print(f"{mode:>8}  evaluate: {evaluate * 1000:6.2f}ms  "
+                  f"snapshot file: {disk * 1000:6.2f}ms  in memory: {memory * 1000:6.2f}ms")
+
+        for mode in args.modes:
+            for f in os.listdir(tmp):
+                os.remove(os.path.join(tmp, f))
+            cold = process_start(mode)
+            warm = min(process_start(mode) for _ in range(5))
+            print(f"{mode:>8}  process start, no snapshot: {cold * 1000:6.1f}ms  "
+                  f"with snapshot: {warm * 1000:6.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Benchmark suite of the interpreter's hot paths.
+
+    mylisp-bench run --output results.json
+    mylisp-bench run --filter calls lists --modes closure --repeat 10
+    mylisp-bench compare baseline.json results.json --threshold 0.1
+
+`run` times every benchmark `--repeat` times per evaluation mode, after
+one untimed warmup run, and writes the statistics of the runs to a JSON
+file. `compare` matches two of those files benchmark by benchmark and
+flags the ones whose median got slower by more than `--threshold`
+(exiting with status 1 if there is any), so a stored baseline catches
+regressions. `run --baseline FILE` does both at once.
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import re
+import statistics
+import sys
+import time
+
+import lisp
+from lisp import parallel
+from lisp.cache import load_stdlib
+from lisp.compiler import Print, Reader, ev, evalS, read_from_tokens, tokenize
+
+from benchmarks.bench_mandelbrot import PROGRAMS, mandelbrot_program, run as run_mandelbrot
+from benchmarks.bench_reader import generate_program
+
+BENCHMARKS = dict() # name -> function(mode) returning the function to time
+
+
+MODES = ("tree", "closure", "vm")
+
+
+def benchmark(name, modes=MODES):
+    "Registers a benchmark, run once per evaluation mode in `modes`."
+    def register(setup):
+        BENCHMARKS[name] = (setup, modes)
+        return setup
+    return register
+
+
+def lisp_benchmark(name, program, setup_program="", modes=MODES):
+    "A benchmark timing `program`, evaluated after `setup_program`."
+    @benchmark(name, modes)
+    def setup(mode):
+        ctx = ev(setup_program, what_to_print=Print.NOTHING, mode=mode)
+        return lambda: evalS(program, ctx, mode=mode)
+
+#######################################
+
+PARSE_SIZE = 256 * 1024
+
+@benchmark("parse/tokenize", modes=("-",))
+def parse_tokens(mode):
+    program = generate_program(PARSE_SIZE)
+    def run():
+        tokens = tokenize(program)
+        while tokens:
+            read_from_tokens(tokens)
+    return run
+
+@benchmark("parse/reader", modes=("-",))
+def parse_reader(mode):
+    program = generate_program(PARSE_SIZE)
+    return lambda: sum(1 for _ in Reader(program))
+
+
+@benchmark("startup/ev")
+def startup(mode):
+    return lambda: ev("", what_to_print=Print.NOTHING, mode=mode)
+
+@benchmark("startup/evaluate-stdlib")
+def startup_uncached(mode):
+    return lambda: load_stdlib(mode, cache=False)
+
+@benchmark("startup/fork-10k")
+def startup_forks(mode):
+    env = load_stdlib(mode)
+    def run():
+        for _ in range(10000):
+            evalS("(fact 5)", env.fork(), mode=mode)
+    return run
+
+
+lisp_benchmark("calls/fact", "(map fact (seq 0 200))")
+lisp_benchmark("calls/fibo", "(map fibo (seq 3 80))")
+lisp_benchmark("calls/lucas-list", "(lucas-list 2000 '(2 1))")
+
+for n in (100, 1000, 10000):
+    bench_list = f"(define bench-list (seq 0 {n}))"
+    lisp_benchmark(f"lists/seq-{n}", f"(seq 0 {n})")
+    lisp_benchmark(f"lists/reverse-{n}", "(reverse bench-list)", bench_list)
+    lisp_benchmark(f"lists/filter-{n}", "(filter (lambda (x) (= (mod x 3) 0)) bench-list)", bench_list)
+    lisp_benchmark(f"lists/zip-{n}", "(zip bench-list bench-list)", bench_list)
+    lisp_benchmark(f"lists/length-{n}", "(length bench-list)", bench_list)
+    lisp_benchmark(f"lists/last-{n}", "(last bench-list)", bench_list)
+
+# Text of 20000 numbers: a + per number, or built in one go
+for name, program in {
+        "fold-concat": '(fold (lambda (x acc) (+ acc (show x) " ")) "" bench-list)',
+        "join": '(string-join (map show bench-list) " ")',
+        "builder": '(sb->string (fold (lambda (x sb) (sb-append sb x " ")) (string-builder) bench-list))',
+        }.items():
+    lisp_benchmark(f"strings/{name}-20000", program, "(define bench-list (seq 0 20000))")
+
+lisp_benchmark("closures/let", """
+  (let ((adder (lambda (a) (lambda (b) (+ a b))))
+        (twice (lambda (f) (lambda (x) (f (f x))))))
+    (fold (lambda (x acc) ((twice (adder x)) acc)) 0 (seq 0 3000)))""")
+
+
+# Dedup: a linear scan of the list seen so far, or a lookup in a set
+lisp_benchmark("maps/dedup-list", """
+  (fold (lambda (x seen) (if (fold (lambda (y found) (or found (= x y))) nil seen) seen (cons x seen)))
+        '() bench-list)""", "(define bench-list (map (lambda (x) (mod x 200)) (seq 0 1000)))")
+lisp_benchmark("maps/dedup-set", """
+  (fold (lambda (x seen) (if (contains? seen x) seen (union seen (hash-set x))))
+        #{} bench-list)""", "(define bench-list (map (lambda (x) (mod x 200)) (seq 0 1000)))")
+
+for name in PROGRAMS:
+    @benchmark(f"mandelbrot/{name}-32")
+    def mandelbrot(mode, name=name):
+        program = mandelbrot_program(32, PROGRAMS[name])
+        return lambda: run_mandelbrot(program, mode)
+
+#######################################
+
+def measure(func, repeat: int) -> dict:
+    with contextlib.redirect_stdout(io.StringIO()):
+        func() # warmup
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    return {
+        "runs": times,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "max": max(times),
+    }
+
+
+def run_suite(patterns, modes, repeat) -> dict:
+    results = dict()
+    for name, (setup, benchmark_modes) in BENCHMARKS.items():
+        if patterns and not any(re.search(p, name) for p in patterns):
+            continue
+        for mode in benchmark_modes:
+            if mode != "-" and mode not in modes:
+                continue
+            key = name if mode == "-" else f"{name}[{mode}]"
+            stats = measure(setup(mode), repeat)
+            results[key] = stats
+            print(f"{key:<36} median {stats['median'] * 1000:9.2f}ms  "
+                  f"stdev {stats['stdev'] * 1000:8.2f}ms", flush=True)
+
+    return {
+        "meta": {
+            "version": lisp.__version__,
+            "python": sys.version,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    "Prints the benchmarks of both; returns the names of the regressions."
+    regressions = []
+    for key, stats in current["results"].items():
+        if key not in baseline["results"]:
+            continue
+        before, after = baseline["results"][key]["median"], stats["median"]
+        change = after / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{key:<36} {before * 1000:9.2f}ms -> {after * 1000:9.2f}ms  {change:+7.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmarks")
+    run.add_argument("--filter", nargs="+", default=[], metavar="REGEX",
+                     help="only the benchmarks whose name matches one of these")
+    run.add_argument("--modes", nargs="+", default=list(MODES))
+    run.add_argument("--repeat", type=int, default=5)
+    run.add_argument("--workers", type=int, default=None, help="processes used by pmap")
+    run.add_argument("--output", help="JSON file for the results")
+    run.add_argument("--baseline", help="JSON results to compare with")
+    run.add_argument("--threshold", type=float, default=0.1)
+
+    cmp = commands.add_parser("compare", help="compare two JSON results")
+    cmp.add_argument("baseline")
+    cmp.add_argument("current")
+    cmp.add_argument("--threshold", type=float, default=0.1,
+                     help="slowdown of the median flagged as a regression (default: 0.1)")
+
+    commands.add_parser("list", help="list the benchmarks")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        for name, (_, modes) in BENCHMARKS.items():
+            print(name if modes == ("-",) else f"{name} [{' '.join(modes)}]")
+        return 0
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        return 1 if compare(baseline, current, args.threshold) else 0
+
+    parallel.WORKERS = args.workers
+    results = run_suite(args.filter, args.modes, args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        return 1 if compare(baseline, results, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
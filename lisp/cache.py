@@ -0,0 +1,100 @@
+"""
+Stdlib snapshots.
+
+Evaluating the stdlib at every start means reading, parsing and
+evaluating all of its forms again. `load_stdlib` does it once: the
+values the stdlib defines are pickled (see lisp.serialize) to a file
+in the cache directory, and later starts just unpickle them on top of a
+copy of the base context. The snapshot of every file is also kept in
+memory, so each later load in the same process skips the disk too.
+
+A snapshot is keyed by a hash of the stdlib, of the sources of the
+interpreter, of its version and of Python's, and of the evaluation
+mode: editing any of them means a new snapshot. The cache directory is
+$MYLISP_CACHE_DIR, or mylisp/ in the user cache directory.
+"""
+import functools
+import hashlib
+import os
+import pathlib
+import pickle
+import sys
+
+import lisp
+from lisp import serialize
+from lisp.compiler import Context, Print, STDLIB_PATH, context_base, eval_program
+
+_snapshots = dict() # key -> pickled definitions
+
+
+def cache_dir() -> pathlib.Path:
+    if "MYLISP_CACHE_DIR" in os.environ:
+        return pathlib.Path(os.environ["MYLISP_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(base) / "mylisp"
+
+
+@functools.lru_cache(maxsize=None)
+def interpreter_digest() -> bytes:
+    "Hash of the interpreter, as it was when this process loaded it."
+    digest = hashlib.sha256()
+    for part in (lisp.__version__, sys.version):
+        digest.update(part.encode() + b"\0")
+    for source in sorted(pathlib.Path(lisp.__file__).parent.glob("*.py")):
+        digest.update(source.read_bytes() + b"\0")
+    return digest.digest()
+
+def snapshot_key(path, mode: str) -> str:
+    digest = hashlib.sha256(interpreter_digest())
+    digest.update(mode.encode() + b"\0")
+    digest.update(pathlib.Path(path).read_bytes())
+    return digest.hexdigest()
+
+
+def base_context() -> Context:
+    "A new global context with just the builtins."
+    return Context(context_base.keys(), context_base.values())
+
+
+def load_stdlib(mode="tree", path=STDLIB_PATH, cache=True) -> Context:
+    """
+    A new global context with the stdlib at `path` loaded, from its
+    snapshot if there is one.
+    """
+    if not cache:
+        return eval_program(path, base_context(), what_to_print=Print.NOTHING, mode=mode)
+
+    key = snapshot_key(path, mode)
+    snapshot = cache_dir() / f"{key}.pickle"
+
+    if key not in _snapshots:
+        try:
+            _snapshots[key] = snapshot.read_bytes()
+        except OSError:
+            pass
+
+    if key in _snapshots:
+        ctx = base_context()
+        try:
+            ctx.update(serialize.loads(_snapshots[key], ctx))
+            return ctx
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+            del _snapshots[key] # a stale or broken file: make it again
+
+    ctx = eval_program(path, base_context(), what_to_print=Print.NOTHING, mode=mode)
+    missing = object()
+    definitions = {k: v for k, v in ctx.items() if context_base.get(k, missing) is not v}
+    try:
+        _snapshots[key] = serialize.dumps(definitions, snapshot=True)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return ctx # something in there can't be pickled: no snapshot
+
+    try:
+        snapshot.parent.mkdir(parents=True, exist_ok=True)
+        partial = snapshot.with_suffix(f".{os.getpid()}.tmp")
+        partial.write_bytes(_snapshots[key])
+        os.replace(partial, snapshot) # other processes never see half a file
+    except OSError:
+        pass # no cache on disk then, only in memory
+
+    return ctx
@@ -0,0 +1,445 @@
+"""
+Closure compiler.
+
+Instead of looking at every node of the AST each time it is evaluated,
+like `eval_free` does, an expression is compiled once into a tree of
+Python closures, each specialized for one kind of node (constant,
+variable, `if`, call...). Running the expression is then just calling
+the root closure with a frame.
+
+Variables are resolved while compiling. A `lambda` or a `let` opens a
+`Scope`, and at runtime every scope becomes a `Frame` holding its values
+in an array, so a local variable is found at a fixed (depth, slot)
+address without any dictionary lookup. Variables bound by no scope are
+globals, looked up in the global Context. A global that is neither
+bound nor defined anywhere in the compiled expression is reported
+before running it, unless it is only referenced from inside a lambda,
+since a later `define` may still bind it.
+
+Calls in tail position don't call: they return a `TailCall`, which the
+`call` trampoline runs in a loop, so tail recursion takes constant stack
+just like in `eval_free`.
+"""
+from lisp.compiler import *
+from lisp import jit, macro
+
+
+class Scope():
+    "The variables bound by a lambda or a let, known at compile time."
+    def __init__(self, names: list, parent=None, is_procedure=False):
+        self.names = list(names)
+        # A name given twice refers to its last slot, like in a dict
+        self.slots = {name: i for i, name in enumerate(self.names)}
+        self.parent = parent
+        self.is_procedure = is_procedure
+        self.in_procedure = is_procedure or (parent is not None and parent.in_procedure)
+        # Only the first `visible` slots can be referenced directly: a
+        # let clause sees the names bound by the clauses before it.
+        self.visible = len(self.names)
+
+    def view(self, visible: int):
+        "This same scope, as seen by code running before all its slots are set."
+        view = object.__new__(Scope)
+        view.__dict__.update(self.__dict__, visible=visible)
+        return view
+
+    def resolve(self, name):
+        "The (depth, slot) where `name` is found, or None for a global."
+        depth, scope, deferred = 0, self, False
+        while scope is not None:
+            slot = scope.slots.get(name)
+            if slot is not None and (deferred or slot < scope.visible):
+                return depth, slot
+            # Code inside a lambda only runs once its outer scopes are full
+            deferred = deferred or scope.is_procedure
+            scope, depth = scope.parent, depth + 1
+        return None
+
+
+class Frame():
+    "The runtime values of a Scope, stored in an array of slots."
+    __slots__ = ("slots", "outer", "scope")
+
+    def __init__(self, slots, outer, scope: Scope):
+        self.slots, self.outer, self.scope = slots, outer, scope
+
+    def find(self, var):
+        frame = self
+        while isinstance(frame, Frame):
+            slot = frame.scope.slots.get(var)
+            if slot is not None:
+                return frame.slots[slot]
+            frame = frame.outer
+        return frame.find(var)
+
+    def outermost_add(self, k, v):
+        self.outer.outermost_add(k, v)
+
+    def depth(self, acc=0):
+        return self.outer.depth(acc=acc+1)
+
+    def __repr__(self):
+        return repr(dict(zip(self.scope.names, self.slots)))
+
+
+class TailCall():
+    "A call left for the trampoline to do."
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, args):
+        self.func, self.args = func, args
+
+
+class CompiledProcedure(Procedure):
+    "A procedure whose body has been compiled to closures."
+    def __init__(self, parms, body, ctx, code, scope, _help=None, location=None):
+        self.parms, self.body, self.ctx = parms, body, ctx
+        self.code, self.scope = code, scope
+        self.help = _help
+        self.name, self.location = None, location
+
+    def __call__(self, *args):
+        return call(self, args)
+
+
+def call(func, args):
+    "Calls `func` on `args`, running in a loop the tail calls it returns."
+    while type(func) is CompiledProcedure:
+        if len(args) != len(func.parms):
+            raise LispError(f"procedure {ast_to_str(func.parms)} expects "
+                            f"{len(func.parms)} arguments, given {len(args)}")
+
+        result = func.code(Frame(args, func.ctx, func.scope))
+        if type(result) is not TailCall:
+            return result
+        func, args = result.func, result.args
+
+    return func(*args)
+
+
+def run_body(func, args):
+    "Runs the body of `func` once: its value, or the TailCall it ends with."
+    if len(args) != len(func.parms):
+        raise LispError(f"procedure {ast_to_str(func.parms)} expects "
+                        f"{len(func.parms)} arguments, given {len(args)}")
+    return func.code(Frame(args, func.ctx, func.scope))
+
+
+def eval_closure(ast, context):
+    "Compiles `ast` and runs it in `context`."
+    scope = context.scope if isinstance(context, Frame) else None
+    return Compiler(global_context(context), ast).compile(ast, scope)(context)
+
+
+def global_context(ctx):
+    "The Context where `define` binds names."
+    while isinstance(ctx, Frame):
+        ctx = ctx.outer
+    return ctx
+
+def outermost_context(ctx):
+    """
+    The outermost Context of `ctx`, where its globals live. It differs
+    from the global context of a procedure sent to another process,
+    whose captured values are in a Context of their own.
+    """
+    while ctx.outer is not None:
+        ctx = ctx.outer
+    return ctx
+
+
+def defined_names(ast) -> set:
+    "Names bound by a `define` anywhere in `ast`."
+    names, stack = set(), [ast]
+    while stack:
+        ast = stack.pop()
+        if isinstance(ast, list) and len(ast) > 0:
+            if ast[0] in ("quote", "string"):
+                continue
+            if ast[0] == "define" and len(ast) > 1:
+                names.add(ast[1])
+            stack.extend(ast)
+    return names
+
+#######################################
+
+class Compiler():
+    """
+    Compiles the ASTs that will run in the global context `genv`. Every
+    method compiling a node takes the scope it is compiled in and whether
+    it is in tail position of a procedure body.
+    """
+    def __init__(self, genv: Context, unit=None):
+        self.genv = genv
+        self.defines = defined_names(unit)
+
+    def compile(self, ast, scope: Scope = None, tail=False):
+        if isinstance(ast, Symbol):
+            return self.compile_symbol(ast, scope)
+
+        if isinstance(ast, (*Number, str)):
+            return lambda frame: ast
+
+        if isinstance(ast, list):
+            if len(ast) == 0:
+                return lambda frame: []
+
+            if isinstance(ast[0], str) and ast[0] in SPECIAL_FORMS:
+                return SPECIAL_FORMS[ast[0]](self, ast, scope, tail)
+
+            return self.compile_call(ast, scope, tail)
+
+        raise LispError("Unknwown type")
+
+    def is_global(self, name) -> bool:
+        return self.genv.binds(name)
+
+    def compile_symbol(self, name, scope):
+        where = None if scope is None else scope.resolve(name)
+
+        if where is None:
+            if (not self.is_global(name) and name not in self.defines
+                and (scope is None or not scope.in_procedure)):
+                raise LispSymbolError(f"unbound symbol: {name}")
+
+            genv = self.genv
+            def global_variable(frame):
+                try:
+                    return genv[name]
+                except KeyError:
+                    return genv.find(name)
+            return global_variable
+
+        depth, slot = where
+        if depth == 0:
+            return lambda frame: frame.slots[slot]
+        if depth == 1:
+            return lambda frame: frame.outer.slots[slot]
+        if depth == 2:
+            return lambda frame: frame.outer.outer.slots[slot]
+
+        def variable(frame):
+            for _ in range(depth):
+                frame = frame.outer
+            return frame.slots[slot]
+        return variable
+
+    def compile_call(self, ast, scope, tail):
+        func = self.compile(ast[0], scope)
+        args = [self.compile(x, scope) for x in ast[1:]]
+
+        if tail:
+            def tail_call(frame):
+                return TailCall(func(frame), [arg(frame) for arg in args])
+            return tail_call
+
+        if len(args) == 1:
+            arg0, = args
+            def call1(frame):
+                f = func(frame)
+                if type(f) is CompiledProcedure:
+                    return call(f, (arg0(frame),))
+                return f(arg0(frame))
+            return call1
+
+        if len(args) == 2:
+            arg0, arg1 = args
+            def call2(frame):
+                f = func(frame)
+                if type(f) is CompiledProcedure:
+                    return call(f, (arg0(frame), arg1(frame)))
+                return f(arg0(frame), arg1(frame))
+            return call2
+
+        def call_n(frame):
+            return call(func(frame), [arg(frame) for arg in args])
+        return call_n
+
+    def compile_body(self, parms, body, inner):
+        "The code of a procedure body, tiered when the JIT is on (see lisp.jit)."
+        code = self.compile(body, inner, tail=True)
+        if jit.THRESHOLD is not None:
+            code = jit.tiered(code, parms, body, inner, self.genv)
+        return code
+
+    #######################################
+
+    def compile_quote(self, ast, scope, tail):
+        value = ast[1]
+        return lambda frame: value
+
+    def compile_list(self, ast, scope, tail):
+        elements = [self.compile(x, scope) for x in ast[1:]]
+        return lambda frame: [el(frame) for el in elements]
+
+    def compile_lambda(self, ast, scope, tail):
+        if len(ast[1:]) == 3:
+            variables, _help, body = ast[1], self.compile(ast[2], scope), ast[3]
+        elif len(ast[1:]) == 2:
+            variables, _help, body = ast[1], None, ast[2]
+        else:
+            raise LispError(f"lambda expects 2/3 arguments, were given {len(ast[1:])}")
+
+        inner = Scope(variables, scope, is_procedure=True)
+        code = self.compile_body(variables, body, inner)
+        location = getattr(ast, "location", None)
+
+        def make_procedure(frame):
+            return CompiledProcedure(variables, body, frame, code, inner,
+                                     None if _help is None else _help(frame), location)
+        return make_procedure
+
+    def compile_define(self, ast, scope, tail):
+        name, value = ast[1], self.compile(ast[2], scope)
+        genv = self.genv
+
+        def define(frame):
+            genv.outermost_add(name, named(value(frame), name))
+            return name
+        return define
+
+    def compile_cond(self, ast, scope, tail):
+        clauses = [(self.compile(clause[0], scope), self.compile(clause[1], scope, tail))
+                   for clause in ast[1:]]
+        last_condition = ast[-1][0]
+
+        def cond(frame):
+            for test, body in clauses:
+                if test(frame):
+                    return body(frame)
+            raise AssertionError(f"{last_condition} should evaluate to T!")
+        return cond
+
+    def compile_if(self, ast, scope, tail):
+        test, then = self.compile(ast[1], scope), self.compile(ast[2], scope, tail)
+        if len(ast) < 4:
+            def _if(frame):
+                if test(frame):
+                    return then(frame)
+                raise LispError(f"missing else branch in {ast_to_str(ast)}")
+            return _if
+
+        other = self.compile(ast[3], scope, tail)
+        def _if(frame):
+            return then(frame) if test(frame) else other(frame)
+        return _if
+
+    def compile_begin(self, ast, scope, tail):
+        if len(ast) < 2:
+            raise LispError("begin expects at least one expression")
+
+        body = [self.compile(x, scope) for x in ast[1:-1]]
+        last = self.compile(ast[-1], scope, tail)
+
+        def begin(frame):
+            for x in body:
+                x(frame)
+            return last(frame)
+        return begin
+
+    def compile_curry(self, ast, scope, tail):
+        partial = ast[1]
+        func = self.compile(partial[0], scope)
+        num_declared_args = len(partial) - 1
+        by_arity = dict() # arity -> compiled lambda
+
+        def curry(frame):
+            function_arity = deduce_arity(func(frame))
+            if function_arity not in by_arity:
+                alfabeto = "abcdefghij"
+                missing = [Symbol(c) for c in alfabeto[:function_arity-num_declared_args]]
+                by_arity[function_arity] = self.compile_lambda(
+                    ["lambda", missing, partial + missing], scope, False)
+            return by_arity[function_arity](frame)
+        return curry
+
+    def compile_let(self, ast, scope, tail):
+        MULTI_LET = len(ast) == 3
+
+        if MULTI_LET:
+            bindings, body = [(clause[0], clause[1]) for clause in ast[1]], ast[2]
+        else:
+            bindings, body = [(ast[1], ast[2])], ast[3]
+
+        inner = Scope(dict.fromkeys(name for name, _ in bindings), scope)
+        clauses, bound = [], set()
+        for name, value in bindings:
+            clauses.append((name, inner.slots[name],
+                            self.compile(value, inner.view(len(bound)))))
+            bound.add(name)
+        body = self.compile(body, inner, tail)
+        size = len(inner.names)
+
+        def let(frame):
+            slots = [None] * size
+            inner_frame = Frame(slots, frame, inner)
+            for name, slot, value in clauses:
+                slots[slot] = named(value(inner_frame), name)
+            return body(inner_frame)
+        return let
+
+    def compile_debug(self, ast, scope, tail):
+        # Hooks only see the tree walker: compiled code runs untraced even
+        # after (debug t).
+        def debug(frame):
+            return eval_free(["debug", ast[1]], frame)
+        return debug
+
+    def compile_eval(self, ast, scope, tail):
+        return self.compile(ast[1], scope, tail)
+
+    def compile_evalS(self, ast, scope, tail):
+        genv = self.genv
+
+        if isinstance(ast[1], list) and len(ast[1]) > 0 and ast[1][0] == "string":
+            code = None
+            def evalS_literal(frame):
+                nonlocal code
+                if code is None:
+                    program = macro.expand_source(ast[1], ast[1][1], genv, eval_closure)
+                    code = Compiler(genv, program).compile(program, scope)
+                return code(frame)
+            return evalS_literal
+
+        source = self.compile(ast[1], scope)
+        def evalS(frame):
+            program = source(frame)
+            if isinstance(program, list) and len(program) > 0 and program[0] == "string":
+                program = program[1]
+            if not isinstance(program, str):
+                raise LispError(f"evalS expects a string, got {program}")
+            program = macro.expand(parse(program), genv, eval_closure)
+            return Compiler(genv, program).compile(program, scope)(frame)
+        return evalS
+
+    def compile_profile(self, ast, scope, tail):
+        from lisp import profiler
+        body = self.compile(ast[1], scope)
+        return lambda frame: profiler.profile_form(lambda: body(frame))
+
+    def compile_print(self, ast, scope, tail):
+        value = self.compile(ast[1], scope)
+        def _print(frame):
+            eval_body = value(frame)
+            print(eval_body)
+            return eval_body
+        return _print
+
+
+SPECIAL_FORMS = {
+    "quote": Compiler.compile_quote,
+    "string": Compiler.compile_quote,
+    "list": Compiler.compile_list,
+    "lambda": Compiler.compile_lambda,
+    "define": Compiler.compile_define,
+    "cond": Compiler.compile_cond,
+    "if": Compiler.compile_if,
+    "begin": Compiler.compile_begin,
+    "curry": Compiler.compile_curry,
+    "let": Compiler.compile_let,
+    "debug": Compiler.compile_debug,
+    "eval": Compiler.compile_eval,
+    "evalS": Compiler.compile_evalS,
+    "profile": Compiler.compile_profile,
+    "print": Compiler.compile_print,
+}
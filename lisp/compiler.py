@@ -1,15 +1,19 @@
 from typing import List, Callable, Dict, Tuple,  _CallableGenericAlias
 import socket
-import shlex
 import threading
 import os
+import pathlib
 import random
+import re
 
 from lisp.utils import *
+from lisp import rlist, numarray, parallel, memo, macro, lazy, hamt, files, strings, native
+from lisp.rlist import RList
+from lisp.numarray import NumArray
 
 class Symbol(str): pass
 
-Number = (int, float)     # A Scheme Number is implemented as a Python int or float
+Number = (int, float, complex) # A Scheme Number is implemented as a Python int, float or complex
 Atom   = (Symbol, Number) # A Scheme Atom is a Symbol or Number
 List   = list             # A Scheme List is implemented as a Python list
 Exp    = (Atom, List)     # A Scheme expression is an Atom or List
@@ -20,61 +24,301 @@ class LispError(Exception): pass
 class LispParseError(LispError): pass
 class LispSymbolError(LispError): pass
 
+# Every character of the source matches exactly one of these groups, so a
+# single left-to-right pass of `match` over the text yields all the tokens.
+_TOKEN_RE = re.compile(r"""
+    (?P<skip>(?:\s+|;[^\n]*)+)   # whitespace and ; comments
+  | (?P<open>\(|\#?\{)          # a list, a {map} or a #{set}
+  | (?P<close>[)}])
+  | (?P<quote>['`])
+  | (?P<string>"[^"]*")
+  | (?P<badstring>")           # a " without its closing twin
+  | (?P<atom>[^\s(){}'`";]+)
+""", re.X)
+
 def tokenize(chars: str) -> list:
     "Convert a string of characters into a list of tokens."
-    return shlex.split(
-        replace_but_not_inside_quotes('(', ' ( ',
-          replace_but_not_inside_quotes(')', ' ) ',
-            replace_but_not_inside_quotes("'", " ` ", chars))),
-        posix=False
-    )
-            
+    tokens = []
+    for m in _TOKEN_RE.finditer(chars):
+        kind = m.lastgroup
+        if kind == "skip":
+            continue
+        if kind == "quote":
+            tokens.append("`")
+        elif kind == "badstring":
+            raise LispParseError(f"unterminated string at {location(chars, m.start())}")
+        else:
+            tokens.append(m.group())
+    return tokens
+
+def location(chars: str, pos: int, name: str = "<string>") -> str:
+    "Human readable `name:line:column` of the offset `pos` in `chars`."
+    line = chars.count("\n", 0, pos) + 1
+    column = pos - chars.rfind("\n", 0, pos)
+    return f"{name}:{line}:{column}"
+
+# Brackets other than ( read as a call of the builtin making the value
+CLOSING = {"(": ")", "{": "}", "#{": "}"}
+LITERALS = {"{": "hash-map", "#{": "hash-set"}
+
+class SourceList(list):
+    "A list read from the source, with the place it was read from."
+    __slots__ = ("location",)
+
+    def __init__(self, items, location: str):
+        super().__init__(items)
+        self.location = location
+
+class Reader():
+    """
+    Reads expressions out of a source string or an open text stream in
+    a single pass, moving an index cursor along the text instead of
+    splitting it first. Streams are read `chunk_size` characters at a
+    time, and the text already consumed is dropped, so only the current
+    chunk is ever held in memory.
+    """
+    def __init__(self, source: Union[str, IO], name: str = None, chunk_size: int = 1 << 16):
+        if isinstance(source, str):
+            self.source, self.stream = source, None
+            self.name = "<string>" if name is None else name
+        else:
+            self.source, self.stream = "", source
+            self.name = getattr(source, "name", "<stream>") if name is None else name
+        self.pos = 0
+        self.chunk_size = chunk_size
+        # Where the current buffer starts, in the whole text
+        self.first_line, self.first_column = 1, 0
+        # The line of the last position located: lines are counted from
+        # there, so locating along the text costs a single pass over it.
+        self.mark, self.mark_line = 0, 1
+
+    def location(self, pos: Union[int, str]) -> str:
+        if isinstance(pos, str): # already resolved before its text was dropped
+            return pos
+        if pos >= self.mark:
+            line = self.mark_line + self.source.count("\n", self.mark, pos)
+            self.mark, self.mark_line = pos, line
+        else: # an enclosing list, opened before the last position located
+            line = self.mark_line - self.source.count("\n", pos, self.mark)
+        newline = self.source.rfind("\n", 0, pos)
+        column = pos - newline if newline >= 0 else self.first_column + pos + 1
+        return f"{self.name}:{line}:{column}"
+
+    def refill(self, stack: list) -> bool:
+        "Drop the consumed text and read the next chunk; False at end of stream."
+        drop = self.pos
+        # Reading at least as much as is kept makes long tokens grow the
+        # buffer geometrically instead of one chunk at a time.
+        size = max(self.chunk_size, len(self.source) - drop)
+        chunk = self.stream.read(size) if self.stream is not None else ""
+        if not chunk:
+            self.stream = None
+            return False
+
+        for entry in stack:
+            if isinstance(entry[1], int):
+                entry[1] = self.location(entry[1]) if entry[1] < drop else entry[1] - drop
+
+        dropped_lines = self.source.count("\n", 0, drop)
+        if dropped_lines:
+            self.first_line += dropped_lines
+            self.first_column = drop - self.source.rfind("\n", 0, drop) - 1
+        else:
+            self.first_column += drop
+        if self.mark >= drop:
+            self.mark -= drop
+        else:
+            self.mark, self.mark_line = 0, self.first_line
+
+        self.source = self.source[drop:] + chunk
+        self.pos = 0
+        return True
+
+    def read(self) -> Exp:
+        "Read the next expression, raising LispParseError at end of input."
+        match = _TOKEN_RE.match
+        # Open lists and pending quotes as [list, position, opening
+        # bracket], innermost last. A pending quote is stored as a `None` list.
+        stack = []
+
+        while True:
+            m = match(self.source, self.pos)
+
+            # A token touching the end of the buffer may continue in the
+            # next chunk, as may a string still missing its closing quote:
+            # read more and match it again.
+            if (self.stream is not None
+                and (m is None or m.end() == len(self.source) or m.lastgroup == "badstring")
+                and self.refill(stack)):
+                continue
+
+            if m is None:
+                if stack:
+                    raise LispParseError(
+                        f"unexpected EOF: unclosed ( at {self.location(stack[-1][1])}")
+                raise LispParseError('unexpected EOF')
+
+            kind, start, self.pos = m.lastgroup, m.start(), m.end()
+
+            if kind == "skip":
+                continue
+            if kind == "open":
+                stack.append([[], start, m.group()])
+                continue
+            if kind == "quote":
+                stack.append([None, start, None])
+                continue
+
+            if kind == "atom":
+                exp = atom(m.group())
+            elif kind == "string":
+                exp = ["string", m.group()[1:-1]]
+            elif kind == "close":
+                if not stack or stack[-1][0] is None or CLOSING[stack[-1][2]] != m.group():
+                    raise LispParseError(f"unexpected {m.group()} at {self.location(start)}")
+                exp, pos, bracket = stack.pop()
+                if bracket != "(":
+                    exp = [Symbol(LITERALS[bracket])] + exp
+                elif exp and exp[0] == "lambda":
+                    exp = SourceList(exp, self.location(pos))
+            else:
+                raise LispParseError(f"unterminated string at {self.location(start)}")
+
+            while stack and stack[-1][0] is None:
+                stack.pop()
+                exp = ["quote", exp]
+
+            if not stack:
+                return exp
+            stack[-1][0].append(exp)
+
+    def at_end(self) -> bool:
+        "Skips blanks and comments; True if nothing else is left to read."
+        while True:
+            m = _TOKEN_RE.match(self.source, self.pos)
+            if (self.stream is not None
+                and (m is None or m.end() == len(self.source))
+                and self.refill([])):
+                continue
+            if m is not None and m.lastgroup == "skip":
+                self.pos = m.end()
+            return self.pos >= len(self.source)
+
+    def __iter__(self):
+        "Yields every top-level expression left in the source."
+        while not self.at_end():
+            yield self.read()
+
+
+def read_forms(program: Union[str, os.PathLike, IO]) -> Iterator:
+    """
+    Yields the top-level expressions of a program one at a time. The
+    program is either its source text, the path of a file or an open
+    text stream; files and streams are read lazily, as forms are asked for.
+    """
+    if isinstance(program, os.PathLike):
+        with open(program, "r") as f:
+            yield from Reader(f)
+    else:
+        yield from Reader(program)
+
 
 def parse(program: str) -> Exp:
     "Read a Scheme expression from a string."
-    return read_from_tokens(tokenize(program))
+    return Reader(program).read()
 
 def read_from_tokens(tokens: list) -> Exp:
     "Read an expression from a sequence of tokens."
-    if len(tokens) == 0:
-        raise LispParseError('unexpected EOF')
-
-    token = tokens.pop(0)
-
-    if token == "`":
-        return ["quote", read_from_tokens(tokens)]
-    if token.startswith("\""):
-        return ["string", token[1:-1]]
-    if token == '(':
-        L = []
-        while tokens[0] != ')':
-            L.append(read_from_tokens(tokens))
-        tokens.pop(0) # pop off ')'
-        return L
-    if token == ')':
-        raise LispParseError('unexpected )')
-    
-    return atom(token)
-
+    i = 0
+
+    def read():
+        nonlocal i
+        if i >= len(tokens):
+            raise LispParseError('unexpected EOF')
+
+        token = tokens[i]
+        i += 1
+
+        if token == "`":
+            return ["quote", read()]
+        if token.startswith("\""):
+            return ["string", token[1:-1]]
+        if token in CLOSING:
+            L = [] if token == "(" else [Symbol(LITERALS[token])]
+            while i < len(tokens) and tokens[i] not in (")", "}"):
+                L.append(read())
+            if i >= len(tokens):
+                raise LispParseError('unexpected EOF')
+            if tokens[i] != CLOSING[token]:
+                raise LispParseError(f'unexpected {tokens[i]}')
+            i += 1 # skip ')'
+            return L
+        if token in (")", "}"):
+            raise LispParseError(f'unexpected {token}')
+
+        return atom(token)
+
+    exp = read()
+    del tokens[:i] # consume what was read, like the old pop(0) did
+    return exp
+
+
+_COMPLEX_RE = re.compile(r"""
+    [+-]? (?: \d+\.?\d* | \.\d+ ) (?: [eE][+-]?\d+ )?        # real or imaginary part
+    (?: [+-] (?: \d+\.?\d* | \.\d+ ) (?: [eE][+-]?\d+ )? )?  # imaginary part
+    i
+""", re.X)
 
 def atom(token: str) -> Atom:
-    "Numbers become numbers; every other token is a symbol."
+    "Numbers become numbers (`1+2i` is a complex); every other token is a symbol."
+    # Only tokens that may be numbers pay for the int/float attempts
+    c = token[0]
+    if not (c.isdigit() or c in "+-." or token.lower() in ("inf", "infinity", "nan")):
+        return Symbol(token)
+
     try: return int(token)
     except ValueError:
         try: return float(token)
         except ValueError:
-            # if token[0] == "\"":
-            #     return ["string", token] #TODO?
-            # else:
+            if _COMPLEX_RE.fullmatch(token):
+                return complex(token[:-1] + "j")
             return Symbol(token)
 
 ##################################
 
 class Context(dict):
+    """
+    The names bound by a procedure call or a let, in front of the
+    Context it is in, up to the global one whose `outer` is None.
+
+    `fork` makes a new global Context in front of this one: its defines
+    are its own, the rest is read through to its `parent`, frozen from
+    then on.
+    """
+    guarded = frozenset() # names optimized code depends on: see lisp.optimizer
+    parent = None # the global Context this one was forked from
+    frozen = False # forked: defining names in it raises a LispError
+
     def __init__(self, parms: list, args: list, outer=None):
         self.update(zip(parms, args))
         self.outer = outer
 
+    def __missing__(self, key):
+        if self.parent is None:
+            raise KeyError(key)
+        # The parent never changes: keep its value here for the next time
+        value = self[key] = self.parent[key]
+        return value
+
+    def fork(self) -> "Context":
+        "An empty global Context over this one, which is frozen; O(1)."
+        if self.outer is not None:
+            raise LispError("only the global context can be forked")
+        self.frozen = True
+        child = Context((), ())
+        child.parent = self
+        return child
+
     def depth(self, acc=0):
         if self.outer is None:
             return acc
@@ -85,30 +329,58 @@ class Context(dict):
 
     def outermost_add(self, k, v):
         if self.outer is None:
+            if self.frozen:
+                raise LispError(f"cannot define {k}: the context is frozen, define it in a fork")
+            if k in self.guarded:
+                raise LispError(f"cannot define {k} again: optimized code depends on its value")
             self.add(k, v)
         else:
             self.outer.outermost_add(k, v)
         
     def find(self, var):
-        "Find the innermost Ctx where var appears."
+        "Find the value of var in the innermost Ctx where it appears."
+        ctx = self
+        while (outer := ctx.outer) is not None:
+            if var in ctx:
+                return ctx[var]
+            ctx = outer
         try:
-            return self[var] if (var in self) else self.outer.find(var)
-        except AttributeError as e:
-            print(f"Coulnd't find {var}")
-            raise LispSymbolError(str(e)) from e
+            return ctx[var] # the global Context, or the ones it was forked from
+        except KeyError:
+            raise LispSymbolError(f"unbound symbol: {var}") from None
+
+    def binds(self, var) -> bool:
+        "True if `find` finds `var`."
+        ctx = self
+        while ctx is not None:
+            if var in ctx:
+                return True
+            ctx = ctx.outer if ctx.outer is not None else ctx.parent
+        return False
         
 class Procedure():
-    "A user-defined Scheme procedure."
-    def __init__(self, parms, body, ctx, _help=None, debug=False):
+    """
+    A user-defined Scheme procedure. `name` is the first name it was
+    bound to by a define or a let, `location` where its lambda was read.
+    """
+    def __init__(self, parms, body, ctx, _help=None, location=None):
         self.parms, self.body, self.ctx = parms, body, ctx
-        self.help = None if _help is None else eval_free(_help, ctx, debug=debug)
-        self.debug = debug
+        self.help = None if _help is None else eval_free(_help, ctx)
+        self.name, self.location = None, location
     def __call__(self, *args):
-        return eval_free(self.body, Context(self.parms, args, outer=self.ctx), debug=self.debug)
-    
+        return eval_free(self.body, Context(self.parms, args, outer=self.ctx))
+
+def named(value, name):
+    "`value`, named `name` if it is a procedure without a name yet."
+    if isinstance(value, memo.Memo):
+        named(value.func, name)
+    elif isinstance(value, Procedure) and value.name is None:
+        value.name = name
+    return value
 
 ################################
 import time
+import inspect
 
 def print_help(foo: Union[Callable, Procedure]):
     if isinstance(foo, Procedure):
@@ -117,6 +389,10 @@ def print_help(foo: Union[Callable, Procedure]):
 
         return foo.help
 
+    # Builtins written in Python have their help in the docstring
+    if inspect.isroutine(foo) and foo.__doc__:
+        return foo.__doc__
+
     return False
 
 def read_file(fpath: str) -> str:
@@ -132,14 +408,24 @@ def import_func(fpath):
     pass # TODO
     
 def get_type(obj):
-    if isinstance(obj, (int, float)):
+    if isinstance(obj, Number):
         return Symbol("number")
     if isinstance(obj, Symbol):
         return Symbol("symbol")
     if isinstance(obj, str):
         return Symbol("string")
-    if isinstance(obj, list):
+    if isinstance(obj, (list, RList)):
         return Symbol("lst")
+    if isinstance(obj, NumArray):
+        return Symbol("array")
+    if isinstance(obj, lazy.LazySeq):
+        return Symbol("seq")
+    if isinstance(obj, hamt.HashMap):
+        return Symbol("map")
+    if isinstance(obj, hamt.HashSet):
+        return Symbol("set")
+    if isinstance(obj, strings.StringBuilder):
+        return Symbol("string-builder")
 
 def foldl(func, acc, l):
     for x in l:
@@ -150,7 +436,18 @@ def repeat_until(func, acc, cond):
         acc = func(acc)
     return acc
 
-import functools, operator as op
+import functools, operator as op, cmath
+
+def add(*ns):
+    if ns and isinstance(ns[0], str):
+        return "".join(ns) # copies the strings once, not once per argument
+    return functools.reduce(op.add, ns)
+
+def append(x, xs):
+    if isinstance(xs, lazy.LazySeq):
+        xs = xs.force()
+    return xs + [x]
+
 context_base_simple = {
     "t": True,
     "nil": False,
@@ -166,7 +463,7 @@ context_base_simple = {
     "<": (lambda x, y: x < y),
 
     # "+": (lambda *ns: sum(ns)),
-    "+": (lambda *ns: functools.reduce(op.add, ns)),
+    "+": add,
     "-": (lambda x,y: x-y),
     "*": (lambda *ns: functools.reduce(op.mul, ns)),
     "**": (lambda x,y: x**y),
@@ -175,16 +472,25 @@ context_base_simple = {
     "mod": (lambda x,y: x % y),
     "/": (lambda x,y: x / y),
 
-    "cons": lambda x,xs: [x] + xs,
+    "make-rectangular": complex,
+    "make-polar": cmath.rect,
+    "real-part": lambda z: z.real,
+    "imag-part": lambda z: z.imag,
+    "magnitude": abs,
+    "angle": lambda z: cmath.phase(z),
+    "conjugate": lambda z: z.conjugate(),
+    "complex?": lambda x: isinstance(x, complex),
+
+    "cons": rlist.cons,
     "head": lambda xs: Symbol("err-empty-list") if len(xs) == 0 else xs[0],
-    "tail": lambda xs: xs[1:],
-    "append": lambda x,xs: xs + [x],
+    "tail": rlist.tail,
+    "append": append,
     "nth": lambda l, n: l[n] if 0 <= n <= len(l) else Symbol("err-empty-list"),
-    "is-list?": lambda x: isinstance(x, list),
+    "is-list?": lambda x: isinstance(x, (list, RList)),
 
     "compose": lambda f1, f2: lambda x: f1 ( f2 (x)),
     
-    "map": lambda f,l: [f(x) for x in l],
+    "map": lambda f,l: lazy.lazy_map(f, l) if isinstance(l, lazy.LazySeq) else [f(x) for x in l],
     "fold": foldl,
     "repeat-until": repeat_until,
     
@@ -204,8 +510,17 @@ context_base_simple = {
     "append-to-file": append_to_file,
 
     "type?": get_type,
-    "atom?": lambda x: isinstance(x, (int, float, str, Symbol)) # TODO: str può essere stringa o simbolo!
+    "atom?": lambda x: isinstance(x, (int, float, complex, str, Symbol)) # TODO: str può essere stringa o simbolo!
 }
+context_base_simple.update(numarray.builtins)
+context_base_simple.update(parallel.builtins)
+context_base_simple.update(memo.builtins)
+context_base_simple.update(macro.builtins)
+context_base_simple.update(lazy.builtins)
+context_base_simple.update(hamt.builtins)
+context_base_simple.update(files.builtins)
+context_base_simple.update(strings.builtins)
+context_base_simple.update(native.builtins)
 
 context_base = Context(context_base_simple.keys(), context_base_simple.values())
 
@@ -218,23 +533,62 @@ def ast_to_str(ast: List) -> str:
     if not isinstance(ast, list):
         return str(ast)
 
-    return f"({ast[0]} " + " ".join(ast_to_str(x) for x in ast[1:]) + ")"
+    if len(ast) == 2 and ast[0] == "string":
+        return f'"{ast[1]}"'
+    if len(ast) == 2 and ast[0] == "quote":
+        return "'" + ast_to_str(ast[1])
+
+    return "(" + " ".join(ast_to_str(x) for x in ast) + ")"
 
 import logging
 
 logger = logging.getLogger("[EVAL]")
 
-def eval_free(ast: List, context: dict, debug=False):
-    while True:
-        # print(ast)
-        
-        if debug:
-            print(ast)
+def let_context(ast: List, context: dict) -> Context:
+    "The context of the body of the let `ast`, with its bindings."
+    # Per esempio, se ho
+    # 
+    #   (let foo (lambda (x) (if (= x 0) 0 (let-rec (- x 1)))))
+    # 
+    # Il primo passo è fare EVAL sulla lambda:
+    inner_ctx = Context([], [], context)
+
+    MULTI_LET = len(ast) == 3
+
+    if MULTI_LET:
+        for let_clause in ast[1]:
+
+            let_clause_body = named(eval_free(let_clause[1], inner_ctx), let_clause[0])
+
+            # Se il corpo del let-rec è effettivamente una procedura (e non
+            # ad es. un numero), essa potrebbe essere ricorsiva.
+            # Per cui, aggiungi nel contesto della procedura
+            # un binding a sé stessa, aka. aggiungi al contesto della procedura
+            # la coppia {foo : Procedure<foo, body=...,>}
+            if isinstance(let_clause_body, Procedure):
+                let_clause_body.ctx.add(let_clause[0], let_clause_body)
+
+            inner_ctx.add(let_clause[0], let_clause_body)
+
+    else:
+        let_clause_body = named(eval_free(ast[2], inner_ctx), ast[1])
+
+        if isinstance(let_clause_body, Procedure):
+            let_clause_body.ctx.add(ast[1], let_clause_body)
 
+        inner_ctx.add(ast[1], let_clause_body)
+
+    return inner_ctx
+
+def eval_free(ast: List, context: dict):
+    # Tracing and profiling hooks replace this function with
+    # lisp.hooks.eval_hooked while they are installed, so it pays nothing
+    # for them here.
+    while True:
         if isinstance(ast, Symbol):
             return context.find(ast)
 
-        if isinstance(ast, (int, float)): #TODO: ma era questo?
+        if isinstance(ast, Number): #TODO: ma era questo?
             return ast
 
         if isinstance(ast, str): #TODO: ma era questo?
@@ -253,7 +607,7 @@ def eval_free(ast: List, context: dict, debug=False):
                 return ast[1]
 
             elif ast[0] == "list":
-                return [eval_free(el, context, debug=debug) for el in ast[1:]]
+                return [eval_free(el, context) for el in ast[1:]]
             
             if ast[0] == "lambda":
                 if len(ast[1:]) == 3:
@@ -267,32 +621,33 @@ def eval_free(ast: List, context: dict, debug=False):
                 else:
                     raise LispError(f"lambda expects 2/3 arguments, were given {len(ast[1:])}")
 
-                return Procedure(variables, body, context, _help=_help, debug=debug)
+                return Procedure(variables, body, context, _help=_help,
+                                 location=getattr(ast, "location", None))
 
             if ast[0] == "define":
                 #funziona per non-ricorsive
-                context.outermost_add(ast[1], eval_free(ast[2], context, debug=debug)) 
+                context.outermost_add(ast[1], named(eval_free(ast[2], context), ast[1]))
                 return ast[1]
 
             if ast[0] == "cond":
                 for clause in ast[1:]:
-                    if eval_free(clause[0], context, debug=debug):
+                    if eval_free(clause[0], context):
                         ast = clause[1]
                         break
                 else:
-                    assert eval_free(ast[-1][0], context, debug=debug), f"{ast[-1][0]} should evaluate to T!"
+                    assert eval_free(ast[-1][0], context), f"{ast[-1][0]} should evaluate to T!"
                     print("WARNING")
                     return 
 
             elif ast[0] == "if":
-                if eval_free(ast[1], context, debug=debug):
+                if eval_free(ast[1], context):
                     ast = ast[2]
                 else:
                     ast = ast[3]
 
             elif ast[0] == "begin":
                 for x in ast[1:-1]:
-                    eval_free(x, context, debug=debug)
+                    eval_free(x, context)
                 ast = ast[-1]
 
             elif ast[0] == "curry":
@@ -300,7 +655,7 @@ def eval_free(ast: List, context: dict, debug=False):
                 
                 num_declared_args = len(ast) - 1
 
-                symbol_eval = eval_free(ast[0], context, debug=debug)
+                symbol_eval = eval_free(ast[0], context)
                 function_arity = deduce_arity(
                     symbol_eval
                 )
@@ -313,40 +668,10 @@ def eval_free(ast: List, context: dict, debug=False):
                 ]
 
                 
-            elif ast[0] == "let":   
-                # Per esempio, se ho
-                # 
-                #   (let foo (lambda (x) (if (= x 0) 0 (let-rec (- x 1)))))
-                # 
-                # Il primo passo è fare EVAL sulla lambda:
-                inner_ctx = Context([], [], context)
-
-                MULTI_LET = len(ast) == 3
-
-                if MULTI_LET:
-                    for let_clause in ast[1]:
-
-                        let_clause_body = eval_free(let_clause[1], inner_ctx, debug=debug)
-
-                        # Se il corpo del let-rec è effettivamente una procedura (e non
-                        # ad es. un numero), essa potrebbe essere ricorsiva.
-                        # Per cui, aggiungi nel contesto della procedura
-                        # un binding a sé stessa, aka. aggiungi al contesto della procedura
-                        # la coppia {foo : Procedure<foo, body=...,>}
-                        if isinstance(let_clause_body, Procedure):
-                            let_clause_body.ctx.add(let_clause[0], let_clause_body)
-
-                        inner_ctx.add(let_clause[0], let_clause_body)
-
-                else:
-                    let_clause_body = eval_free(ast[2], inner_ctx, debug=debug)
-
-                    if isinstance(let_clause_body, Procedure):
-                        let_clause_body.ctx.add(ast[1], let_clause_body)
-
-                    inner_ctx.add(ast[1], let_clause_body)
-
-                return eval_free(ast[2] if MULTI_LET else ast[3], inner_ctx, debug=debug)
+            elif ast[0] == "let":
+                # The body is in tail position
+                ast, context = ast[-1], let_context(ast, context)
+                continue
 
 
             elif ast[0] == "debug":
@@ -366,42 +691,48 @@ def eval_free(ast: List, context: dict, debug=False):
                     breakpoint()
                     print(i)
                     return "ok"
+                if ast[1] == "depth":
+                    return context.depth()
                 if ast[1] == "t":
-                    debug=True
+                    from lisp import hooks
+                    hooks.install(hooks.print_hook)
                     return "ok"
                 if ast[1] == "f":
-                    debug=False
+                    from lisp import hooks
+                    hooks.remove(hooks.print_hook)
                     return "ok"
 
             elif ast[0] == "eval":
-                # ast = eval_free(ast[1], context, debug=debug)
-                return eval_free(ast[1], context, debug=debug)
+                # ast = eval_free(ast[1], context)
+                return eval_free(ast[1], context)
                 
             elif ast[0] == "evalS":
                 if ast[1][0] == "string":
-                    # ast = eval_free(parse(ast[1][1]), context, debug=debug)
-                    return eval_free(parse(ast[1][1]), context, debug=debug)
+                    # ast = eval_free(parse(ast[1][1]), context)
+                    return eval_free(macro.expand_source(ast[1], ast[1][1], context, eval_free), context)
                 else:
-                    s = eval_free(ast[1], context, debug=debug)
+                    s = eval_free(ast[1], context)
                     ast = ["evalS", s]
                     
+            elif ast[0] == "profile":
+                from lisp import profiler
+                return profiler.profile_form(lambda: eval_free(ast[1], context))
+
             elif ast[0] == "print":
-                eval_body = eval_free(ast[1], context, debug=debug)
+                eval_body = eval_free(ast[1], context)
                 print(eval_body)
                 return eval_body
 
             else:
-                eval_exprs = [eval_free(piece, context, debug=debug) for piece in ast]
-                # if debug:
-                #     breakpoint()
+                eval_exprs = [eval_free(piece, context) for piece in ast]
                 eval_func  = eval_exprs[0]
 
-                if isinstance(eval_func, Procedure):
+                if type(eval_func) is Procedure:
+                    # Only the parameters get a new frame, linked to where
+                    # the procedure was defined: a tail call replaces the
+                    # caller's frame instead of growing a chain of them.
                     ast = eval_func.body
-                    context = Context(eval_func.parms, eval_exprs[1:],
-                                      Context(eval_func.ctx.keys(),
-                                              eval_func.ctx.values(),
-                                              context))
+                    context = Context(eval_func.parms, eval_exprs[1:], eval_func.ctx)
                 else:
                     return eval_func(*eval_exprs[1:])
 
@@ -409,36 +740,80 @@ def eval_free(ast: List, context: dict, debug=False):
             raise LispError("Unknwown type")
 
 
-def evalS(program, context=None, debug=False):
-    ast = parse(program)
-    if context is None:
-        return eval_free(ast, context_base, debug=debug)
-    return eval_free(ast, context, debug=debug)
+def evaluator(mode="tree", debug=False, opt_level=0):
+    """
+    The function evaluating an AST in a context for an evaluation mode:
+    "tree" walks the AST with `eval_free`, "closure" compiles it to
+    closures first (see lisp.closure), "vm" to bytecode run by the
+    virtual machine of lisp.vm. Either way macros are expanded
+    first (see lisp.macro), then the AST is optimized if `opt_level` is
+    above 0 (see lisp.optimizer). `debug` traces the tree walker (see
+    lisp.hooks).
+    """
+    from lisp import optimizer
+    if mode == "tree":
+        evaluate = lambda ast, ctx: eval_free(ast, ctx)
+        if debug:
+            from lisp import hooks
+            evaluate = hooks.with_hook(hooks.print_hook, evaluate)
+    elif mode == "closure":
+        from lisp.closure import eval_closure
+        evaluate = eval_closure
+    elif mode == "vm":
+        from lisp.vm import eval_vm
+        evaluate = eval_vm
+    else:
+        raise LispError(f"unknown evaluation mode {mode}")
 
+    return macro.expanding(optimizer.optimizing(evaluate, opt_level))
 
-def eval_program(program, ctx=None, what_to_print=Print.ALL, debug=False, returns="ctx"):
-    import copy
 
-    lines = extract_expressions(program)
-    ctx = copy.deepcopy(context_base) if ctx is None else ctx
+def evalS(program, context=None, debug=False, mode="tree", opt_level=0):
+    ast = parse(program)
+    if context is None:
+        context = context_base.fork()
+    return evaluator(mode, debug, opt_level)(ast, context)
+
 
-    partial_results = list()
-    for expr in lines:
-        result = eval_free(parse(expr), ctx, debug=debug)
+def eval_program(program, ctx=None, what_to_print=Print.ALL, debug=False, returns="ctx", mode="tree",
+                 profile=False, opt_level=0):
+    """
+    Evaluates, one at a time, the top-level expressions of `program`:
+    either its source text, a file path or an open text stream.
+    `profile` is True to print a profile of the program at the end, or a
+    lisp.profiler.Profiler to collect it in. `opt_level` is the level of
+    lisp.optimizer, 0 not to optimize.
+    """
+    ctx = context_base.fork() if ctx is None else ctx
+    evaluate = evaluator(mode, debug, opt_level)
+
+    if profile:
+        from lisp import hooks, profiler
+        profiler_ = profiler.Profiler() if profile is True else profile
+        expanded = macro.snapshot()
+        with hooks.installed(profiler_):
+            result = eval_program(program, ctx, what_to_print, debug, returns, mode,
+                                  opt_level=opt_level)
+        if profile is True:
+            print(profiler_.report())
+            print(macro.report(since=expanded))
+        return result
+
+    result = None
+    for expr in read_forms(program):
+        result = evaluate(expr, ctx)
 
         if what_to_print == Print.ALL:
-            print(expr)
+            print(ast_to_str(expr))
             print(" = " + str(result) + "\n")
 
-        partial_results.append(result)
-
     if returns == "ctx":
         return ctx
     
     if returns == "val":
         if what_to_print.value > 0:
-            print(partial_results[-1])
-        return partial_results[-1]
+            print(result)
+        return result
 
     raise LispError(f"`returns` parameter must be either ctx or val (given: {returns}")
 
@@ -446,21 +821,19 @@ def eval_program(program, ctx=None, what_to_print=Print.ALL, debug=False, return
 
 import readline
 
-def ev(program: str, what_to_print=Print.ALL, returns="ctx"):
-    user_library = open("lisp/stdlib.lisp", "r").read()
-    userctx = eval_program(user_library, what_to_print=what_to_print)
-    return eval_program(program, userctx, what_to_print=what_to_print, returns=returns)
+STDLIB_PATH = pathlib.Path(__file__).parent / "stdlib.lisp"
+
+def ev(program, what_to_print=Print.ALL, returns="ctx", mode="tree", profile=False, opt_level=0):
+    from lisp.cache import load_stdlib
+    userctx = load_stdlib(mode)
+    return eval_program(program, userctx, what_to_print=what_to_print, returns=returns, mode=mode,
+                        profile=profile, opt_level=opt_level)
     
 def repl(debug=False, fpath=None):
     import traceback
 
-    if fpath is not None:
-        with open(fpath, "r") as f:
-            readed = f.read()
-    else:
-        readed = ""
-        
-    userctx = ev(readed, what_to_print=Print.FINAL)
+    program = "" if fpath is None else pathlib.Path(fpath)
+    userctx = ev(program, what_to_print=Print.FINAL)
     while (inp := input("λ ")) != "q":
         try:
             eval_program(inp, userctx, what_to_print=Print.ALL, debug=debug)
@@ -469,8 +842,4 @@ def repl(debug=False, fpath=None):
             print(traceback.format_exc())
 
 
-def mcirc():
-    ev("(metacircular (list if-macro-checker for-macro-sub))")
-    
 # repl()
-# mcirc()
@@ -0,0 +1,136 @@
+"""
+Files and images.
+
+`(open path)` returns a file to write to, through a buffer (`'a` as
+second argument appends to it). `write` and `write-lines` add text to
+the buffer, which goes to the disk when it is full, on `flush` and on
+`close`; `(with-file path (lambda (f) ...))` closes the file once the
+procedure returns, or fails.
+
+    (with-file "squares.txt"
+      (lambda (f) (write-lines f (map square (seq 0 10)))))
+
+`(write-pgm path pixels width height maxval)` writes a grayscale image,
+binary PGM, and `write-ppm` a color one, binary PPM, with three values
+per pixel (red, green and blue). `pixels` is a list or an array of
+numbers from 0 to `maxval`, row after row; a list of rows works too.
+The samples are packed and written in one go, so writing an image
+costs next to nothing next to computing it.
+"""
+import array
+import itertools
+import sys
+
+from lisp.numarray import NumArray
+from lisp.rlist import RList
+from lisp.utils import lisp_error, text
+
+BUFFER_SIZE = 1 << 16 # bytes
+MODES = ("w", "a") # write, append
+
+
+class File():
+    __slots__ = ("file", "path")
+
+    def __init__(self, file, path):
+        self.file, self.path = file, path
+
+    def __repr__(self):
+        return f"<{'closed ' if self.file.closed else ''}file {self.path}>"
+
+
+def opened(f, caller):
+    "The Python file of `f`."
+    if not isinstance(f, File):
+        raise lisp_error(f"{caller} expects a file, got {f}")
+    if f.file.closed:
+        raise lisp_error(f"{caller}: {f} can't be written anymore")
+    return f.file
+
+
+def open_file(path, mode="w") -> File:
+    if mode not in MODES:
+        raise lisp_error(f"open: the mode is either w or a (given: {mode})")
+    return File(open(path, mode, buffering=BUFFER_SIZE), path)
+
+def write(f, x) -> int:
+    return opened(f, "write").write(text(x))
+
+def write_lines(f, lines) -> int:
+    "Writes every element of `lines` followed by a newline."
+    data = "".join(text(line) + "\n" for line in lines)
+    return opened(f, "write-lines").write(data)
+
+def flush(f):
+    opened(f, "flush").flush()
+    return f
+
+def close(f):
+    if not isinstance(f, File):
+        raise lisp_error(f"close expects a file, got {f}")
+    f.file.close()
+    return f
+
+def with_file(path, mode, proc=None):
+    "(with-file path proc) or (with-file path mode proc): `proc` of the open file."
+    if proc is None:
+        proc, mode = mode, "w"
+    f = open_file(path, mode)
+    try:
+        return proc(f)
+    finally:
+        f.file.close()
+
+#######################################
+
+def flat(pixels):
+    "The numbers of `pixels`, or of its rows one after the other."
+    if isinstance(pixels, NumArray):
+        return pixels.data
+    pixels = pixels if isinstance(pixels, (list, RList)) else list(pixels)
+    if len(pixels) > 0 and isinstance(pixels[0], (list, RList, NumArray)):
+        return list(itertools.chain.from_iterable(pixels))
+    return pixels
+
+def samples(pixels, count, maxval, caller) -> array.array:
+    "`pixels` packed as PNM samples, 1 byte each or 2 big-endian bytes."
+    if not isinstance(maxval, int) or not 0 < maxval < 65536:
+        raise lisp_error(f"{caller}: maxval must be an integer from 1 to 65535 (given: {maxval})")
+    values, typecode = flat(pixels), "B" if maxval < 256 else "H"
+    try:
+        try:
+            packed = array.array(typecode, values)
+        except TypeError: # floats, like counts summed on arrays of doubles
+            packed = array.array(typecode, map(int, values))
+    except (TypeError, ValueError, OverflowError):
+        raise lisp_error(f"{caller}: pixels must be integers from 0 to {maxval}") from None
+
+    if len(packed) != count:
+        raise lisp_error(f"{caller}: expected {count} samples, got {len(packed)}")
+    if count and max(packed) > maxval:
+        raise lisp_error(f"{caller}: pixels must be integers from 0 to {maxval}")
+    if typecode == "H" and sys.byteorder == "little":
+        packed.byteswap()
+    return packed
+
+def write_pnm(magic, channels, caller):
+    def write_image(path, pixels, width, height, maxval=255):
+        packed = samples(pixels, width * height * channels, maxval, caller)
+        with open(path, "wb") as f:
+            f.write(f"{magic}\n{width} {height}\n{maxval}\n".encode())
+            packed.tofile(f)
+        return path
+    return write_image
+
+
+builtins = {
+    "open": open_file,
+    "write": write,
+    "write-lines": write_lines,
+    "flush": flush,
+    "close": close,
+    "with-file": with_file,
+    "file?": lambda x: isinstance(x, File),
+    "write-pgm": write_pnm("P5", 1, "write-pgm"),
+    "write-ppm": write_pnm("P6", 3, "write-ppm"),
+}
@@ -0,0 +1,326 @@
+"""
+Persistent hash maps and sets.
+
+`HashMap` and `HashSet` are hash array mapped tries: a tree of nodes 32
+wide, each level indexed by the next 5 bits of the hash of a key. A
+node only stores the children it has, with a bitmap of which ones they
+are. `assoc` and `dissoc` don't change a map: they return a new one,
+copying just the nodes on the way to the key (at most 13 of them) and
+sharing all the others, so lookups and updates are O(1) in practice.
+
+Keys are compared like `=` compares them: the key of a list is the
+tuple of its elements (see `lisp_key` in lisp.memo), so `'(1 2)`,
+`(list 1 2)`, `(cons 1 '(2))` and `(array (list 1 2))` are the same key,
+and so are a symbol and the string with its name.
+
+    {k1 v1 k2 v2}   is read as (hash-map k1 v1 k2 v2)
+    #{x y}          is read as (hash-set x y)
+
+Walking a map (`fold`, `map`...) yields its entries as (key value)
+lists, in no particular order.
+"""
+from lisp.memo import lisp_key
+from lisp.utils import lisp_error
+
+BITS, MASK = 5, 31
+HASH_BITS = (1 << 64) - 1
+
+_missing = object()
+
+
+class Bitmap():
+    "A node: `slots` holds the children whose bit is set in `bitmap`."
+    __slots__ = ("bitmap", "slots")
+
+    def __init__(self, bitmap: int, slots: tuple):
+        self.bitmap, self.slots = bitmap, slots
+
+class Collision():
+    "Leaves of different keys with the same hash."
+    __slots__ = ("hash", "leaves")
+
+    def __init__(self, h: int, leaves: tuple):
+        self.hash, self.leaves = h, leaves
+
+# A leaf is a (hash, frozen key, key, value) tuple
+EMPTY = Bitmap(0, ())
+
+
+def key_hash(key):
+    "The hash and the frozen form of `key`."
+    frozen = lisp_key(key)
+    try:
+        return hash(frozen) & HASH_BITS, frozen
+    except TypeError:
+        raise lisp_error(f"{key} can't be the key of a map or an element of a set") from None
+
+
+def lookup(node, h, frozen):
+    "The leaf of the key, or None."
+    shift = 0
+    while True:
+        if type(node) is Collision:
+            for leaf in node.leaves:
+                if leaf[1] == frozen:
+                    return leaf
+            return None
+        bit = 1 << ((h >> shift) & MASK)
+        if not node.bitmap & bit:
+            return None
+        child = node.slots[(node.bitmap & (bit - 1)).bit_count()]
+        if type(child) is tuple:
+            return child if child[0] == h and child[1] == frozen else None
+        node, shift = child, shift + BITS
+
+
+def insert(node, leaf, shift=0):
+    "`node` with `leaf` in it, and whether its key is new."
+    h = leaf[0]
+    if type(node) is Collision:
+        if node.hash == h:
+            for i, other in enumerate(node.leaves):
+                if other[1] == leaf[1]:
+                    return Collision(h, node.leaves[:i] + (leaf,) + node.leaves[i+1:]), False
+            return Collision(h, node.leaves + (leaf,)), True
+        # Moves the collision one level down, under a new node
+        node = Bitmap(1 << ((node.hash >> shift) & MASK), (node,))
+
+    bit = 1 << ((h >> shift) & MASK)
+    i = (node.bitmap & (bit - 1)).bit_count()
+    if not node.bitmap & bit:
+        return Bitmap(node.bitmap | bit, node.slots[:i] + (leaf,) + node.slots[i:]), True
+
+    child = node.slots[i]
+    if type(child) is tuple:
+        if child[0] == h and child[1] == leaf[1]:
+            new, added = leaf, False
+        elif child[0] == h:
+            new, added = Collision(h, (child, leaf)), True
+        else:
+            new, added = insert(insert(EMPTY, child, shift + BITS)[0], leaf, shift + BITS)
+    else:
+        new, added = insert(child, leaf, shift + BITS)
+    return Bitmap(node.bitmap, node.slots[:i] + (new,) + node.slots[i+1:]), added
+
+
+def remove(node, h, frozen, shift=0):
+    "`node` without the key, None if it is left empty; `node` itself if the key isn't there."
+    if type(node) is Collision:
+        leaves = tuple(leaf for leaf in node.leaves if leaf[1] != frozen)
+        if len(leaves) == len(node.leaves):
+            return node
+        return leaves[0] if len(leaves) == 1 else Collision(h, leaves)
+
+    bit = 1 << ((h >> shift) & MASK)
+    if not node.bitmap & bit:
+        return node
+    i = (node.bitmap & (bit - 1)).bit_count()
+    child = node.slots[i]
+    if type(child) is tuple:
+        if child[0] != h or child[1] != frozen:
+            return node
+        new = None
+    else:
+        new = remove(child, h, frozen, shift + BITS)
+        if new is child:
+            return node
+
+    if new is None:
+        if node.bitmap == bit:
+            return None
+        return Bitmap(node.bitmap ^ bit, node.slots[:i] + node.slots[i+1:])
+    if type(new) is Bitmap and len(new.slots) == 1 and type(new.slots[0]) is tuple:
+        new = new.slots[0] # a node with a single leaf is just the leaf
+    return Bitmap(node.bitmap, node.slots[:i] + (new,) + node.slots[i+1:])
+
+
+def leaves(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        for child in (node.leaves if type(node) is Collision else node.slots):
+            if type(child) is tuple:
+                yield child
+            else:
+                stack.append(child)
+
+#######################################
+
+class HashMap():
+    __slots__ = ("root", "size")
+
+    def __init__(self, root=EMPTY, size=0):
+        self.root, self.size = root, size
+
+    @staticmethod
+    def of(items) -> "HashMap":
+        "A map of the (key, value) pairs in `items`; the last value of a key wins."
+        root, size = EMPTY, 0
+        for key, value in items:
+            h, frozen = key_hash(key)
+            root, added = insert(root, (h, frozen, key, value))
+            size += added
+        return HashMap(root, size)
+
+    def get(self, key, default=None):
+        leaf = lookup(self.root, *key_hash(key))
+        return default if leaf is None else leaf[3]
+
+    def __contains__(self, key):
+        return lookup(self.root, *key_hash(key)) is not None
+
+    def assoc(self, key, value) -> "HashMap":
+        h, frozen = key_hash(key)
+        root, added = insert(self.root, (h, frozen, key, value))
+        return HashMap(root, self.size + added)
+
+    def dissoc(self, key) -> "HashMap":
+        root = remove(self.root, *key_hash(key))
+        if root is self.root:
+            return self
+        return HashMap(EMPTY if root is None else root, self.size - 1)
+
+    def items(self):
+        for leaf in leaves(self.root):
+            yield leaf[2], leaf[3]
+
+    def keys(self):
+        return [leaf[2] for leaf in leaves(self.root)]
+
+    def values(self):
+        return [leaf[3] for leaf in leaves(self.root)]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for leaf in leaves(self.root):
+            yield [leaf[2], leaf[3]]
+
+    def __eq__(self, other):
+        if not isinstance(other, HashMap):
+            return NotImplemented
+        return self.size == other.size and all(
+            other.get(key, _missing) == value for key, value in self.items())
+
+    def __hash__(self):
+        return hash(frozenset((leaf[1], lisp_key(leaf[3])) for leaf in leaves(self.root)))
+
+    def __reduce__(self):
+        # Hashes of strings change from one process to another
+        return HashMap.of, (list(self.items()),)
+
+    def __repr__(self):
+        return "{" + ", ".join(f"{key!r}: {value!r}" for key, value in self.items()) + "}"
+
+
+class HashSet():
+    __slots__ = ("map",)
+
+    def __init__(self, map=HashMap()):
+        self.map = map
+
+    @staticmethod
+    def of(elements) -> "HashSet":
+        return HashSet(HashMap.of((x, True) for x in elements))
+
+    def __contains__(self, x):
+        return x in self.map
+
+    def get(self, x, default=None):
+        leaf = lookup(self.map.root, *key_hash(x))
+        return default if leaf is None else leaf[2]
+
+    def add(self, x) -> "HashSet":
+        return HashSet(self.map.assoc(x, True))
+
+    def discard(self, x) -> "HashSet":
+        return HashSet(self.map.dissoc(x))
+
+    def union(self, other: "HashSet") -> "HashSet":
+        big, small = (self, other) if len(self) >= len(other) else (other, self)
+        result = big.map
+        for x in small:
+            result = result.assoc(x, True)
+        return HashSet(result)
+
+    def intersection(self, other: "HashSet") -> "HashSet":
+        big, small = (self, other) if len(self) >= len(other) else (other, self)
+        return HashSet.of(x for x in small if x in big)
+
+    def difference(self, other: "HashSet") -> "HashSet":
+        return HashSet.of(x for x in self if x not in other)
+
+    def __len__(self):
+        return len(self.map)
+
+    def __iter__(self):
+        for leaf in leaves(self.map.root):
+            yield leaf[2]
+
+    def __eq__(self, other):
+        if not isinstance(other, HashSet):
+            return NotImplemented
+        return len(self) == len(other) and all(x in other for x in self)
+
+    def __hash__(self):
+        return hash(frozenset(leaf[1] for leaf in leaves(self.map.root)))
+
+    def __reduce__(self):
+        return HashSet.of, (list(self),)
+
+    def __repr__(self):
+        return "#{" + ", ".join(repr(x) for x in self) + "}"
+
+#######################################
+
+def hash_map(*kvs) -> HashMap:
+    if len(kvs) % 2:
+        raise lisp_error(f"hash-map expects keys and values, given {len(kvs)} arguments")
+    return HashMap.of(zip(kvs[::2], kvs[1::2]))
+
+def get(coll, key, default=False):
+    "The value of `key` in a map, or `key` itself in a set; nil or `default` if missing."
+    return collection(coll, "get").get(key, default)
+
+def assoc(m, *kvs) -> HashMap:
+    collection(m, "assoc", HashMap)
+    if len(kvs) % 2:
+        raise lisp_error(f"assoc expects keys and values, given {len(kvs)} arguments")
+    for key, value in zip(kvs[::2], kvs[1::2]):
+        m = m.assoc(key, value)
+    return m
+
+def dissoc(coll, *keys):
+    collection(coll, "dissoc")
+    for key in keys:
+        coll = coll.dissoc(key) if isinstance(coll, HashMap) else coll.discard(key)
+    return coll
+
+def collection(x, caller, types=(HashMap, HashSet)):
+    if not isinstance(x, types):
+        expected = {HashMap: "hash map", HashSet: "hash set"}.get(types, "hash map or set")
+        raise lisp_error(f"{caller} expects a {expected}, got {x}")
+    return x
+
+def set_operation(name):
+    def operation(a, b):
+        return getattr(collection(a, name, HashSet), name)(collection(b, name, HashSet))
+    return operation
+
+
+builtins = {
+    "hash-map": hash_map,
+    "hash-set": lambda *xs: HashSet.of(xs),
+    "get": get,
+    "assoc": assoc,
+    "dissoc": dissoc,
+    "contains?": lambda coll, key: key in collection(coll, "contains?"),
+    "keys": lambda m: collection(m, "keys", HashMap).keys(),
+    "vals": lambda m: collection(m, "vals", HashMap).values(),
+    "union": set_operation("union"),
+    "intersection": set_operation("intersection"),
+    "difference": set_operation("difference"),
+    "hash-map?": lambda x: isinstance(x, HashMap),
+    "hash-set?": lambda x: isinstance(x, HashSet),
+}
@@ -0,0 +1,405 @@
+"""
+Evaluator hooks.
+
+A hook is told what the tree walker is doing through these events:
+
+    enter(ast, func, args, depth)  the call `ast` is calling `func`
+    exit(ast, func, value, depth)  ...which returned `value`
+    special_form(ast, depth)       the special form `ast` is evaluated
+    error(ast, exc, depth)         evaluating `ast` raised `exc`
+
+`depth` counts the calls in progress outside the current one. A tail
+call first exits from its caller, with TAIL_CALL as the value; when an
+exception goes through a call, the call exits with RAISED as the value.
+`error` is only sent for the innermost expression raising.
+
+Hooks are installed for the running thread only: the calls evaluated
+by other threads, like the sessions of lisp.server, don't reach them.
+While a thread has a hook installed, `lisp.compiler.eval_free` is
+replaced with `eval_hooked`, which sends the events to the hooks of the
+thread evaluating, if it has any; so are `Procedure.__call__`, used by
+builtins like `map` to call procedures, and the `call` trampoline of
+lisp.closure. Once no thread has hooks the plain functions are back,
+and so evaluating doesn't pay for hooks unless there are some. In code
+compiled to closures hooks only see procedure calls: no builtins nor
+special forms. Procedures called outside of a call expression get a
+call AST made of just their name.
+
+`Sampler` is the exception: it takes samples of the Lisp stack from
+another thread, without hooking the evaluator at all.
+"""
+import collections
+import contextlib
+import json
+import sys
+import threading
+import time
+
+from lisp import compiler
+from lisp.compiler import Context, Procedure, ast_to_str
+
+TAIL_CALL = compiler.Symbol("tail-call")
+RAISED = compiler.Symbol("raised")
+
+SPECIAL_FORMS = frozenset(("quote", "string", "list", "lambda", "define", "cond", "if",
+                           "begin", "curry", "let", "debug", "profile", "eval", "evalS",
+                           "print"))
+
+# The functions without hooks
+_walk = compiler.eval_free
+_procedure_call = Procedure.__call__
+_compiled_call = None
+
+
+class State(threading.local):
+    "The hooks installed by a thread, and the depth of its calls."
+    def __init__(self):
+        self.installed, self.hook, self.depth = [], None, 0
+
+_state = State()
+_lock = threading.Lock()
+_hooked_threads = 0
+
+
+class Hook():
+    "A hook doing nothing: subclasses override the events they want."
+    def enter(self, ast, func, args, depth): pass
+    def exit(self, ast, func, value, depth): pass
+    def special_form(self, ast, depth): pass
+    def error(self, ast, exc, depth): pass
+
+
+class Hooks(Hook):
+    "Sends the events to several hooks."
+    def __init__(self, hooks):
+        self.hooks = list(hooks)
+    def enter(self, *event):
+        for hook in self.hooks: hook.enter(*event)
+    def exit(self, *event):
+        for hook in self.hooks: hook.exit(*event)
+    def special_form(self, *event):
+        for hook in self.hooks: hook.special_form(*event)
+    def error(self, *event):
+        for hook in self.hooks: hook.error(*event)
+
+
+def install(hook: Hook):
+    "Installs `hook` for the calls evaluated by the running thread."
+    global _hooked_threads
+    state = _state
+    if not state.installed:
+        with _lock:
+            _hooked_threads += 1
+            compiler.eval_free = eval_hooked
+            Procedure.__call__ = call_hooked
+            closure().call = call_compiled_hooked
+    if hook not in state.installed:
+        state.installed.append(hook)
+    state.hook = state.installed[0] if len(state.installed) == 1 else Hooks(state.installed)
+
+def remove(hook: Hook):
+    global _hooked_threads
+    state = _state
+    if hook not in state.installed:
+        return
+    state.installed.remove(hook)
+    if state.installed:
+        state.hook = state.installed[0] if len(state.installed) == 1 else Hooks(state.installed)
+        return
+    state.hook = None
+    with _lock:
+        _hooked_threads -= 1
+        if not _hooked_threads:
+            compiler.eval_free = _walk
+            Procedure.__call__ = _procedure_call
+            closure().call = _compiled_call
+
+@contextlib.contextmanager
+def installed(hook: Hook):
+    install(hook)
+    try:
+        yield hook
+    finally:
+        remove(hook)
+
+def with_hook(hook: Hook, evaluate):
+    "`evaluate`, running with `hook` installed."
+    def evaluate_hooked(ast, ctx):
+        with installed(hook):
+            return evaluate(ast, ctx)
+    return evaluate_hooked
+
+
+def closure():
+    global _compiled_call
+    from lisp import closure
+    if _compiled_call is None:
+        _compiled_call = closure.call
+    return closure
+
+
+def eval_hooked(ast, context):
+    "`eval_free`, sending the events to the hooks of the running thread."
+    state = _state
+    hook, depth = state.hook, state.depth
+    if hook is None:
+        return _walk(ast, context)
+    call = None # the call running in this frame, if any
+
+    try:
+        while True:
+            if not isinstance(ast, list) or len(ast) == 0:
+                value = _walk(ast, context)
+                break
+
+            if isinstance(ast[0], str) and ast[0] in SPECIAL_FORMS:
+                hook.special_form(ast, state.depth)
+
+                # The forms evaluating their last expression in tail
+                # position: their calls are seen by the loop below.
+                if ast[0] == "if":
+                    ast = ast[2] if compiler.eval_free(ast[1], context) else ast[3]
+                    continue
+                if ast[0] == "let":
+                    ast, context = ast[-1], compiler.let_context(ast, context)
+                    continue
+                if ast[0] == "begin":
+                    for x in ast[1:-1]:
+                        compiler.eval_free(x, context)
+                    ast = ast[-1]
+                    continue
+                if ast[0] == "cond":
+                    for clause in ast[1:]:
+                        if compiler.eval_free(clause[0], context):
+                            ast = clause[1]
+                            break
+                    else:
+                        raise AssertionError(f"{ast[-1][0]} should evaluate to T!")
+                    continue
+
+                value = _walk(ast, context)
+                break
+
+            eval_exprs = [compiler.eval_free(piece, context) for piece in ast]
+            func, args = eval_exprs[0], eval_exprs[1:]
+            if call is None:
+                state.depth += 1
+            else:
+                hook.exit(call[0], call[1], TAIL_CALL, depth)
+            call = (ast, func)
+            hook.enter(ast, func, args, depth)
+
+            if type(func) is Procedure:
+                ast, context = func.body, Context(func.parms, args, func.ctx)
+                continue
+            value = func(*args)
+            break
+
+    except Exception as e:
+        if not getattr(e, "_lisp_hooked", False):
+            e._lisp_hooked = True
+            hook.error(ast, e, state.depth)
+        if call is not None:
+            hook.exit(call[0], call[1], RAISED, depth)
+        raise
+
+    finally:
+        if call is not None:
+            state.depth = depth
+
+    if call is not None:
+        hook.exit(call[0], call[1], value, depth)
+    return value
+
+
+def call_ast(proc) -> list:
+    return [compiler.Symbol(proc.name or "lambda")]
+
+def call_hooked(proc, *args):
+    "`Procedure.__call__`, sending the events to the hooks of the running thread."
+    state = _state
+    hook, depth = state.hook, state.depth
+    if hook is None:
+        return _procedure_call(proc, *args)
+    ast = call_ast(proc)
+    state.depth += 1
+    hook.enter(ast, proc, args, depth)
+    try:
+        value = compiler.eval_free(proc.body, Context(proc.parms, args, outer=proc.ctx))
+    except Exception:
+        hook.exit(ast, proc, RAISED, depth)
+        raise
+    finally:
+        state.depth = depth
+    hook.exit(ast, proc, value, depth)
+    return value
+
+def call_compiled_hooked(func, args):
+    "`lisp.closure.call`, sending the events to the hooks of the running thread."
+    from lisp.closure import CompiledProcedure, TailCall, run_body
+    state = _state
+    if state.hook is None:
+        return _compiled_call(func, args)
+    if type(func) is not CompiledProcedure:
+        return func(*args)
+
+    hook, depth, ast = state.hook, state.depth, None
+    state.depth += 1
+    try:
+        while True:
+            if ast is not None:
+                hook.exit(ast, proc, TAIL_CALL, depth)
+            proc, ast = func, call_ast(func)
+            hook.enter(ast, proc, args, depth)
+            value = run_body(func, args)
+            if type(value) is not TailCall:
+                break
+            func, args = value.func, value.args
+            if type(func) is not CompiledProcedure:
+                hook.exit(ast, proc, TAIL_CALL, depth)
+                ast, value = None, func(*args)
+                break
+    except Exception:
+        if ast is not None:
+            hook.exit(ast, proc, RAISED, depth)
+        raise
+    finally:
+        state.depth = depth
+
+    if ast is not None:
+        hook.exit(ast, proc, value, depth)
+    return value
+
+#######################################
+
+def short(ast, width=60) -> str:
+    "The source of `ast`, cut to `width` characters."
+    text = ast_to_str(ast)
+    return text if len(text) <= width else text[:width - 3] + "..."
+
+
+class PrintHook(Hook):
+    "Prints calls and special forms, indented by depth."
+    def __init__(self, file=None, width=60):
+        self.file, self.width = file, width
+
+    def enter(self, ast, func, args, depth):
+        call = short([ast[0], *args], self.width)
+        print("  " * depth + "-> " + call, file=self.file or sys.stdout)
+
+    def exit(self, ast, func, value, depth):
+        if value is not TAIL_CALL:
+            print("  " * depth + "<- " + short(value, self.width), file=self.file or sys.stdout)
+
+    def special_form(self, ast, depth):
+        print("  " * depth + short(ast, self.width), file=self.file or sys.stdout)
+
+    def error(self, ast, exc, depth):
+        print("  " * depth + f"!! {exc!r} in {short(ast, self.width)}", file=self.file or sys.stdout)
+
+print_hook = PrintHook() # the one of (debug t)
+
+
+class JSONTraceHook(Hook):
+    """
+    Writes one JSON object per event to `file`, with the event, the
+    depth, the seconds since the hook was made, and the expression.
+    Special forms are left out unless `special_forms`.
+    """
+    def __init__(self, file, special_forms=False, width=80):
+        self.file, self.width = file, width
+        self.start = time.perf_counter()
+        if not special_forms:
+            self.special_form = lambda ast, depth: None
+
+    def write(self, event, depth, **fields):
+        record = {"event": event, "depth": depth,
+                  "t": round(time.perf_counter() - self.start, 9), **fields}
+        self.file.write(json.dumps(record) + "\n")
+
+    def enter(self, ast, func, args, depth):
+        self.write("enter", depth, call=short(ast, self.width),
+                   args=[short(x, self.width) for x in args])
+
+    def exit(self, ast, func, value, depth):
+        value = value if value is TAIL_CALL or value is RAISED else short(value, self.width)
+        self.write("exit", depth, call=short(ast, self.width), value=value)
+
+    def special_form(self, ast, depth):
+        self.write("special-form", depth, form=ast[0], ast=short(ast, self.width))
+
+    def error(self, ast, exc, depth):
+        self.write("error", depth, ast=short(ast, self.width), error=repr(exc))
+
+#######################################
+
+class Sampler():
+    """
+    Takes a sample of the Lisp stack of `thread` every `interval`
+    seconds, from a thread of its own, while running as a context
+    manager (or between `start` and `stop`). The evaluator is left as it
+    is, so a program runs at full speed while it is sampled.
+
+    A stack is the list of the expressions the tree walker is evaluating,
+    outermost first, or of the procedures called by compiled code.
+    """
+    def __init__(self, interval=0.001, thread: threading.Thread = None, width=40):
+        self.interval, self.width = interval, width
+        self.thread_id = (thread or threading.current_thread()).ident
+        self.samples = collections.Counter() # stack -> number of samples
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stack(self, frame) -> tuple:
+        from lisp import closure
+        walkers = (_walk.__code__, eval_hooked.__code__)
+        stack = []
+        while frame is not None:
+            if frame.f_code in walkers:
+                stack.append(short(frame.f_locals.get("ast"), self.width))
+            elif frame.f_code is closure.call.__code__:
+                func = frame.f_locals.get("func")
+                stack.append(short(["lambda", func.parms, func.body], self.width)
+                             if hasattr(func, "body") else repr(func))
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = self.stack(frame)
+        if stack:
+            self.samples[stack] += 1
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def write_collapsed(self, file):
+        "The samples as collapsed stacks, the input of flamegraph.pl."
+        for stack, count in self.samples.most_common():
+            file.write(";".join(s.replace(";", ",") for s in stack) + f" {count}\n")
+
+    def report(self, n=10) -> str:
+        "The expressions found most often in the samples."
+        innermost = collections.Counter()
+        for stack, count in self.samples.items():
+            innermost[stack[-1]] += count
+        total = sum(self.samples.values()) or 1
+        return "\n".join(f"{100 * count / total:5.1f}%  {expr}"
+                         for expr, count in innermost.most_common(n))
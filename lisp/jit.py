@@ -0,0 +1,352 @@
+"""
+Tiered JIT.
+
+With `THRESHOLD` set, the body of every lambda compiled to closures (see
+lisp.closure) counts its calls, all the procedures made by that lambda
+together. At the THRESHOLD-th call the body is translated to the source
+of a Python function and compiled with `exec`, and from then on the
+calls run that function instead:
+
+    parameters and let-bound names   Python local variables
+    a tail call of the procedure     another turn of a `while` loop
+    itself (or of its lambda)
+    arithmetic and comparisons       Python operators
+    other builtins                   called directly, without a lookup
+
+A body using a form the translation doesn't know (`lambda`, `define`,
+`curry`, `debug`, `evalS`, `profile`) keeps running as closures. Like in
+lisp.optimizer, the builtins a translated body refers to are guarded:
+defining them again raises a LispError.
+
+    from lisp import jit
+    jit.THRESHOLD = 100
+"""
+import collections
+import re
+
+from lisp import closure, compiler
+from lisp.compiler import LispError, LispSymbolError, Symbol, context_base_simple, named
+
+# Calls of a lambda before it is compiled to Python; None turns the tier off
+THRESHOLD = None
+
+stats = collections.Counter() # compiled, unsupported
+
+# Builtins translated to Python operators: name -> (number of arguments,
+# operator), any number from one on when None
+OPERATORS = {
+    "=": (2, "=="), "!=": (2, "!="), ">=": (2, ">="), ">": (2, ">"), "<=": (2, "<="), "<": (2, "<"),
+    "+": (None, "+"), "*": (None, "*"),
+    "-": (2, "-"), "**": (2, "**"), "mod": (2, "%"), "/": (2, "/"),
+}
+UNARY = {"not": "(not {})", "++": "({} + 1)", "*2": "({} * 2)"}
+
+# Special forms with a translation; the others leave the body to closures
+FORMS = frozenset(("quote", "string", "list", "if", "cond", "begin", "let", "eval", "print"))
+
+
+class Unsupported(Exception):
+    "The body uses something the translation doesn't know."
+
+
+def _fail(exc_type, message):
+    raise exc_type(message)
+
+def _print(value):
+    print(value)
+    return value
+
+
+class Translator():
+    """
+    Translates the body of a lambda with parameters `parms` and scope
+    `scope` (see lisp.closure.Scope), whose globals are in `genv`.
+    """
+    def __init__(self, parms, body, scope, genv):
+        self.parms, self.body, self.scope, self.genv = list(parms), body, scope, genv
+        self.lines = []
+        self.values = {"_closure": closure, "_CompiledProcedure": closure.CompiledProcedure,
+                       "_TailCall": closure.TailCall, "_fail": _fail, "_print": _print,
+                       "_named": named, "_LispError": LispError, "_AssertionError": AssertionError,
+                       "_lookup": global_lookup(genv)}
+        self.builtins = set() # the names guarded once the translation is used
+        self.loops = False    # the body calls itself in tail position
+        self.count = 0
+
+    def translate(self, entry) -> str:
+        "The source of a factory making the Python function; `entry` is the tiered code."
+        self.values["_entry"] = entry
+        env = {name: self.local(name) for name in self.parms}
+        self.tail(self.body, env, 2)
+        body = self.lines
+        if not self.loops:
+            body = [line[4:] for line in body]
+        head = ["def jitted(frame):", "    outer = frame.outer"]
+        if self.parms:
+            head.append(f"    {', '.join(env[name] for name in self.parms)}, = frame.slots")
+        if self.loops:
+            head.append("    while True:")
+        names = ", ".join(sorted(self.values))
+        return "\n".join([f"def factory({names}):"]
+                         + ["    " + line for line in head + body] + ["    return jitted"])
+
+    def local(self, name) -> str:
+        self.count += 1
+        return f"v{self.count}_{re.sub(r'[^0-9a-zA-Z_]', '_', name)}"
+
+    def value(self, value) -> str:
+        "A name for `value` in the factory."
+        self.count += 1
+        name = f"_k{self.count}"
+        self.values[name] = value
+        return name
+
+    def emit(self, line, indent):
+        self.lines.append("    " * indent + line)
+
+    #######################################
+
+    def builtin(self, name, env):
+        "The builtin `name` stands for, or None."
+        if not isinstance(name, Symbol) or name in env or name not in context_base_simple:
+            return None
+        if self.scope.resolve(name) is not None:
+            return None
+        try:
+            value = self.genv.find(name)
+        except LispSymbolError:
+            return None
+        return name if value is context_base_simple[name] else None
+
+    def special(self, ast) -> bool:
+        head = ast[0]
+        if not (isinstance(head, str) and head in closure.SPECIAL_FORMS):
+            return False
+        if head not in FORMS:
+            raise Unsupported(head)
+        return True
+
+    def expr(self, ast, env) -> str:
+        "A Python expression with the value of `ast`."
+        if isinstance(ast, Symbol):
+            return self.symbol(ast, env)
+        if isinstance(ast, bool) or (type(ast) in (int, float) and ast == ast and abs(ast) != float("inf")):
+            return f"({ast!r})"
+        if isinstance(ast, (*compiler.Number, str)):
+            return self.value(ast)
+        if not isinstance(ast, list):
+            raise Unsupported(type(ast).__name__)
+        if len(ast) == 0:
+            return "[]"
+
+        head = ast[0]
+        if self.special(ast):
+            if head in ("quote", "string"):
+                return self.value(ast[1])
+            if head == "list":
+                return f"[{', '.join(self.expr(x, env) for x in ast[1:])}]"
+            if head == "eval":
+                return self.expr(ast[1], env)
+            if head == "print":
+                return f"_print({self.expr(ast[1], env)})"
+            if head == "if":
+                test, then = self.expr(ast[1], env), self.expr(ast[2], env)
+                other = (self.expr(ast[3], env) if len(ast) > 3 else
+                         f"_fail(_LispError, {self.value(f'missing else branch in {compiler.ast_to_str(ast)}')})")
+                return f"({then} if {test} else {other})"
+            if head == "cond":
+                result = self.cond_failure(ast)
+                for clause in reversed(ast[1:]):
+                    result = f"({self.expr(clause[1], env)} if {self.expr(clause[0], env)} else {result})"
+                return result
+            if head == "begin":
+                if len(ast) < 2:
+                    raise LispError("begin expects at least one expression")
+                return f"({', '.join(self.expr(x, env) for x in ast[1:])},)[-1]"
+            if head == "let":
+                assignments, env = self.let_bindings(ast, env)
+                body = self.expr(ast[-1], env)
+                return f"({', '.join(f'({name} := {value})' for name, value in assignments)}, {body})[-1]"
+
+        return self.call(ast, env)
+
+    def symbol(self, name, env) -> str:
+        if name in env:
+            return env[name]
+        where = self.scope.resolve(name)
+        if where is not None: # a local of the procedure's environment
+            return "outer" + ".outer" * (where[0] - 1) + f".slots[{where[1]}]"
+        builtin = self.builtin(name, env)
+        if builtin is not None:
+            self.builtins.add(builtin)
+            if name in ("t", "nil"):
+                return repr(context_base_simple[name])
+            return self.value(context_base_simple[name])
+        return f"_lookup({str(name)!r})"
+
+    def call(self, ast, env) -> str:
+        head, args = ast[0], [self.expr(x, env) for x in ast[1:]]
+        builtin = self.builtin(head, env)
+        if builtin is not None:
+            self.builtins.add(builtin)
+            if builtin in OPERATORS:
+                arity, operator = OPERATORS[builtin]
+                if len(args) == arity or (arity is None and len(args) > 0):
+                    return "(" + f" {operator} ".join(args) + ")"
+            elif builtin in UNARY and len(args) == 1:
+                return UNARY[builtin].format(args[0])
+            return f"{self.value(context_base_simple[builtin])}({', '.join(args)})"
+        return f"_closure.call({self.expr(head, env)}, ({''.join(a + ', ' for a in args)}))"
+
+    def let_bindings(self, ast, env):
+        "The (local, Python expression) pairs a `let` assigns, and the names in its body."
+        if len(ast) == 3:
+            bindings = [(clause[0], clause[1]) for clause in ast[1]]
+        else:
+            bindings = [(ast[1], ast[2])]
+        assignments = []
+        for name, value in bindings:
+            # A clause only sees the names bound before it
+            python = self.expr(value, env)
+            if not self.is_plain(value, env):
+                python = f"_named({python}, {self.value(name)})"
+            env = dict(env, **{name: self.local(name)})
+            assignments.append((env[name], python))
+        return assignments, env
+
+    def is_plain(self, ast, env) -> bool:
+        "True if `ast` can't evaluate to a procedure needing a name."
+        if not isinstance(ast, list):
+            return not isinstance(ast, Symbol)
+        return (len(ast) == 0 or ast[0] in ("quote", "string", "list")
+                or self.builtin(ast[0], env) in (*OPERATORS, *UNARY))
+
+    def cond_failure(self, ast) -> str:
+        message = f"{compiler.ast_to_str(ast[-1][0])} should evaluate to T!"
+        return f"_fail(_AssertionError, {self.value(message)})"
+
+    #######################################
+
+    def tail(self, ast, env, indent):
+        "Statements returning the value of `ast`."
+        if not isinstance(ast, list) or len(ast) == 0:
+            self.emit(f"return {self.expr(ast, env)}", indent)
+            return
+
+        head = ast[0]
+        if self.special(ast):
+            if head == "if":
+                self.emit(f"if {self.expr(ast[1], env)}:", indent)
+                self.tail(ast[2], env, indent + 1)
+                self.emit("else:", indent)
+                if len(ast) > 3:
+                    self.tail(ast[3], env, indent + 1)
+                else:
+                    message = self.value(f"missing else branch in {compiler.ast_to_str(ast)}")
+                    self.emit(f"_fail(_LispError, {message})", indent + 1)
+                return
+            if head == "cond":
+                for i, clause in enumerate(ast[1:]):
+                    self.emit(f"{'if' if i == 0 else 'elif'} {self.expr(clause[0], env)}:", indent)
+                    self.tail(clause[1], env, indent + 1)
+                self.emit(self.cond_failure(ast), indent)
+                return
+            if head == "begin":
+                if len(ast) < 2:
+                    raise LispError("begin expects at least one expression")
+                for x in ast[1:-1]:
+                    self.emit(self.expr(x, env), indent)
+                self.tail(ast[-1], env, indent)
+                return
+            if head == "let":
+                assignments, env = self.let_bindings(ast, env)
+                for name, value in assignments:
+                    self.emit(f"{name} = {value}", indent)
+                self.tail(ast[-1], env, indent)
+                return
+            if head == "eval":
+                self.tail(ast[1], env, indent)
+                return
+            self.emit(f"return {self.expr(ast, env)}", indent)
+            return
+
+        if self.builtin(head, env) is not None:
+            self.emit(f"return {self.call(ast, env)}", indent)
+            return
+
+        # A call of another procedure goes back to the trampoline; a call
+        # of this same body loops with the new arguments
+        self.emit(f"f = {self.expr(head, env)}", indent)
+        args = [self.expr(x, env) for x in ast[1:]]
+        if len(args) != len(self.parms):
+            self.emit(f"return _TailCall(f, [{', '.join(args)}])", indent)
+            return
+        temps = [f"a{i}" for i in range(len(args))]
+        for temp, arg in zip(temps, args):
+            self.emit(f"{temp} = {arg}", indent)
+        self.emit("if type(f) is _CompiledProcedure and f.code is _entry:", indent)
+        if args:
+            self.emit(f"{', '.join(env[name] for name in self.parms)}, = {', '.join(temps)},", indent + 1)
+        self.emit("outer = f.ctx", indent + 1)
+        self.emit("continue", indent + 1)
+        self.emit(f"return _TailCall(f, [{', '.join(temps)}])", indent)
+        self.loops = True
+
+
+def global_lookup(genv):
+    def lookup(name):
+        try:
+            return genv[name]
+        except KeyError:
+            return genv.find(name)
+    return lookup
+
+
+def translate(parms, body, scope, genv, entry):
+    "The Python function running the body `body`, or None if it can't be translated."
+    if len(set(parms)) != len(parms):
+        stats["unsupported"] += 1
+        return None
+    translator = Translator(parms, body, scope, genv)
+    try:
+        source = translator.translate(entry)
+        namespace = dict()
+        exec(compile(source, "<jit>", "exec"), namespace)
+    except (Unsupported, LispError, SyntaxError, RecursionError):
+        stats["unsupported"] += 1
+        return None
+    jitted = namespace["factory"](**translator.values)
+    jitted.source = source
+
+    genv = closure.outermost_context(genv)
+    for name in translator.builtins:
+        if type(genv.guarded) is frozenset:
+            genv.guarded = set()
+        genv.guarded.add(name)
+    stats["compiled"] += 1
+    return jitted
+
+
+def tiered(code, parms, body, scope, genv):
+    """
+    `code`, the closure compiled from a procedure body, counting its
+    calls: at the THRESHOLD-th it is replaced by the translation to
+    Python, if there is one.
+    """
+    calls, threshold = 0, THRESHOLD
+
+    def entry(frame):
+        nonlocal calls, code
+        calls += 1
+        if calls == threshold:
+            entry.jitted = translate(parms, body, scope, genv, entry)
+            code = entry.jitted or code
+        return code(frame)
+    entry.jitted = None
+    return entry
+
+
+def source(proc):
+    "The Python source the body of `proc` was translated to, or None."
+    jitted = getattr(getattr(proc, "code", None), "jitted", None)
+    return None if jitted is None else jitted.source
@@ -0,0 +1,112 @@
+"""
+Lazy sequences.
+
+A `LazySeq` is a source (a Python range, a list, or `iterate`) and the
+stages its elements go through: `lazy-map`, `lazy-filter`, `take` and
+`take-while`. Adding a stage to a LazySeq doesn't compute anything, it
+returns a new LazySeq with one more stage on the same source. Walking
+it chains the stages as Python iterators, so the elements go through
+all of them one at a time, and no list is built in between:
+
+    (fold + 0 (map square (lazy-filter even? (range 0 1000000))))
+
+runs in constant memory. `fold`, `map`, `sum`... take a LazySeq like
+any list, and `map` keeps it lazy. Indexing it (`head`, `nth`, `tail`),
+printing it or asking its length forces it: its elements are computed
+and kept, once. A sequence without end, made by `iterate`, must go
+through `take` or `take-while` before being forced.
+"""
+import itertools
+
+from lisp.rlist import RList
+
+
+class Iterate():
+    "x, f(x), f(f(x))..."
+    __slots__ = ("func", "start")
+
+    def __init__(self, func, start):
+        self.func, self.start = func, start
+
+    def __iter__(self):
+        func, x = self.func, self.start
+        while True:
+            yield x
+            x = func(x)
+
+
+STAGES = {
+    "map": map,
+    "filter": filter,
+    "take": lambda n, it: itertools.islice(it, n),
+    "take-while": itertools.takewhile,
+}
+
+
+class LazySeq():
+    __slots__ = ("source", "stages", "items")
+
+    def __init__(self, source, stages=()):
+        self.source, self.stages = source, stages
+        self.items = None # the elements, once forced
+
+    def then(self, kind, arg) -> "LazySeq":
+        "This sequence with one more stage."
+        if self.items is not None:
+            return LazySeq(self.items, ((kind, arg),))
+        if kind == "take" and self.stages and self.stages[-1][0] == "take":
+            # Two takes in a row are the shortest of them
+            return LazySeq(self.source, self.stages[:-1] + (("take", min(arg, self.stages[-1][1])),))
+        return LazySeq(self.source, self.stages + ((kind, arg),))
+
+    def __iter__(self):
+        if self.items is not None:
+            return iter(self.items)
+        it = iter(self.source)
+        for kind, arg in self.stages:
+            it = STAGES[kind](arg, it)
+        return it
+
+    def force(self) -> list:
+        if self.items is None:
+            self.items = list(iter(self)) # list(self) would ask our length
+        return self.items
+
+    def __len__(self):
+        return len(self.force())
+
+    def __getitem__(self, i):
+        return self.force()[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, RList, LazySeq)):
+            return NotImplemented
+        # Stops at the first difference, even if one side has no end
+        missing = object()
+        return all(a == b for a, b in itertools.zip_longest(self, other, fillvalue=missing))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.force())
+
+
+def sequence(xs) -> LazySeq:
+    "`xs` as a LazySeq, adding stages to it if it already is one."
+    return xs if isinstance(xs, LazySeq) else LazySeq(xs)
+
+
+def lazy_map(func, xs):
+    return sequence(xs).then("map", func)
+
+
+builtins = {
+    "range": lambda start, end, step=1: LazySeq(range(start, end, step)),
+    "lazy-map": lazy_map,
+    "lazy-filter": lambda pred, xs: sequence(xs).then("filter", pred),
+    "take": lambda n, xs: sequence(xs).then("take", n),
+    "take-while": lambda pred, xs: sequence(xs).then("take-while", pred),
+    "iterate": lambda func, x: LazySeq(Iterate(func, x)),
+    "force": lambda xs: xs.force() if isinstance(xs, LazySeq) else list(xs),
+    "lazy?": lambda x: isinstance(x, LazySeq),
+}
@@ -0,0 +1,206 @@
+"""
+Macros.
+
+    (defmacro for (var in l do body)
+      (list 'map (list 'lambda var body) l))
+
+defines `for` as a macro: a procedure called at expansion time with the
+unevaluated arguments of every form starting with `for`, returning the
+form to evaluate in its place. Every top-level form is expanded once,
+before it is evaluated or compiled, so the code that runs never pays for
+the rewrite again. `(macroexpand 'form)` is replaced by the quoted
+expansion of `form`.
+
+Expansion is a single walk of the form: the expansion of a macro is
+expanded in turn, and every form object is expanded only once per
+walk, so macros repeating their arguments keep it linear. The program
+of an `(evalS "...")` is read and expanded once, when first run.
+
+Macros live in the global context like any other value, so they are
+saved in stdlib snapshots and are unhygienic: a macro expands wherever
+its name heads a form, local bindings notwithstanding. The time spent
+expanding is counted apart from evaluation: see `report` and
+`(macro-stats)`.
+"""
+import collections
+import time
+
+from lisp import compiler
+
+CACHE_SIZE = 1024
+
+# id(form) -> (form, global context, generation, expansion)
+_cache = collections.OrderedDict()
+_generation = 0 # how many macros were defined, which stales the cache
+
+stats = collections.Counter() # "forms", "expansions", "cache-hits", "seconds"
+counts = collections.Counter() # macro -> expansions
+timings = collections.Counter() # macro -> seconds
+
+
+class Macro():
+    "The procedure rewriting the forms headed by `name`."
+    def __init__(self, name, transformer):
+        self.name, self.transformer = name, transformer
+
+    def __call__(self, *args):
+        raise compiler.LispError(f"{self.name} is a macro: it can't be called at runtime")
+
+    def __repr__(self):
+        return f"<macro {self.name}>"
+
+
+def lookup(ctx, name):
+    "The macro bound to `name` in `ctx`, or None."
+    while ctx is not None:
+        if name in ctx:
+            value = ctx[name]
+            return value if type(value) is Macro else None
+        ctx = ctx.outer if ctx.outer is not None else ctx.parent
+    return None
+
+
+class Expander():
+    "Expands the macros bound in `ctx`, evaluating `defmacro`s with `evaluate`."
+    def __init__(self, ctx: "compiler.Context", evaluate):
+        self.ctx, self.evaluate = ctx, evaluate
+        self.done = dict() # id(form) -> (form, expansion)
+
+    def expand(self, ast):
+        if not isinstance(ast, list) or len(ast) == 0:
+            return ast
+        done = self.done.get(id(ast))
+        if done is not None and done[0] is ast:
+            return done[1]
+
+        expansion = self.expand_form(ast)
+        self.done[id(ast)] = (ast, expansion)
+        return expansion
+
+    def expand_form(self, ast):
+        head = ast[0]
+        if not isinstance(head, compiler.Symbol):
+            return self.expand_all(ast, 0)
+
+        if head in ("quote", "string"):
+            return ast
+        if head == "defmacro":
+            return self.defmacro(ast)
+        if head == "macroexpand":
+            if len(ast) != 2 or not (isinstance(ast[1], list) and len(ast[1]) == 2
+                                     and ast[1][0] == "quote"):
+                raise compiler.LispError(f"macroexpand expects a quoted form: {compiler.ast_to_str(ast)}")
+            return ["quote", self.expand(ast[1][1])]
+
+        macro = lookup(self.ctx, head)
+        if macro is not None:
+            start = time.perf_counter()
+            expansion = macro.transformer(*ast[1:])
+            timings[macro.name] += time.perf_counter() - start
+            counts[macro.name] += 1
+            stats["expansions"] += 1
+            return self.expand(expansion)
+
+        # Names being bound aren't calls
+        if head == "lambda":
+            return self.expand_all(ast, 2)
+        if head == "define":
+            return self.expand_all(ast, 2)
+        if head == "let":
+            if len(ast) == 3: # (let ((name value) ...) body)
+                clauses = [[c[0], *self.expand_all(c, 1)[1:]] if isinstance(c, list) else c
+                           for c in ast[1]]
+                return self.rebuild(ast, [head, clauses, self.expand(ast[2])])
+            return self.expand_all(ast, 2)
+        if head == "cond":
+            return self.rebuild(ast, [head] + [self.expand_all(c, 0) if isinstance(c, list) else c
+                                               for c in ast[1:]])
+        return self.expand_all(ast, 0)
+
+    def expand_all(self, ast, start):
+        "`ast` with its elements from `start` on expanded."
+        return self.rebuild(ast, ast[:start] + [self.expand(x) for x in ast[start:]])
+
+    def rebuild(self, ast, items):
+        "`ast` itself if `items` are its own elements, or a copy of `ast` with `items`."
+        if len(items) == len(ast) and all(x is y for x, y in zip(items, ast)):
+            return ast
+        if isinstance(ast, compiler.SourceList):
+            return compiler.SourceList(items, ast.location)
+        return items
+
+    def defmacro(self, ast):
+        global _generation
+        if len(ast) not in (4, 5) or not isinstance(ast[1], compiler.Symbol) or not isinstance(ast[2], list):
+            raise compiler.LispError(f"defmacro expects a name, parameters and a body: {compiler.ast_to_str(ast)}")
+        name = ast[1]
+        transformer = self.evaluate(self.expand(["lambda", *ast[2:]]), self.ctx)
+        self.ctx.outermost_add(name, Macro(name, transformer))
+        _generation += 1
+        return ["quote", name]
+
+
+def expand(ast, ctx: "compiler.Context", evaluate):
+    "`ast` with the macros bound in `ctx` expanded; `evaluate` evaluates `defmacro`s."
+    if not isinstance(ast, list) or len(ast) == 0:
+        return ast
+    start = time.perf_counter()
+    expansion = Expander(ctx, evaluate).expand(ast)
+    stats["seconds"] += time.perf_counter() - start
+    stats["forms"] += 1
+    return expansion
+
+
+def expand_source(form: list, source: str, ctx: "compiler.Context", evaluate):
+    """
+    `source` read and expanded, remembered for `form`, the AST it comes
+    from: running `form` again reuses the expansion until a macro is
+    (re)defined.
+    """
+    from lisp.closure import outermost_context
+    genv = outermost_context(ctx)
+    entry = _cache.get(id(form))
+    if entry is not None and entry[0] is form and entry[1] is genv and entry[2] == _generation:
+        stats["cache-hits"] += 1
+        _cache.move_to_end(id(form))
+        return entry[3]
+
+    expansion = expand(compiler.parse(source), ctx, evaluate)
+    _cache[id(form)] = (form, genv, _generation, expansion)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return expansion
+
+
+def expanding(evaluate):
+    "`evaluate`, expanding the macros of an AST before evaluating it."
+    return lambda ast, ctx: evaluate(expand(ast, ctx, evaluate), ctx)
+
+#######################################
+
+def snapshot() -> tuple:
+    "The statistics so far, to report on what comes after them."
+    return stats.copy(), counts.copy(), timings.copy()
+
+def report(since: tuple = None, n=10) -> str:
+    "The time spent expanding macros, in total and per macro, after `since`."
+    totals, macro_counts, macro_times = stats.copy(), counts.copy(), timings.copy()
+    if since is not None:
+        totals.subtract(since[0])
+        macro_counts.subtract(since[1])
+        macro_times.subtract(since[2])
+
+    lines = [f"macro expansion: {totals['seconds']:.4f}s for {totals['forms']} forms, "
+             f"{totals['expansions']} expansions, {totals['cache-hits']} cached"]
+    for name, seconds in macro_times.most_common(n):
+        if macro_counts[name] > 0:
+            lines.append(f"{macro_counts[name]:9d} {seconds:9.4f}  {name}")
+    return "\n".join(lines)
+
+def macro_stats() -> list:
+    return [[compiler.Symbol(name), stats[name]] for name in ("forms", "expansions", "cache-hits", "seconds")]
+
+
+builtins = {
+    "macro-stats": macro_stats,
+}
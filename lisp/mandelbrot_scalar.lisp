@@ -0,0 +1,43 @@
+;; The Mandelbrot set, one pixel at a time, on native complex numbers.
+;; The rows are computed in parallel, one process per core.
+
+(define converge? 
+    (lambda (c iters) "Convergence test for complex numbers"
+      (let escape
+        (lambda (n z)
+          (if (or (>= n iters) (> (magnitude z) 2)) n
+              (escape (++ n) (+ (* z z) c))))
+        (escape 0 c))))
+
+(define seq-step
+    (lambda (start end step) (reverse
+      (repeat-until (lambda (acc) (cons (+ (head acc) step) acc))
+		    (list start)
+		    (lambda (acc) (= (head acc) end))))))
+
+;;;;;;;;;;;;;;;;;;;;;;
+
+(define width-pixel 256)
+(define height-pixel 256)
+
+(define maprange
+    (lambda (max-pix pix)
+      (- (/ (* 4 pix) max-pix) 2)))
+
+
+(define nth-row
+  (lambda (y)
+    (let calculation
+      (compose  (lambda (c) (converge? c 10))
+       (compose (lambda (x) (make-rectangular x (maprange height-pixel y)))
+		(lambda (x1) (maprange width-pixel x1))))
+      (map calculation (seq 0 width-pixel)))))
+
+
+;;;;;;;;;;;;;;;;;;;;;;;;;
+
+(let start (time)
+ (begin
+  (write-pgm "out.pgm" (pmap nth-row (seq 0 height-pixel))
+             width-pixel height-pixel 10)
+  (print (- (time) start))))
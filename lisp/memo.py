@@ -0,0 +1,155 @@
+"""
+Memoization.
+
+`(memoize f)` is a procedure computing the same results as `f`, which
+remembers them: called again with equal arguments it returns the
+stored result instead of calling `f`. It is meant for pure procedures,
+and makes naive recursive definitions fast, as long as the recursive
+calls go through the memoized name:
+
+    (define fib
+      (memoize (lambda (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))))
+
+Arguments are compared with Lisp equality: lists (and persistent lists)
+with the same elements are the same key, and so are 1 and 1.0.
+Procedures are compared by identity.
+
+The cache is bounded by options given after `f`, as symbol/value pairs:
+
+    'size n     at most n results, dropping the least recently used
+    'bytes n    at most about n bytes of arguments and results, the same way
+    'ttl s      results are forgotten s seconds after being computed
+
+With no options the cache keeps the last 4096 results. `(memo-stats f)`
+lists the hits, misses, evictions, entries and bytes of a memoized
+procedure, and `(memo-clear f)` empties its cache.
+"""
+import collections
+import sys
+import time
+
+from lisp.rlist import RList
+from lisp.numarray import NumArray
+from lisp.lazy import LazySeq
+
+DEFAULT_SIZE = 4096
+
+
+def lisp_key(x):
+    "A hashable value, equal for Lisp values that are equal."
+    if isinstance(x, (list, tuple, RList)):
+        return tuple(lisp_key(el) for el in x)
+    if isinstance(x, LazySeq):
+        return tuple(lisp_key(el) for el in x.force())
+    if isinstance(x, NumArray):
+        return tuple(x.data)
+    return x
+
+def size_of(x) -> int:
+    "About how many bytes `x` takes, with its elements."
+    if isinstance(x, (list, tuple, RList)):
+        return sys.getsizeof(x) + sum(size_of(el) for el in x)
+    if isinstance(x, NumArray):
+        return sys.getsizeof(x.data)
+    return sys.getsizeof(x)
+
+
+class Memo():
+    "A procedure with a cache of its results."
+    def __init__(self, func, size=None, nbytes=None, ttl=None):
+        self.func = func
+        if hasattr(func, "parms"): # keeps curry working
+            self.parms = func.parms
+        self.size, self.nbytes, self.ttl = size, nbytes, ttl
+        self.cache = collections.OrderedDict() # key -> (value, expiry, bytes)
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, *args):
+        try:
+            key = lisp_key(args)
+            entry = self.cache.get(key)
+        except TypeError: # arguments that can't be hashed: no caching
+            self.misses += 1
+            return self.func(*args)
+
+        if entry is not None:
+            if entry[1] is None or entry[1] > time.monotonic():
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return entry[0]
+            self.drop(key)
+
+        self.misses += 1
+        value = self.func(*args)
+        self.store(key, value)
+        return value
+
+    def store(self, key, value):
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        nbytes = size_of(key) + size_of(value) if self.nbytes is not None else 0
+        if key in self.cache: # stored meanwhile by a recursive call
+            self.bytes -= self.cache.pop(key)[2]
+        self.cache[key] = (value, expiry, nbytes)
+        self.bytes += nbytes
+
+        while ((self.size is not None and len(self.cache) > self.size)
+               or (self.nbytes is not None and self.bytes > self.nbytes and self.cache)):
+            self.drop(next(iter(self.cache)))
+
+    def drop(self, key):
+        self.bytes -= self.cache.pop(key)[2]
+        self.evictions += 1
+
+    def clear(self):
+        self.cache.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.cache), "bytes": self.bytes}
+
+    @property
+    def __name__(self): # the profiler's label
+        return "memoized " + (getattr(self.func, "name", None) or getattr(self.func, "__name__", "lambda"))
+
+    def __repr__(self):
+        return f"<memoized {self.func!r}>"
+
+##################################
+
+OPTIONS = {"size": "size", "bytes": "nbytes", "ttl": "ttl"}
+
+def memoize(func, *options) -> Memo:
+    from lisp.compiler import LispError
+    if len(options) % 2:
+        raise LispError("memoize options come in pairs: 'size n, 'bytes n or 'ttl s")
+    kwargs = dict()
+    for option, value in zip(options[::2], options[1::2]):
+        if option not in OPTIONS:
+            raise LispError(f"unknown memoize option {option}: expected one of {list(OPTIONS)}")
+        kwargs[OPTIONS[option]] = value
+    if not kwargs:
+        kwargs["size"] = DEFAULT_SIZE
+    return Memo(func, **kwargs)
+
+def memoized(x, caller) -> Memo:
+    from lisp.compiler import LispError
+    if not isinstance(x, Memo):
+        raise LispError(f"{caller}: {x} is not a memoized procedure")
+    return x
+
+def memo_stats(memo: Memo) -> list:
+    from lisp.compiler import Symbol
+    return [[Symbol(name), value] for name, value in memoized(memo, "memo-stats").stats().items()]
+
+def memo_clear(memo: Memo):
+    memoized(memo, "memo-clear").clear()
+    return memo
+
+
+builtins = {
+    "memoize": memoize,
+    "memo-stats": memo_stats,
+    "memo-clear": memo_clear,
+}
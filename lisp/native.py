@@ -0,0 +1,80 @@
+"""
+Native list functions.
+
+`length`, `reverse`, `filter`, `last`, `seq`, `zip` and `empty-list?`
+are under most of the stdlib, so they are builtins, each a single
+Python loop. Their Lisp definitions live on in lisp/reference.lisp:
+they say what these builtins must return, and the tests check that
+both agree. The docstrings are their help strings, for `help`. `reference_context` loads them over the stdlib.
+
+Two quirks of the Lisp definitions are kept: `zip` returns its pairs
+from the last to the first, and `last` of an empty list is
+`err-empty-list`. One isn't: `(seq n n)` never returns in Lisp, and is
+the empty list here.
+"""
+import math
+import pathlib
+
+from lisp import lazy
+
+REFERENCE_PATH = pathlib.Path(__file__).parent / "reference.lisp"
+
+
+def length(xs) -> int:
+    "List length"
+    try:
+        return len(xs)
+    except TypeError:
+        return sum(1 for _ in xs)
+
+def reverse(xs) -> list:
+    "Reverse a list"
+    return xs[::-1] if isinstance(xs, list) else list(xs)[::-1]
+
+def filter_(pred, xs):
+    "Filter HOF"
+    if isinstance(xs, lazy.LazySeq):
+        return xs.then("filter", pred)
+    return [x for x in xs if pred(x)]
+
+def last(xs):
+    "Returns last element of a list."
+    n = length(xs) - 1
+    if n < 0:
+        from lisp.compiler import Symbol
+        return Symbol("err-empty-list")
+    return xs[n]
+
+def seq(start, end) -> list:
+    "List of numbers from start to end"
+    if isinstance(start, int) and isinstance(end, int):
+        return list(range(start, end))
+    return [start + i for i in range(max(0, math.ceil(end - start)))]
+
+def zip_(xs, ys) -> list:
+    "The pairs of elements of `xs` and `ys`, the last pair first."
+    pairs = [[x, y] for x, y in zip(xs, ys)]
+    pairs.reverse()
+    return pairs
+
+def empty_list(xs) -> bool:
+    "Checks if a list is empty."
+    return xs == []
+
+
+def reference_context(mode="tree"):
+    "A fork of the stdlib where these names are bound to their Lisp definitions."
+    from lisp.cache import load_stdlib
+    from lisp.compiler import Print, eval_program
+    return eval_program(REFERENCE_PATH, load_stdlib(mode).fork(), Print.NOTHING, mode=mode)
+
+
+builtins = {
+    "length": length,
+    "reverse": reverse,
+    "filter": filter_,
+    "last": last,
+    "seq": seq,
+    "zip": zip_,
+    "empty-list?": empty_list,
+}
@@ -0,0 +1,167 @@
+"""
+Numeric arrays.
+
+A `NumArray` is a flat array of numbers, backed by `array.array`: ints
+are stored as 'q', anything else as 'd'. Arithmetic and comparisons
+work elementwise, with scalars broadcast over arrays, so the plain `+`,
+`-`, `*`, `/`, `**`, `mod` and `<`... builtins already handle them.
+Comparisons give arrays of 0/1 to be used as masks with `where`. Every
+operation runs one C-level loop over the whole array, instead of one
+interpreted procedure call per element.
+"""
+import array
+import cmath
+import itertools
+import math
+import operator as op
+
+from lisp.rlist import RList
+
+
+class NumArray():
+    __slots__ = ("data",)
+
+    def __init__(self, data: array.array):
+        self.data = data
+
+    @staticmethod
+    def of(values) -> "NumArray":
+        "An array of `values`, of ints when they all are."
+        values = values if isinstance(values, list) else list(values)
+        try:
+            return NumArray(array.array("q", values))
+        except (TypeError, OverflowError):
+            try:
+                return NumArray(array.array("d", values))
+            except TypeError:
+                raise TypeError("numeric arrays only hold real numbers") from None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return NumArray(self.data[i])
+        return self.data[i]
+
+    def __eq__(self, other):
+        if not isinstance(other, (NumArray, list, RList)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __bool__(self):
+        raise ValueError("the truth value of an array is ambiguous: use any? or all?")
+
+    def __repr__(self):
+        return f"array({list(self.data)})"
+
+    __add__ = lambda self, other: elementwise(op.add, self, other)
+    __radd__ = lambda self, other: elementwise(op.add, other, self)
+    __sub__ = lambda self, other: elementwise(op.sub, self, other)
+    __rsub__ = lambda self, other: elementwise(op.sub, other, self)
+    __mul__ = lambda self, other: elementwise(op.mul, self, other)
+    __rmul__ = lambda self, other: elementwise(op.mul, other, self)
+    __truediv__ = lambda self, other: elementwise(op.truediv, self, other)
+    __rtruediv__ = lambda self, other: elementwise(op.truediv, other, self)
+    __pow__ = lambda self, other: elementwise(op.pow, self, other)
+    __rpow__ = lambda self, other: elementwise(op.pow, other, self)
+    __mod__ = lambda self, other: elementwise(op.mod, self, other)
+    __rmod__ = lambda self, other: elementwise(op.mod, other, self)
+    __lt__ = lambda self, other: elementwise(op.lt, self, other)
+    __le__ = lambda self, other: elementwise(op.le, self, other)
+    __gt__ = lambda self, other: elementwise(op.gt, self, other)
+    __ge__ = lambda self, other: elementwise(op.ge, self, other)
+    __neg__ = lambda self: NumArray.of(map(op.neg, self.data))
+
+
+def _operands(*xs):
+    "Iterables over the values of arrays and scalars, all of the same length."
+    lengths = {len(x) for x in xs if isinstance(x, NumArray)}
+    if not lengths:
+        raise TypeError("expected at least one array")
+    if len(lengths) > 1:
+        raise ValueError(f"arrays of different lengths: {sorted(lengths)}")
+    return [x.data if isinstance(x, NumArray) else itertools.repeat(x) for x in xs]
+
+def elementwise(func, *xs):
+    return NumArray.of(map(func, *_operands(*xs)))
+
+def mapping(func):
+    "`func` applied to a scalar, or to every element of an array."
+    return lambda x: NumArray.of(map(func, x.data)) if isinstance(x, NumArray) else func(x)
+
+##################################
+
+def make_array(xs) -> NumArray:
+    return NumArray.of(xs)
+
+def arange(start, stop, step=1) -> NumArray:
+    if all(isinstance(x, int) for x in (start, stop, step)):
+        return NumArray(array.array("q", range(start, stop, step)))
+    n = max(0, math.ceil((stop - start) / step))
+    return NumArray(array.array("d", (start + i * step for i in range(n))))
+
+def linspace(start, stop, n) -> NumArray:
+    "n evenly spaced numbers from start to stop, both included."
+    if n == 1:
+        return NumArray(array.array("d", [start]))
+    step = (stop - start) / (n - 1)
+    return NumArray(array.array("d", (start + i * step for i in range(n))))
+
+def full(n, value) -> NumArray:
+    return NumArray.of([value] * n)
+
+def tile(xs: NumArray, times: int) -> NumArray:
+    "The whole array repeated `times` times."
+    return NumArray(xs.data * times)
+
+def repeat_each(xs: NumArray, times: int) -> NumArray:
+    "Every element repeated `times` times in a row."
+    data = array.array(xs.data.typecode)
+    for x in xs.data:
+        data.extend(itertools.repeat(x, times))
+    return NumArray(data)
+
+def where(mask, then, other) -> NumArray:
+    "Elementwise `then` where `mask` is not 0, `other` elsewhere."
+    return NumArray.of(t if m else o for m, t, o in zip(*_operands(mask, then, other)))
+
+def mean(xs):
+    return sum(xs) / len(xs)
+
+
+builtins = {
+    "array": make_array,
+    "array?": lambda x: isinstance(x, NumArray),
+    "array->list": lambda xs: list(xs.data),
+    "array-length": len,
+    "array-slice": lambda xs, start, end: xs[start:end],
+    "arange": arange,
+    "linspace": linspace,
+    "zeros": lambda n: full(n, 0),
+    "full": full,
+    "tile": tile,
+    "repeat-each": repeat_each,
+
+    "where": where,
+    "array=": lambda x, y: elementwise(op.eq, x, y),
+    "mask-and": lambda x, y: elementwise(lambda a, b: bool(a and b), x, y),
+    "mask-or": lambda x, y: elementwise(lambda a, b: bool(a or b), x, y),
+    "mask-not": mapping(lambda a: not a),
+
+    "sqrt": mapping(lambda x: cmath.sqrt(x) if isinstance(x, complex) else math.sqrt(x)),
+    "abs": mapping(abs),
+    "floor": mapping(math.floor),
+
+    "sum": sum,
+    "min": min,
+    "max": max,
+    "mean": mean,
+    "any?": any,
+    "all?": all,
+}
@@ -0,0 +1,256 @@
+"""
+Optimizer.
+
+Rewrites a top-level form, after its macros are expanded and before it
+is evaluated or compiled, resolving what it can without running it.
+`eval_program` runs it with `opt_level` above 0:
+
+    1  constant folding: calls of pure builtins on constants, global
+       numeric constants (`t`, `nil`, `(define width-pixel 256)`) and
+       `(** x 2)` becoming `(* x x)`; `if` and `cond` branches whose
+       condition is constant are dropped
+    2  also inlining: calls of small procedures defined at top level,
+       whose body only calls pure builtins, are replaced with their body
+
+The optimized form depends on the global values it resolved, so those
+names are guarded: defining any of them again raises a LispError,
+instead of leaving optimized code behind with the old value. Names
+bound locally, or defined by the form itself, are left alone.
+"""
+from lisp import compiler
+from lisp.compiler import Number, Procedure, Symbol, context_base_simple
+from lisp.closure import defined_names
+
+# Builtins without side effects, whose value only depends on their arguments
+PURE = frozenset((
+    "and", "or", "not", "=", "!=", ">=", ">", "<=", "<",
+    "+", "-", "*", "**", "++", "*2", "mod", "/",
+    "make-rectangular", "make-polar", "real-part", "imag-part", "magnitude", "angle",
+    "conjugate", "complex?", "head", "nth", "is-list?", "show", "type?", "atom?",
+))
+
+# Forms that may appear in the body of an inlined procedure
+INLINE_FORMS = frozenset(("quote", "string", "list", "if", "cond"))
+INLINE_SIZE = 16 # nodes in the body of an inlined procedure, at most
+
+
+def size(ast) -> int:
+    if not isinstance(ast, list):
+        return 1
+    return 1 + sum(size(x) for x in ast)
+
+
+def is_constant(ast) -> bool:
+    return isinstance(ast, Number) and not isinstance(ast, Symbol)
+
+def is_atomic(ast) -> bool:
+    "Evaluating `ast` has no effects, and costs next to nothing."
+    return (not isinstance(ast, list) or len(ast) == 0
+            or (len(ast) == 2 and ast[0] in ("quote", "string")))
+
+
+class Optimizer():
+    "Optimizes forms that will run in the context `ctx`."
+    def __init__(self, ctx, level: int):
+        # Names bound between `ctx` and the global context are local
+        self.local = set()
+        while ctx.outer is not None:
+            self.local.update(ctx.scope.names if hasattr(ctx, "scope") else ctx.keys())
+            ctx = ctx.outer
+        self.genv, self.level = ctx, level
+        self.defined = set() # names defined by the form being optimized
+
+    def optimize_form(self, ast):
+        self.defined = defined_names(ast)
+        return self.optimize(ast, frozenset(self.local))
+
+    def guard(self, name):
+        if type(self.genv.guarded) is frozenset:
+            self.genv.guarded = set()
+        self.genv.guarded.add(name)
+
+    def sees(self, ctx) -> bool:
+        "True if `ctx` is the global context, or one it was forked from."
+        genv = self.genv
+        while genv is not None and genv is not ctx:
+            genv = genv.parent
+        return genv is not None
+
+    def global_value(self, name, scope):
+        "The global value of `name` the optimizer may rely on, or None."
+        if name in scope or name in self.defined:
+            return None
+        return self.genv[name] if self.genv.binds(name) else None
+
+    def builtin(self, name, scope) -> bool:
+        "True if `name` is a pure builtin here."
+        if not isinstance(name, Symbol) or name not in PURE:
+            return False
+        return self.global_value(name, scope) is context_base_simple[name]
+
+    def optimize(self, ast, scope: frozenset):
+        "`ast` optimized; `scope` holds the names bound locally around it."
+        if isinstance(ast, Symbol):
+            value = self.global_value(ast, scope)
+            if is_constant(value):
+                self.guard(ast)
+                return value
+            return ast
+
+        if not isinstance(ast, list) or len(ast) == 0:
+            return ast
+
+        head = ast[0]
+        if head in ("quote", "string", "debug", "curry"):
+            return ast
+
+        if head == "lambda":
+            inner = scope | set(ast[1])
+            return self.rebuild(ast, ast[:-1] + [self.optimize(ast[-1], inner)])
+
+        if head == "define":
+            return self.rebuild(ast, ast[:2] + [self.optimize(x, scope) for x in ast[2:]])
+
+        if head == "let":
+            if len(ast) == 3: # (let ((name value) ...) body)
+                inner = scope | {clause[0] for clause in ast[1]}
+                clauses = [[clause[0], self.optimize(clause[1], inner)] for clause in ast[1]]
+                return self.rebuild(ast, [head, clauses, self.optimize(ast[2], inner)])
+            inner = scope | {ast[1]}
+            return self.rebuild(ast, [head, ast[1]] + [self.optimize(x, inner) for x in ast[2:]])
+
+        if head == "if" and len(ast) == 4:
+            test = self.optimize(ast[1], scope)
+            if is_constant(test):
+                return self.optimize(ast[2] if test else ast[3], scope)
+            return self.rebuild(ast, [head, test] + [self.optimize(x, scope) for x in ast[2:]])
+
+        if head == "cond":
+            clauses = []
+            for clause in ast[1:]:
+                test = self.optimize(clause[0], scope)
+                if is_constant(test):
+                    if test:
+                        if not clauses: # the first clause always taken
+                            return self.optimize(clause[1], scope)
+                        clauses.append([test, self.optimize(clause[1], scope)])
+                        break
+                    continue
+                clauses.append([test, self.optimize(clause[1], scope)])
+            if not clauses: # no clause is taken: leave the error to runtime
+                return ast
+            return [head] + clauses
+
+        items = [self.optimize(x, scope) for x in ast]
+        if isinstance(head, Symbol):
+            folded = self.fold(items, scope)
+            if folded is not None:
+                return folded
+            if self.level >= 2:
+                inlined = self.inline(items, scope)
+                if inlined is not None:
+                    return inlined
+        return self.rebuild(ast, items)
+
+    def rebuild(self, ast, items):
+        if len(items) == len(ast) and all(x is y for x, y in zip(items, ast)):
+            return ast
+        if isinstance(ast, compiler.SourceList):
+            return compiler.SourceList(items, ast.location)
+        return items
+
+    def fold(self, call, scope):
+        "The constant value of the builtin `call`, or None."
+        name, args = call[0], call[1:]
+        if not self.builtin(name, scope):
+            return None
+
+        if name == "**" and len(args) == 2 and type(args[1]) is int and args[1] == 2 \
+           and isinstance(args[0], Symbol):
+            if self.builtin(Symbol("*"), scope):
+                self.guard(name)
+                self.guard(Symbol("*"))
+                return [Symbol("*"), args[0], args[0]]
+
+        if not all(is_constant(x) for x in args):
+            return None
+        try:
+            value = context_base_simple[name](*args)
+        except Exception: # left for runtime to raise
+            return None
+        if not is_constant(value):
+            return None
+        self.guard(name)
+        return value
+
+    def inline(self, call, scope):
+        "The body of the procedure called by `call`, with the arguments in it, or None."
+        name, args = call[0], call[1:]
+        proc = self.global_value(name, scope)
+        if (not isinstance(proc, Procedure) or not self.sees(proc.ctx)
+                or len(proc.parms) != len(args) or size(proc.body) > INLINE_SIZE):
+            return None
+
+        parms = list(proc.parms)
+        uses = [] # parameters as they are evaluated, strictly or not
+        if not self.inlinable(proc.body, name, parms, scope, uses, strict=True):
+            return None
+
+        # The arguments that aren't atomic are evaluated once, in order
+        eager = [p for p, arg in zip(parms, args) if not is_atomic(arg)]
+        if ([p for p, strict in uses if p in eager] != eager
+                or not all(strict for p, strict in uses if p in eager)):
+            return None
+
+        self.guard(name)
+        body = substitute(proc.body, dict(zip(parms, args)))
+        return self.optimize(body, scope)
+
+    def inlinable(self, ast, name, parms, scope, uses, strict) -> bool:
+        """
+        True if `ast`, part of the body of the procedure `name`, only
+        calls pure builtins. Appends to `uses` the parameters it reads.
+        """
+        if isinstance(ast, Symbol):
+            if ast in parms:
+                uses.append((ast, strict))
+                return True
+            return ast != name and ast not in scope and ast not in self.defined
+        if not isinstance(ast, list) or len(ast) == 0:
+            return True
+
+        head = ast[0]
+        if head in ("quote", "string"):
+            return True
+        if head in INLINE_FORMS:
+            # Only the condition of an if or of the first clause is always evaluated
+            if head == "if":
+                parts = [(ast[1], strict)] + [(x, False) for x in ast[2:]]
+            elif head == "cond":
+                parts = [(x, strict and i == 0 and j == 0)
+                         for i, clause in enumerate(ast[1:]) for j, x in enumerate(clause)]
+            else:
+                parts = [(x, strict) for x in ast[1:]]
+            return all(self.inlinable(x, name, parms, scope, uses, s) for x, s in parts)
+
+        if not self.builtin(head, scope):
+            return False
+        return all(self.inlinable(x, name, parms, scope, uses, strict) for x in ast[1:])
+
+
+def substitute(ast, values: dict):
+    "`ast` with the symbols in `values` replaced by their values."
+    if isinstance(ast, Symbol):
+        return values.get(ast, ast)
+    if not isinstance(ast, list) or len(ast) == 0 or ast[0] in ("quote", "string"):
+        return ast
+    return [substitute(x, values) for x in ast]
+
+
+def optimizing(evaluate, level: int):
+    "`evaluate`, optimizing an AST at `level` before evaluating it."
+    if level <= 0:
+        return evaluate
+    def evaluate_optimized(ast, ctx):
+        return evaluate(Optimizer(ctx, level).optimize_form(ast), ctx)
+    return evaluate_optimized
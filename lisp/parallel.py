@@ -0,0 +1,117 @@
+"""
+Parallel map and fold.
+
+`pmap` and `pfold` split a list in chunks and hand them to a pool of
+worker processes, each with the stdlib already loaded. The procedure
+is pickled once and sent along with every chunk (see lisp.serialize);
+the results come back in order.
+
+Processes only pay off when every call does real work: sending a chunk
+and its results costs about as much as a few hundred cheap calls.
+"""
+import concurrent.futures
+import math
+import os
+import pickle
+
+from lisp import serialize
+
+# Defaults for the optional arguments of pmap and pfold. None means one
+# worker per core, and four chunks per worker.
+WORKERS = None
+CHUNKSIZE = None
+
+_pools = dict() # workers -> ProcessPoolExecutor
+_worker_env = None
+
+
+def _init_worker():
+    global _worker_env
+    from lisp.cache import load_stdlib
+    _worker_env = load_stdlib()
+
+def _send_back(value) -> bytes:
+    from lisp.compiler import LispError
+    try:
+        return serialize.dumps(value)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        raise LispError(f"cannot send {value} back from a worker process ({e})") from None
+
+def _map_chunk(func: bytes, chunk: bytes) -> bytes:
+    func, chunk = serialize.loads(func, _worker_env), serialize.loads(chunk, _worker_env)
+    return _send_back([func(x) for x in chunk])
+
+def _fold_chunk(func: bytes, chunk: bytes) -> bytes:
+    func, chunk = serialize.loads(func, _worker_env), serialize.loads(chunk, _worker_env)
+    acc = chunk[0]
+    for x in chunk[1:]:
+        acc = func(x, acc)
+    return _send_back(acc)
+
+
+def pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    if workers not in _pools:
+        _pools[workers] = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker)
+    return _pools[workers]
+
+def shutdown():
+    "Stops all the worker processes."
+    for executor in _pools.values():
+        executor.shutdown()
+    _pools.clear()
+
+
+def describe(func) -> str:
+    "`func` as errors name it: a procedure by its name and where its lambda was read."
+    if not hasattr(func, "location"):
+        return getattr(func, "__name__", repr(func))
+    name = func.name or "lambda"
+    return name if func.location is None else f"{name} ({func.location})"
+
+
+def _run(name, task, func, l, workers, chunksize):
+    "Runs `task` on the chunks of `l` in the pool; yields the results in order."
+    from lisp.closure import outermost_context
+    from lisp.compiler import LispError, context_base
+
+    items = list(l)
+    workers = workers or WORKERS or os.cpu_count()
+    chunksize = chunksize or CHUNKSIZE or max(1, math.ceil(len(items) / (4 * workers)))
+    env = outermost_context(func.ctx) if hasattr(func, "ctx") else context_base
+
+    try:
+        payload = serialize.dumps(func)
+        chunks = [serialize.dumps(items[i:i+chunksize])
+                  for i in range(0, len(items), chunksize)]
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        raise LispError(f"{name}: cannot send {describe(func)} to the worker processes ({e})") from None
+
+    futures = [pool(workers).submit(task, payload, chunk) for chunk in chunks]
+    for future in futures:
+        yield serialize.loads(future.result(), env)
+
+
+def pmap(func, l, workers=None, chunksize=None) -> list:
+    """
+    Like `map`, calling `func` in `workers` processes, on chunks of
+    `chunksize` elements.
+    """
+    return [y for chunk in _run("pmap", _map_chunk, func, l, workers, chunksize)
+              for y in chunk]
+
+def pfold(func, acc, l, workers=None, chunksize=None):
+    """
+    Like `fold`, folding every chunk in a different process and then the
+    results of the chunks, in order. `func` must be associative: it gets
+    as arguments elements of `l` or results of `func` alike.
+    """
+    for x in _run("pfold", _fold_chunk, func, l, workers, chunksize):
+        acc = func(x, acc)
+    return acc
+
+
+builtins = {
+    "pmap": pmap,
+    "pfold": pfold,
+}
@@ -0,0 +1,105 @@
+"""
+Lisp-level profiler.
+
+`Profiler` is a hook (see lisp.hooks) timing every call it sees. Times
+are attributed to the callee: a procedure by its name and the location
+of its lambda, a builtin by its name in `context_base_simple`. For each
+of them it counts the calls, their self time (spent in the callee's own
+body) and their inclusive time (self time plus the calls it made, with
+recursive calls counted once). A tail call ends the time of its caller.
+
+With `allocations`, the memory blocks still allocated when a call
+returns are counted the same way. `sys.getallocatedblocks` takes time
+proportional to the heap, so this is off by default.
+
+Programs are profiled by `(profile expr)`, which prints the report and
+returns the value of `expr`, or by the `profile` argument of
+`eval_program` and `ev`.
+"""
+import collections
+import sys
+import time
+
+from lisp.compiler import Procedure
+from lisp import hooks, serialize
+
+
+class Profiler(hooks.Hook):
+    def __init__(self, allocations=False):
+        self.allocations = allocations
+        # label -> [calls, self time, inclusive time, self blocks, inclusive blocks]
+        self.stats = collections.defaultdict(lambda: [0, 0.0, 0.0, 0, 0])
+        self.stacks = collections.Counter() # tuple of labels -> self time
+        self.active = collections.Counter() # label -> calls in progress
+        # The calls in progress, as [label, path, start, time in callees,
+        # blocks at start, blocks allocated in callees]
+        self.frames = []
+        self.labels = dict() # id -> label, for builtins
+        self.builtins = serialize.builtin_names()
+
+    def label(self, func) -> str:
+        if isinstance(func, Procedure):
+            name = func.name or "lambda"
+            return name if func.location is None else f"{name} ({func.location})"
+        label = self.labels.get(id(func))
+        if label is None:
+            label = self.builtins.get(id(func)) or getattr(func, "__name__", repr(func))
+            self.labels[id(func)] = label
+        return label
+
+    def enter(self, ast, func, args, depth):
+        label = self.label(func)
+        path = (self.frames[-1][1] if self.frames else ()) + (label,)
+        self.active[label] += 1
+        blocks = sys.getallocatedblocks() if self.allocations else 0
+        self.frames.append([label, path, time.perf_counter(), 0.0, blocks, 0])
+
+    def exit(self, ast, func, value, depth):
+        now = time.perf_counter()
+        blocks = sys.getallocatedblocks() if self.allocations else 0
+        label, path, start, callees, start_blocks, callee_blocks = self.frames.pop()
+        elapsed, allocated = now - start, blocks - start_blocks
+
+        stats = self.stats[label]
+        stats[0] += 1
+        stats[1] += elapsed - callees
+        stats[3] += allocated - callee_blocks
+        self.active[label] -= 1
+        if not self.active[label]:
+            stats[2] += elapsed
+            stats[4] += allocated
+        self.stacks[path] += elapsed - callees
+
+        if self.frames:
+            self.frames[-1][3] += elapsed
+            self.frames[-1][5] += allocated
+
+    def report(self, n=20, sort="self") -> str:
+        "The `n` most expensive procedures and builtins, as a table."
+        column = {"calls": 0, "self": 1, "inclusive": 2}[sort]
+        rows = sorted(self.stats.items(), key=lambda item: -item[1][column])[:n]
+
+        lines = [f"{'calls':>9} {'self s':>9} {'incl. s':>9}"
+                 + (f" {'self blk':>9} {'incl. blk':>9}" if self.allocations else "")
+                 + "  procedure"]
+        for label, (calls, own, inclusive, own_blocks, blocks) in rows:
+            lines.append(f"{calls:9d} {own:9.4f} {inclusive:9.4f}"
+                         + (f" {own_blocks:9d} {blocks:9d}" if self.allocations else "")
+                         + f"  {label}")
+        return "\n".join(lines)
+
+    def write_collapsed(self, file):
+        "Self times in microseconds, as collapsed stacks for flamegraph.pl."
+        for path, seconds in self.stacks.most_common():
+            micros = round(seconds * 1e6)
+            if micros > 0:
+                file.write(";".join(label.replace(";", ",") for label in path) + f" {micros}\n")
+
+
+def profile_form(evaluate):
+    "Runs `evaluate` with a new profiler, printing its report: (profile expr)."
+    profiler = Profiler()
+    with hooks.installed(profiler):
+        value = evaluate()
+    print(profiler.report())
+    return value
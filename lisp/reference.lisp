@@ -0,0 +1,58 @@
+;; Lisp definitions of the list functions that are builtins now (see
+;; lisp/native.py). They are what the builtins must agree with: the
+;; tests run both and compare them.
+
+;; Checks if list is empty
+(define empty-list?  
+  (lambda (l) "Checks if a list is empty." (= l '())))
+
+(define filter
+    (lambda (f l) "Filter HOF"
+      (if (lazy? l) (lazy-filter f l)
+	  (fold (lambda (x acc) (if (f x) (append x acc) acc)) '() l))))
+
+(define length 
+    (lambda (l) "List length"
+      (fold (lambda (_ acc) (++ acc)) 0 l)))
+
+;; (let start (time) (begin (E) (print (- (time) start))))
+
+;; Reverse a list
+(define reverse
+    (lambda (l) "Reverse a list"
+      (fold (lambda (x acc) (cons x acc)) '() l)))
+
+;; (define ex (repeat-until *2 "x" (lambda (acc) (> (length acc) 800))))
+
+;; nth element of a list
+;; (define nth
+;;   (lambda (l n) "Returns nth element of a list." 
+;;     (cond ((empty-list? l) 'err-empty-list)
+;;           ((= n 0) (head l))
+;;           (t (nth (tail l) (- n 1))))))
+
+
+;; last element of a list
+(define last
+  (lambda (l) "Returns last element of a list."
+    (nth l (- (length l) 1))))
+
+
+;; Seq from to
+(define seq
+  (lambda (start end) "List of numbers from start to end"
+    (if (> start end) '() 
+	(reverse
+	 (repeat-until (lambda (acc) (cons (++ (head acc)) acc))
+		       (list start)
+		       (lambda (acc) (= (head acc) (- end 1))))))))
+
+(define zip 
+ (let zip-rec 
+    (lambda (l1 l2 acc)
+       (if (or (empty-list? l1) (empty-list? l2)) acc
+       (let ((h1 (head l1))
+	     (h2 (head l2)))
+	 (zip-rec (tail l1) (tail l2) (cons (list h1 h2) acc)))))
+
+  (lambda (l1 l2) (zip-rec l1 l2 ()))))
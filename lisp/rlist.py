@@ -0,0 +1,132 @@
+"""
+Persistent lists.
+
+`RList` is Okasaki's skew-binary random-access list: a linked list of
+complete binary trees, whose sizes follow the digits of a skew binary
+number. Consing, taking the head and the tail touch only the first two
+trees, so they are O(1), and since the trees are complete the nth
+element is O(log n) away. Lists are never modified: `cons` and `tail`
+build a new list sharing all its structure with the old one.
+
+RLists are what `cons` and `tail` return. They compare equal to the
+Python lists with the same elements and print like them, so they can
+flow through the code written for Python lists.
+"""
+
+
+class RList():
+    # `spine` is None for the empty list, or a (weight, tree, rest) tuple.
+    # A tree of weight 1 is the element itself, any other tree is a tuple
+    # (element, left, right) of two subtrees weighing (weight - 1) / 2.
+    # The elements of a tree are in preorder.
+    __slots__ = ("spine", "size")
+
+    def __init__(self, spine=None, size=0):
+        self.spine, self.size = spine, size
+
+    @staticmethod
+    def from_iterable(xs) -> "RList":
+        result = EMPTY
+        for x in reversed(list(xs)):
+            result = result.cons(x)
+        return result
+
+    def cons(self, x) -> "RList":
+        spine = self.spine
+        if spine is not None and spine[2] is not None and spine[0] == spine[2][0]:
+            weight, left, (_, right, rest) = spine
+            return RList((2 * weight + 1, (x, left, right), rest), self.size + 1)
+        return RList((1, x, spine), self.size + 1)
+
+    def head(self):
+        weight, tree, _ = self.spine
+        return tree if weight == 1 else tree[0]
+
+    def tail(self) -> "RList":
+        if self.spine is None:
+            return self
+        weight, tree, rest = self.spine
+        if weight == 1:
+            return RList(rest, self.size - 1)
+        half = weight // 2
+        return RList((half, tree[1], (half, tree[2], rest)), self.size - 1)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError("list index out of range")
+
+        spine = self.spine
+        while i >= spine[0]:
+            i -= spine[0]
+            spine = spine[2]
+
+        weight, tree = spine[0], spine[1]
+        while weight > 1:
+            if i == 0:
+                return tree[0]
+            weight //= 2
+            if i <= weight:
+                tree, i = tree[1], i - 1
+            else:
+                tree, i = tree[2], i - 1 - weight
+        return tree
+
+    def __iter__(self):
+        spine = self.spine
+        while spine is not None:
+            weight, tree, spine = spine
+            stack = [(weight, tree)]
+            while stack:
+                weight, tree = stack.pop()
+                if weight == 1:
+                    yield tree
+                else:
+                    yield tree[0]
+                    half = weight // 2
+                    stack.append((half, tree[2]))
+                    stack.append((half, tree[1]))
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, RList)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+EMPTY = RList()
+
+##################################
+
+def cons(x, xs):
+    if isinstance(xs, list):
+        xs = RList.from_iterable(xs)
+    elif not isinstance(xs, RList):
+        from lisp.lazy import LazySeq
+        if not isinstance(xs, LazySeq):
+            return [x] + xs # same error as before for non-lists
+        xs = RList.from_iterable(xs.force())
+    return xs.cons(x)
+
+def tail(xs):
+    if isinstance(xs, list):
+        xs = RList.from_iterable(xs)
+    elif not isinstance(xs, RList):
+        return xs[1:] # strings
+    return xs.tail()
@@ -0,0 +1,158 @@
+"""
+Pickling Lisp values.
+
+Builtins are lambdas, which pickle can't send by value, so they travel
+as a reference to their name in `context_base_simple`. The global
+environment is never pickled either: the unpickling side links what it
+loads to a global Context of its own.
+
+A procedure is pickled as its parameters, its body AST and its
+environment. When sending it to another process, the environment is
+just a small Context with the free variables of its body, the values it
+has captured; in a `snapshot` it is its whole environment. Compiled
+procedures, to closures or to bytecode, are compiled again the first
+time they are called after being loaded.
+"""
+import io
+import pickle
+
+GLOBAL_ENV = "global-env"
+
+
+def builtin(name):
+    "The builtin bound to `name`, on the receiving side."
+    from lisp.compiler import context_base_simple
+    return context_base_simple[name]
+
+
+_builtin_names = None
+
+def builtin_names() -> dict:
+    "id -> name of every builtin procedure."
+    global _builtin_names
+    if _builtin_names is None:
+        from lisp.compiler import context_base_simple
+        _builtin_names = {id(v): k for k, v in context_base_simple.items() if callable(v)}
+    return _builtin_names
+
+
+def free_variables(ast, bound=frozenset()) -> set:
+    "The symbols in `ast` not bound by one of its own lambdas or lets."
+    from lisp.compiler import Symbol
+
+    if isinstance(ast, Symbol):
+        return set() if ast in bound else {ast}
+    if not isinstance(ast, list) or len(ast) == 0:
+        return set()
+
+    form, free = ast[0], set()
+    if form in ("quote", "string"):
+        return free
+    if form == "lambda":
+        return free_variables(ast[-1], bound | set(ast[1]))
+    if form == "define":
+        return free_variables(ast[2], bound)
+    if form == "let" and len(ast) == 3:
+        # A clause only sees the names bound before it
+        names = [clause[0] for clause in ast[1]]
+        for i, clause in enumerate(ast[1]):
+            free |= free_variables(clause[1], bound | set(names[:i]))
+        return free | free_variables(ast[2], bound | set(names))
+    if form == "let":
+        return free_variables(ast[2], bound) | free_variables(ast[3], bound | {ast[1]})
+
+    for x in ast:
+        free |= free_variables(x, bound)
+    return free
+
+
+def captured(proc):
+    "A Context with the values of the free variables of `proc`."
+    from lisp.closure import outermost_context
+    from lisp.compiler import Context, LispSymbolError, context_base_simple
+
+    names, values = [], []
+    for name in sorted(free_variables(proc.body, frozenset(proc.parms))):
+        try:
+            value = proc.ctx.find(name)
+        except LispSymbolError:
+            continue # special forms, or names defined later on
+        if context_base_simple.get(name, names) is value:
+            continue # the receiving side has its own
+        names.append(name)
+        values.append(value)
+
+    return Context(names, values, outermost_context(proc.ctx))
+
+
+def restore_procedure(proc, state):
+    "Fills in an unpickled procedure."
+    from lisp.closure import CompiledProcedure, Compiler, Scope, global_context
+    from lisp.vm import VMProcedure
+
+    parms, body, ctx, _help, scope, proc.name, proc.location = state
+    proc.parms, proc.body, proc.ctx, proc.help = parms, body, ctx, _help
+    if isinstance(proc, CompiledProcedure):
+        proc.scope = Scope(parms, is_procedure=True) if scope is None else scope
+
+        def compile_body(frame):
+            proc.code = Compiler(global_context(ctx), body).compile_body(parms, body, proc.scope)
+            return proc.code(frame)
+        proc.code = compile_body
+    elif isinstance(proc, VMProcedure):
+        proc.scope = Scope(parms, is_procedure=True) if scope is None else scope
+        proc.genv, proc.code = global_context(ctx), None
+
+
+class LispPickler(pickle.Pickler):
+    """
+    Pickles procedures with the values they captured, or with their whole
+    environment if `snapshot`.
+    """
+    def __init__(self, file, snapshot=False):
+        from lisp.compiler import Context, Procedure
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.Context, self.Procedure = Context, Procedure
+        self.builtins = builtin_names()
+        self.snapshot = snapshot
+
+    def persistent_id(self, obj):
+        if type(obj) is self.Context and obj.outer is None:
+            return GLOBAL_ENV
+        return None
+
+    def reducer_override(self, obj):
+        if isinstance(obj, self.Procedure):
+            if self.snapshot:
+                env, scope = obj.ctx, getattr(obj, "scope", None)
+            else:
+                env, scope = captured(obj), None
+            state = (obj.parms, obj.body, env, obj.help, scope, obj.name, obj.location)
+            return object.__new__, (type(obj),), state, None, None, restore_procedure
+
+        name = self.builtins.get(id(obj))
+        if name is not None:
+            return builtin, (name,)
+
+        return NotImplemented
+
+
+class LispUnpickler(pickle.Unpickler):
+    def __init__(self, file, env):
+        super().__init__(file)
+        self.env = env
+
+    def persistent_load(self, pid):
+        if pid != GLOBAL_ENV:
+            raise pickle.UnpicklingError(f"unknown persistent id {pid}")
+        return self.env
+
+
+def dumps(obj, snapshot=False) -> bytes:
+    f = io.BytesIO()
+    LispPickler(f, snapshot).dump(obj)
+    return f.getvalue()
+
+def loads(data: bytes, env):
+    "Unpickles `data`, linking the procedures in it to the global Context `env`."
+    return LispUnpickler(io.BytesIO(data), env).load()
@@ -0,0 +1,452 @@
+"""
+An eval server.
+
+Loading the stdlib takes most of the time of a short program, so the
+server loads it once and keeps it. Every session gets a fork of it (see
+Context.fork), so its defines don't change the other sessions, nor the
+stdlib. A request without a session runs in a fork thrown away
+afterwards.
+
+Requests and responses are frames: a 4-byte big-endian length, then
+that many bytes of a JSON object.
+
+    {"id": 1, "program": "(define x 2) (* x 21)", "session": "s",
+     "result": "str", "timeout": 5}
+    {"id": 1, "ok": true, "value": "42", "output": "", "seconds": 0.0003}
+    {"id": 1, "ok": false, "error": "LispSymbolError", "message": "unbound symbol: y", ...}
+
+`result` is "str" for the value as the REPL prints it, "json" for the
+value as JSON (lists, maps and sets as arrays, anything else JSON has
+no type for as its text), or "none". What the program prints comes
+back in `output`. A program still running after `timeout` seconds is
+interrupted. `{"op": "stats"}` returns the number of requests, the
+queue depth and latency percentiles; `{"op": "close", "session": "s"}`
+forgets a session.
+
+Programs run on a pool of threads, a session one request at a time.
+A connection can send a request before the response to the previous
+one: responses come back as they are ready, with the `id` of their
+request.
+
+    python -m lisp.server --port 7654
+    python -m lisp.server --unix /tmp/lisp.sock --workers 8
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import io
+import itertools
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+from lisp.compiler import Context, LispError, Print, eval_program
+from lisp.hamt import HashMap, HashSet
+from lisp.lazy import LazySeq
+from lisp.numarray import NumArray
+from lisp.rlist import RList
+
+HEADER = struct.Struct(">I")
+MAX_FRAME = 1 << 24 # bytes
+
+TIMEOUT = 30 # seconds, for a request that doesn't say
+SESSION_TTL = 600 # seconds a session is kept without requests
+WINDOW = 1000 # latest requests the latency percentiles are about
+RESULTS = ("str", "json", "none")
+
+
+class RequestError(Exception):
+    "A request the server can't make sense of."
+
+class Interrupted(BaseException):
+    """
+    Raised in the thread of an evaluation past its timeout. Like
+    KeyboardInterrupt, no `except Exception` catches it.
+    """
+
+
+def frame(obj) -> bytes:
+    data = json.dumps(obj).encode()
+    return HEADER.pack(len(data)) + data
+
+async def read_frame(reader) -> dict:
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size > MAX_FRAME:
+        raise RequestError(f"a frame of {size} bytes, the most is {MAX_FRAME}")
+    return json.loads(await reader.readexactly(size))
+
+
+def to_json(x):
+    if x is None or isinstance(x, (bool, int, float, str)):
+        return x
+    if isinstance(x, (list, tuple, RList, LazySeq, NumArray, HashMap, HashSet)):
+        return [to_json(y) for y in x]
+    return str(x)
+
+def encode(value, result):
+    if result == "str":
+        return str(value)
+    if result == "json":
+        return to_json(value)
+    return None
+
+
+class Output():
+    """
+    Stands for sys.stdout: what a thread writes while it has a `buffer`
+    goes there, the rest to the real stdout.
+    """
+    def __init__(self, stdout):
+        self.stdout, self.local = stdout, threading.local()
+
+    def target(self):
+        buffer = getattr(self.local, "buffer", None)
+        return self.stdout if buffer is None else buffer
+
+    def write(self, s):
+        return self.target().write(s)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+_output_lock = threading.Lock()
+
+@contextlib.contextmanager
+def captured_output():
+    "What this thread prints, in a StringIO."
+    with _output_lock:
+        if not isinstance(sys.stdout, Output):
+            sys.stdout = Output(sys.stdout)
+        output = sys.stdout
+    output.local.buffer = io.StringIO()
+    try:
+        yield output.local.buffer
+    finally:
+        output.local.buffer = None
+
+
+class Job():
+    "An evaluation on the pool, that can be interrupted."
+    def __init__(self, server):
+        self.server, self.lock = server, threading.Lock()
+        self.thread, self.cancelled = None, False
+
+    def run(self, func, *args):
+        with self.server.counter_lock:
+            self.server.running += 1
+        try:
+            try:
+                with self.lock:
+                    if self.cancelled:
+                        return None
+                    self.thread = threading.get_ident()
+                return func(*args)
+            except Interrupted:
+                return None # nobody waits for the result anymore
+            finally:
+                # An interrupt sent as `func` returned may not have been
+                # raised yet: clear it, or drop it if it is raised now.
+                while True:
+                    try:
+                        with self.lock:
+                            if self.thread is not None and self.cancelled:
+                                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                                    ctypes.c_ulong(self.thread), None)
+                            self.thread = None
+                        break
+                    except Interrupted:
+                        pass
+        finally:
+            with self.server.counter_lock:
+                self.server.running -= 1
+
+    def interrupt(self):
+        "Raises Interrupted in the thread running the job, once, unless it is done."
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            if self.thread is not None:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                    ctypes.c_ulong(self.thread), ctypes.py_object(Interrupted))
+
+
+class Session():
+    def __init__(self, env: Context):
+        self.ctx = env.fork()
+        self.lock = asyncio.Lock()
+        self.used = time.monotonic()
+
+
+class Stats():
+    def __init__(self):
+        self.requests = self.errors = self.timeouts = 0
+        self.latencies = collections.deque(maxlen=WINDOW)
+
+    def record(self, response):
+        self.requests += 1
+        self.errors += not response["ok"]
+        self.timeouts += response.get("error") == "Timeout"
+        self.latencies.append(response["seconds"])
+
+    def latency(self) -> dict:
+        if not self.latencies:
+            return {}
+        ordered = sorted(self.latencies)
+        def percentile(p):
+            return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+        return {"mean": sum(ordered) / len(ordered), "p50": percentile(50),
+                "p95": percentile(95), "p99": percentile(99), "max": ordered[-1]}
+
+
+class Server():
+    """
+    Serves evaluations in `mode` (see lisp.compiler.evaluator) on a pool
+    of `workers` threads.
+    """
+    def __init__(self, mode="closure", workers=4, opt_level=0):
+        from lisp.cache import load_stdlib
+        self.mode, self.opt_level = mode, opt_level
+        self.env = load_stdlib(mode)
+        self.pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="lisp-eval")
+        self.sessions = dict()
+        self.stats = Stats()
+        self.pending = 0 # requests sent to the pool and not done yet
+        self.running, self.counter_lock = 0, threading.Lock()
+        self.server = self.loop = self.thread = None
+        self.writers = set() # of the open connections
+
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        "Listens on `path`, a Unix socket, or on `host`:`port`; the address."
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.connection, path)
+        else:
+            self.server = await asyncio.start_server(self.connection, host, port)
+        return self.address
+
+    @property
+    def address(self):
+        sockname = self.server.sockets[0].getsockname()
+        return sockname if isinstance(sockname, str) else sockname[:2]
+
+    def start_thread(self, host="127.0.0.1", port=0, path=None):
+        "Serves from a daemon thread of its own; the address."
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        return asyncio.run_coroutine_threadsafe(self.start(host, port, path), self.loop).result()
+
+    def close(self):
+        if self.thread is not None:
+            asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.thread = None
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def stop(self):
+        "Stops listening and drops the connections."
+        self.server.close()
+        for writer in self.writers:
+            writer.close() # their connection sees the end of the stream
+        others = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        await asyncio.gather(*others, return_exceptions=True)
+
+    async def connection(self, reader, writer):
+        tasks = set()
+        self.writers.add(writer)
+        try:
+            while True:
+                try:
+                    request = await read_frame(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (RequestError, ValueError) as e:
+                    # The stream may be out of step with the frames: give up on it
+                    writer.write(frame({"id": None, "ok": False, "error": "RequestError",
+                                        "message": str(e)}))
+                    break
+                task = asyncio.create_task(self.respond(request, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def respond(self, request, writer):
+        start = time.perf_counter()
+        try:
+            if not isinstance(request, dict):
+                raise RequestError(f"a request must be a JSON object, not {request!r}")
+            response = await self.handle(request)
+        except RequestError as e:
+            response = {"ok": False, "error": "RequestError", "message": str(e)}
+        response["id"] = request.get("id") if isinstance(request, dict) else None
+        response["seconds"] = time.perf_counter() - start
+        self.stats.record(response)
+
+        writer.write(frame(response))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass # the client is gone
+
+    async def handle(self, request) -> dict:
+        op = request.get("op", "eval")
+        if op == "stats":
+            return {"ok": True, "value": self.report()}
+        if op == "close":
+            self.sessions.pop(request.get("session"), None)
+            return {"ok": True, "value": None}
+        if op != "eval":
+            raise RequestError(f"unknown op {op!r}")
+
+        program, result = request.get("program"), request.get("result", "str")
+        timeout = request.get("timeout", TIMEOUT)
+        if not isinstance(program, str):
+            raise RequestError("an eval request needs the text of a `program`")
+        if result not in RESULTS:
+            raise RequestError(f"`result` must be one of {', '.join(RESULTS)} (given: {result!r})")
+        if timeout is not None and not isinstance(timeout, (int, float)):
+            raise RequestError(f"`timeout` must be a number of seconds (given: {timeout!r})")
+
+        session = self.session(request.get("session"))
+        async with session.lock:
+            job = Job(self)
+            future = asyncio.get_running_loop().run_in_executor(
+                self.pool, job.run, self.evaluate, session.ctx, program, result)
+            self.pending += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                job.interrupt()
+                await future # the session is free again once its thread is out
+                return {"ok": False, "error": "Timeout", "output": "",
+                        "message": f"still running after {timeout} seconds"}
+            finally:
+                self.pending -= 1
+
+    def session(self, name) -> Session:
+        if name is None:
+            return Session(self.env)
+
+        now = time.monotonic()
+        for other in [k for k, s in self.sessions.items()
+                      if now - s.used > SESSION_TTL and not s.lock.locked()]:
+            del self.sessions[other]
+
+        if name not in self.sessions:
+            self.sessions[name] = Session(self.env)
+        self.sessions[name].used = now
+        return self.sessions[name]
+
+    def evaluate(self, ctx, program, result) -> dict:
+        "Runs on the pool."
+        with captured_output() as output:
+            try:
+                value = eval_program(program, ctx, Print.NOTHING, returns="val",
+                                     mode=self.mode, opt_level=self.opt_level)
+                response = {"ok": True, "value": encode(value, result)}
+            except Exception as e:
+                response = {"ok": False, "error": type(e).__name__, "message": str(e)}
+        response["output"] = output.getvalue()
+        return response
+
+    def report(self) -> dict:
+        with self.counter_lock:
+            running = self.running
+        return {"requests": self.stats.requests, "errors": self.stats.errors,
+                "timeouts": self.stats.timeouts, "sessions": len(self.sessions),
+                "running": running, "queued": max(0, self.pending - running),
+                "latency": self.stats.latency()}
+
+
+class Client():
+    """
+    A blocking client. `address` is a (host, port) pair or the path of a
+    Unix socket.
+    """
+    def __init__(self, address):
+        if isinstance(address, (str, os.PathLike)):
+            self.sock = socket.socket(socket.AF_UNIX)
+            self.sock.connect(os.fspath(address))
+        else:
+            self.sock = socket.create_connection(tuple(address))
+        self.ids = itertools.count()
+
+    def request(self, **fields) -> dict:
+        fields["id"] = next(self.ids)
+        self.sock.sendall(frame(fields))
+        size, = HEADER.unpack(self.receive(HEADER.size))
+        return json.loads(self.receive(size))
+
+    def receive(self, size) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("the server closed the connection")
+            data += chunk
+        return data
+
+    def eval(self, program, session=None, result="str", timeout=TIMEOUT):
+        "The value of `program`; raises a LispError if it fails."
+        response = self.request(program=program, session=session, result=result, timeout=timeout)
+        if not response["ok"]:
+            raise LispError(f"{response['error']}: {response['message']}")
+        return response["value"]
+
+    def stats(self) -> dict:
+        return self.request(op="stats")["value"]
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluates Lisp programs sent over a socket.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7654)
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix socket instead")
+    parser.add_argument("--mode", default="closure", choices=("tree", "closure", "vm"))
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("-O", "--opt-level", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = Server(args.mode, args.workers, args.opt_level)
+
+    async def serve():
+        address = await server.start(args.host, args.port, args.unix)
+        print(f"listening on {address}")
+        async with server.server:
+            await server.server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Strings.
+
+Adding strings with `+` copies them: building a text one `+` at a time,
+in a `fold` over a list, copies what is already built at every step.
+These builtins build it in one go instead:
+
+    (string-join (map show xs) ", ")       "1, 2, 3"
+    (string-split "a b  c")                ("a" "b" "c")
+    (substring "mandelbrot" 0 6)           "mandel"
+    (format "{} x {} = {:.2f}" 2 3 6)       "2 x 3 = 6.00"
+    (string->list "abc")                   ("a" "b" "c")
+
+A string builder collects the pieces of a text and joins them once, at
+the end, with `sb->string`; `sb-append` adds any number of them, and
+values that aren't strings as `show` prints them.
+
+    (sb->string (fold (lambda (x sb) (sb-append sb (show x) " "))
+                      (string-builder) xs))
+"""
+from lisp.utils import lisp_error, text
+
+
+class StringBuilder():
+    __slots__ = ("parts",)
+
+    def __init__(self):
+        self.parts = []
+
+    def append(self, *xs) -> "StringBuilder":
+        parts = self.parts
+        for x in xs:
+            parts.append(x if isinstance(x, str) else str(x))
+        return self
+
+    def build(self) -> str:
+        if len(self.parts) > 1:
+            self.parts[:] = ["".join(self.parts)] # joined once, even if built again
+        return self.parts[0] if self.parts else ""
+
+    def __len__(self):
+        return len(self.build())
+
+    def __repr__(self):
+        return f"<string-builder {self.build()!r}>"
+
+
+def string(x, caller) -> str:
+    if not isinstance(x, str):
+        raise lisp_error(f"{caller} expects a string, got {x}")
+    return x
+
+def builder(sb, caller) -> StringBuilder:
+    if not isinstance(sb, StringBuilder):
+        raise lisp_error(f"{caller} expects a string builder, got {sb}")
+    return sb
+
+
+def string_split(s, sep=None) -> list:
+    "The pieces of `s` between `sep`, or between runs of whitespace."
+    if sep == "":
+        raise lisp_error("string-split: the separator can't be empty")
+    return string(s, "string-split").split(sep)
+
+def substring(s, start, end=None) -> str:
+    end = len(string(s, "substring")) if end is None else end
+    if not 0 <= start <= end <= len(s):
+        raise lisp_error(f"substring: {start}..{end} is out of a string of length {len(s)}")
+    return s[start:end]
+
+def format_string(fmt, *args) -> str:
+    "`fmt` with every {} replaced by the next argument, as str.format does."
+    try:
+        return string(fmt, "format").format(*args)
+    except (IndexError, KeyError, ValueError) as e:
+        raise lisp_error(f"format: {e} in {fmt!r}") from None
+
+
+builtins = {
+    "string-join": lambda xs, sep="": string(sep, "string-join").join(map(text, xs)),
+    "string-split": string_split,
+    "substring": substring,
+    "format": format_string,
+    "string->list": lambda s: list(string(s, "string->list")),
+    "string-builder": StringBuilder,
+    "sb-append": lambda sb, *xs: builder(sb, "sb-append").append(*xs),
+    "sb->string": lambda sb: builder(sb, "sb->string").build(),
+    "string-builder?": lambda x: isinstance(x, StringBuilder),
+}
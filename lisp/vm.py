@@ -0,0 +1,548 @@
+"""
+Bytecode compiler and virtual machine.
+
+An expression is compiled to a `Code`: a flat list of instructions, each
+an opcode followed by its argument, with the constants and the global
+names it refers to kept apart in pools. `run` executes it on a value
+stack. Variables are resolved while compiling, like in lisp.closure
+(whose `Scope` and `Frame` are used here too): a local is read from a
+fixed (depth, slot) address of the current frame.
+
+A call to a procedure compiled here doesn't recurse in Python: the
+caller is pushed on an explicit call stack, and popped when the callee
+returns. Deep non-tail recursion is then only limited by memory, and a
+tail call replaces the current frame without pushing anything. Builtins
+calling a procedure (`map`, `fold`...) run it in a VM loop of its own.
+
+The code of a whole program is a `Module`, which pickles to a file and
+runs later without being parsed or compiled again:
+
+    python -m lisp.vm compile program.lisp -o program.lispc
+    python -m lisp.vm run program.lispc
+
+Hooks don't see the calls made by the VM.
+"""
+import argparse
+import pathlib
+import pickle
+
+from lisp.compiler import *
+from lisp import macro
+from lisp.closure import Frame, Scope, global_context
+
+# Opcodes
+CONST = 0        # push consts[arg]
+LOCAL = 1        # push slot arg of the current frame
+OUTER = 2        # push slot (arg & 0xffff) of the frame (arg >> 16) levels out
+GLOBAL = 3       # push the global names[arg]
+CALL = 4         # call the value below arg arguments with them
+TAIL_CALL = 5    # the same, returning what it returns
+RETURN = 6       # return the top of the stack
+JUMP = 7         # go to arg
+JUMP_IF_FALSE = 8
+POP = 9
+LIST = 10        # replace the top arg values with a list of them
+DEFINE = 11      # bind the global names[arg] to the top of the stack
+MAKE_PROC = 12   # push a procedure of the Code consts[arg]
+ENTER = 13       # open a frame for the Scope consts[arg]
+STORE = 14       # pop into slot arg of the current frame
+LEAVE = 15       # back to the frame around the current one
+CURRY = 16       # turn the top of the stack into a curried procedure
+EVAL_CODE = 17   # run consts[arg], compiled on first use, in the current frame
+EVAL_SOURCE = 18 # compile and run the program on top of the stack
+DEBUG = 19
+PROFILE = 20
+PRINT = 21       # print the top of the stack, leaving it there
+RAISE = 22       # raise consts[arg] = (exception type, message)
+
+OPNAMES = {globals()[name]: name for name in """
+    CONST LOCAL OUTER GLOBAL CALL TAIL_CALL RETURN JUMP JUMP_IF_FALSE POP LIST DEFINE
+    MAKE_PROC ENTER STORE LEAVE CURRY EVAL_CODE EVAL_SOURCE DEBUG PROFILE PRINT RAISE""".split()}
+
+
+class Code():
+    """
+    Compiled code: `ops` alternates opcodes and their arguments. The code
+    of a lambda also has its parameters, body, scope and location.
+    """
+    def __init__(self):
+        self.ops, self.consts, self.names = [], [], []
+        self._consts, self._names = dict(), dict() # value -> index, while compiling
+        self.parms = self.body = self.scope = self.location = None
+        self.has_help = False
+
+    def const(self, value) -> int:
+        # Only the values equal just when they are the same are shared
+        key = (type(value), value) if type(value) in (int, str, Symbol) else id(value)
+        index = self._consts.get(key)
+        if index is None:
+            index = len(self.consts)
+            self.consts.append(value)
+            self._consts[key] = index
+        return index
+
+    def name(self, name) -> int:
+        index = self._names.get(name)
+        if index is None:
+            index = self._names[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def emit(self, op, arg=0) -> int:
+        "Appends an instruction; its position, to patch its argument later."
+        self.ops += (op, arg)
+        return len(self.ops) - 1
+
+    def here(self) -> int:
+        return len(self.ops)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_consts"], state["_names"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, _consts=dict(), _names=dict())
+
+
+def dis(code: Code) -> str:
+    "A listing of the instructions of `code`."
+    lines = []
+    for pc in range(0, len(code.ops), 2):
+        op, arg = code.ops[pc], code.ops[pc + 1]
+        note = ""
+        if op in (CONST, MAKE_PROC, EVAL_CODE, RAISE, DEBUG):
+            note = f"  ({ast_to_str(code.consts[arg]) if op == CONST else type(code.consts[arg]).__name__})"
+        elif op in (GLOBAL, DEFINE):
+            note = f"  ({code.names[arg]})"
+        elif op == OUTER:
+            note = f"  (depth {arg >> 16}, slot {arg & 0xffff})"
+        lines.append(f"{pc:5d} {OPNAMES[op]:<13} {arg}{note}")
+    return "\n".join(lines)
+
+
+class VMProcedure(Procedure):
+    "A procedure whose body has been compiled to bytecode."
+    def __init__(self, code: Code, ctx, genv, _help=None):
+        self.parms, self.body, self.ctx = code.parms, code.body, ctx
+        self.code, self.scope, self.genv = code, code.scope, genv
+        self.help = _help
+        self.name, self.location = None, code.location
+
+    def __call__(self, *args):
+        return run(self.code or procedure_code(self),
+                   Frame(check_arity(self, args), self.ctx, self.scope), self.genv)
+
+
+def procedure_code(proc) -> Code:
+    "The code of a procedure just unpickled, compiled on its first call."
+    proc.code = compile_lambda(["lambda", proc.parms, proc.body], proc.scope.parent)
+    return proc.code
+
+def check_arity(proc, args):
+    if len(args) != len(proc.parms):
+        raise LispError(f"procedure {ast_to_str(proc.parms)} expects "
+                        f"{len(proc.parms)} arguments, given {len(args)}")
+    return args
+
+#######################################
+
+class Compiler():
+    """
+    Compiles ASTs to bytecode. Every method compiling a node emits its
+    instructions into `code`; `tail` is True when the node's value is
+    the value of the whole code, in which case its instructions end by
+    returning.
+    """
+    def __init__(self, code: Code):
+        self.code = code
+
+    def compile(self, ast, scope: Scope = None, tail=False):
+        code = self.code
+        if isinstance(ast, Symbol):
+            self.compile_symbol(ast, scope)
+        elif isinstance(ast, (*Number, str)):
+            code.emit(CONST, code.const(ast))
+        elif isinstance(ast, list):
+            if len(ast) == 0:
+                code.emit(LIST, 0)
+            elif isinstance(ast[0], str) and ast[0] in SPECIAL_FORMS:
+                SPECIAL_FORMS[ast[0]](self, ast, scope, tail)
+                return # the form took care of returning
+            else:
+                self.compile_call(ast, scope, tail)
+                return
+        else:
+            raise LispError("Unknwown type")
+
+        if tail:
+            code.emit(RETURN)
+
+    def compile_symbol(self, name, scope):
+        where = None if scope is None else scope.resolve(name)
+        if where is None:
+            self.code.emit(GLOBAL, self.code.name(name))
+        elif where[0] == 0:
+            self.code.emit(LOCAL, where[1])
+        else:
+            self.code.emit(OUTER, where[0] << 16 | where[1])
+
+    def compile_call(self, ast, scope, tail):
+        for x in ast:
+            self.compile(x, scope)
+        self.code.emit(TAIL_CALL if tail else CALL, len(ast) - 1)
+
+    def compile_value(self, value, tail):
+        self.code.emit(CONST, self.code.const(value))
+        if tail:
+            self.code.emit(RETURN)
+
+    #######################################
+
+    def compile_quote(self, ast, scope, tail):
+        self.compile_value(ast[1], tail)
+
+    def compile_list(self, ast, scope, tail):
+        for x in ast[1:]:
+            self.compile(x, scope)
+        self.code.emit(LIST, len(ast) - 1)
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_lambda(self, ast, scope, tail):
+        if len(ast[1:]) == 3:
+            self.compile(ast[2], scope)
+        elif len(ast[1:]) != 2:
+            raise LispError(f"lambda expects 2/3 arguments, were given {len(ast[1:])}")
+        self.code.emit(MAKE_PROC, self.code.const(compile_lambda(ast, scope)))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_define(self, ast, scope, tail):
+        self.compile(ast[2], scope)
+        self.code.emit(DEFINE, self.code.name(ast[1]))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_cond(self, ast, scope, tail):
+        code, ends = self.code, []
+        for clause in ast[1:]:
+            self.compile(clause[0], scope)
+            skip = code.emit(JUMP_IF_FALSE)
+            self.compile(clause[1], scope, tail)
+            if not tail:
+                ends.append(code.emit(JUMP))
+            code.ops[skip] = code.here()
+        code.emit(RAISE, code.const((AssertionError, f"{ast_to_str(ast[-1][0])} should evaluate to T!")))
+        for end in ends:
+            code.ops[end] = code.here()
+
+    def compile_if(self, ast, scope, tail):
+        code = self.code
+        self.compile(ast[1], scope)
+        skip = code.emit(JUMP_IF_FALSE)
+        self.compile(ast[2], scope, tail)
+        end = None if tail else code.emit(JUMP)
+        code.ops[skip] = code.here()
+        if len(ast) < 4:
+            code.emit(RAISE, code.const((LispError, f"missing else branch in {ast_to_str(ast)}")))
+        else:
+            self.compile(ast[3], scope, tail)
+        if end is not None:
+            code.ops[end] = code.here()
+
+    def compile_begin(self, ast, scope, tail):
+        if len(ast) < 2:
+            raise LispError("begin expects at least one expression")
+        for x in ast[1:-1]:
+            self.compile(x, scope)
+            self.code.emit(POP)
+        self.compile(ast[-1], scope, tail)
+
+    def compile_curry(self, ast, scope, tail):
+        partial = ast[1]
+        self.compile(partial[0], scope)
+        # The arity is only known at runtime: the lambda is compiled then
+        self.code.emit(CURRY, self.code.const([partial, scope, dict()]))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_let(self, ast, scope, tail):
+        if len(ast) == 3:
+            bindings, body = [(clause[0], clause[1]) for clause in ast[1]], ast[2]
+        else:
+            bindings, body = [(ast[1], ast[2])], ast[3]
+
+        code = self.code
+        inner = Scope(dict.fromkeys(name for name, _ in bindings), scope)
+        code.emit(ENTER, code.const(inner))
+        bound = set()
+        for name, value in bindings:
+            self.compile(value, inner.view(len(bound)))
+            code.emit(STORE, inner.slots[name])
+            bound.add(name)
+        self.compile(body, inner, tail)
+        if not tail:
+            code.emit(LEAVE)
+
+    def compile_debug(self, ast, scope, tail):
+        self.code.emit(DEBUG, self.code.const(ast[1]))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_eval(self, ast, scope, tail):
+        self.compile(ast[1], scope, tail)
+
+    def compile_evalS(self, ast, scope, tail):
+        code = self.code
+        if isinstance(ast[1], list) and len(ast[1]) > 0 and ast[1][0] == "string":
+            code.emit(EVAL_CODE, code.const([ast[1], scope, None]))
+        else:
+            self.compile(ast[1], scope)
+            code.emit(EVAL_SOURCE, code.const(scope))
+        if tail:
+            code.emit(RETURN)
+
+    def compile_profile(self, ast, scope, tail):
+        body = Code()
+        Compiler(body).compile(ast[1], scope, tail=True)
+        self.code.emit(PROFILE, self.code.const(body))
+        if tail:
+            self.code.emit(RETURN)
+
+    def compile_print(self, ast, scope, tail):
+        self.compile(ast[1], scope)
+        self.code.emit(PRINT)
+        if tail:
+            self.code.emit(RETURN)
+
+
+SPECIAL_FORMS = {
+    "quote": Compiler.compile_quote,
+    "string": Compiler.compile_quote,
+    "list": Compiler.compile_list,
+    "lambda": Compiler.compile_lambda,
+    "define": Compiler.compile_define,
+    "cond": Compiler.compile_cond,
+    "if": Compiler.compile_if,
+    "begin": Compiler.compile_begin,
+    "curry": Compiler.compile_curry,
+    "let": Compiler.compile_let,
+    "debug": Compiler.compile_debug,
+    "eval": Compiler.compile_eval,
+    "evalS": Compiler.compile_evalS,
+    "profile": Compiler.compile_profile,
+    "print": Compiler.compile_print,
+}
+
+
+def compile_code(ast, scope: Scope = None) -> Code:
+    "The code of `ast`, run in a frame of `scope`, returning its value."
+    code = Code()
+    Compiler(code).compile(ast, scope, tail=True)
+    return code
+
+def compile_lambda(ast, scope: Scope = None) -> Code:
+    "The code of the body of the lambda `ast`, defined in `scope`."
+    parms, body = ast[1], ast[-1]
+    inner = Scope(parms, scope, is_procedure=True)
+    code = compile_code(body, inner)
+    code.parms, code.body, code.scope = parms, body, inner
+    code.location, code.has_help = getattr(ast, "location", None), len(ast) == 4
+    return code
+
+#######################################
+
+def run(code: Code, frame, genv):
+    "Runs `code` in `frame`, whose globals are in the Context `genv`."
+    ops, consts, names = code.ops, code.consts, code.names
+    stack, calls = [], [] # values; the callers, as (code, pc, frame, genv)
+    pc = 0
+
+    while True:
+        op, arg = ops[pc], ops[pc + 1]
+        pc += 2
+
+        if op == LOCAL:
+            stack.append(frame.slots[arg])
+        elif op == GLOBAL:
+            name = names[arg]
+            try:
+                stack.append(genv[name])
+            except KeyError:
+                stack.append(genv.find(name))
+        elif op == CONST:
+            stack.append(consts[arg])
+
+        elif op == CALL or op == TAIL_CALL:
+            f = stack[-arg - 1]
+            args = stack[len(stack) - arg:]
+            del stack[-arg - 1:]
+            if type(f) is VMProcedure:
+                if op == CALL:
+                    calls.append((code, pc, frame, genv))
+                code, genv = f.code or procedure_code(f), f.genv
+                ops, consts, names = code.ops, code.consts, code.names
+                frame, pc = Frame(check_arity(f, args), f.ctx, f.scope), 0
+            elif op == CALL:
+                stack.append(f(*args))
+            else: # returning what a builtin returns
+                stack.append(f(*args))
+                if not calls:
+                    return stack.pop()
+                code, pc, frame, genv = calls.pop()
+                ops, consts, names = code.ops, code.consts, code.names
+
+        elif op == RETURN:
+            if not calls:
+                return stack.pop()
+            code, pc, frame, genv = calls.pop()
+            ops, consts, names = code.ops, code.consts, code.names
+
+        elif op == JUMP_IF_FALSE:
+            if not stack.pop():
+                pc = arg
+        elif op == JUMP:
+            pc = arg
+        elif op == OUTER:
+            f = frame
+            for _ in range(arg >> 16):
+                f = f.outer
+            stack.append(f.slots[arg & 0xffff])
+        elif op == POP:
+            stack.pop()
+        elif op == LIST:
+            if arg:
+                values = stack[-arg:]
+                del stack[-arg:]
+                stack.append(values)
+            else:
+                stack.append([])
+        elif op == ENTER:
+            scope = consts[arg]
+            frame = Frame([None] * len(scope.names), frame, scope)
+        elif op == STORE:
+            frame.slots[arg] = named(stack.pop(), frame.scope.names[arg])
+        elif op == LEAVE:
+            frame = frame.outer
+        elif op == MAKE_PROC:
+            lambda_code = consts[arg]
+            _help = stack.pop() if lambda_code.has_help else None
+            stack.append(VMProcedure(lambda_code, frame, genv, _help))
+        elif op == DEFINE:
+            name = names[arg]
+            genv.outermost_add(name, named(stack.pop(), name))
+            stack.append(name)
+
+        elif op == EVAL_CODE or op == EVAL_SOURCE:
+            if op == EVAL_CODE:
+                literal = consts[arg]
+                if literal[2] is None:
+                    program = macro.expand_source(literal[0], literal[0][1], genv, eval_vm)
+                    literal[2] = compile_code(program, literal[1])
+                evaluated = literal[2]
+            else:
+                program = stack.pop()
+                if isinstance(program, list) and len(program) > 0 and program[0] == "string":
+                    program = program[1]
+                if not isinstance(program, str):
+                    raise LispError(f"evalS expects a string, got {program}")
+                evaluated = compile_code(macro.expand(parse(program), genv, eval_vm), consts[arg])
+            # Runs like a call, in the same frame
+            calls.append((code, pc, frame, genv))
+            code, pc = evaluated, 0
+            ops, consts, names = code.ops, code.consts, code.names
+
+        elif op == CURRY:
+            partial, scope, by_arity = consts[arg]
+            function_arity = deduce_arity(stack.pop())
+            if function_arity not in by_arity:
+                missing = [Symbol(c) for c in "abcdefghij"[:function_arity - (len(partial) - 1)]]
+                by_arity[function_arity] = compile_lambda(["lambda", missing, partial + missing], scope)
+            stack.append(VMProcedure(by_arity[function_arity], frame, genv))
+        elif op == PRINT:
+            print(stack[-1])
+        elif op == DEBUG:
+            stack.append(eval_free(["debug", consts[arg]], frame))
+        elif op == PROFILE:
+            from lisp import profiler
+            body = consts[arg]
+            stack.append(profiler.profile_form(lambda: run(body, frame, genv)))
+        elif op == RAISE:
+            exc_type, message = consts[arg]
+            raise exc_type(message)
+        else:
+            raise LispError(f"unknown opcode {op}")
+
+
+def eval_vm(ast, context):
+    "Compiles `ast` to bytecode and runs it in `context`."
+    scope = context.scope if isinstance(context, Frame) else None
+    return run(compile_code(ast, scope), context, global_context(context))
+
+#######################################
+
+MAGIC = b"mylisp-bytecode 1\n"
+
+class Module():
+    "The code of the top-level forms of a program, in order."
+    def __init__(self, codes: list, source: str = None):
+        self.codes, self.source = codes, source
+
+    def run(self, ctx):
+        "Runs the forms in the global Context `ctx`; the value of the last one."
+        value = None
+        for code in self.codes:
+            value = run(code, ctx, ctx)
+        return value
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path) -> "Module":
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise LispError(f"{path} is not a bytecode module of this version")
+            return pickle.load(f)
+
+
+def compile_module(program, ctx=None) -> Module:
+    """
+    Compiles the top-level forms of `program` (source text, path or
+    stream) with the macros defined in `ctx`, the stdlib's by default.
+    """
+    if ctx is None:
+        from lisp.cache import load_stdlib
+        ctx = load_stdlib("vm")
+    codes = [compile_code(macro.expand(form, ctx, eval_vm)) for form in read_forms(program)]
+    return Module(codes, str(program) if isinstance(program, os.PathLike) else None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compiles Lisp programs to bytecode and runs them.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    comp = commands.add_parser("compile", help="compile a program to a module")
+    comp.add_argument("program")
+    comp.add_argument("-o", "--output", help="the module (default: the program, ending in .lispc)")
+    execute = commands.add_parser("run", help="run a compiled module")
+    execute.add_argument("module")
+    dump = commands.add_parser("dis", help="list the instructions of a compiled module")
+    dump.add_argument("module")
+    args = parser.parse_args(argv)
+
+    if args.command == "compile":
+        path = pathlib.Path(args.program)
+        Module.save(compile_module(path), args.output or path.with_suffix(".lispc"))
+    elif args.command == "run":
+        from lisp.cache import load_stdlib
+        Module.load(args.module).run(load_stdlib("vm"))
+    else:
+        for i, code in enumerate(Module.load(args.module).codes):
+            print(f"form {i}:\n{dis(code)}")
+
+
+if __name__ == "__main__":
+    main()
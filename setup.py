@@ -15,7 +15,7 @@ README = (HERE / "README.md").read_text()
 setup(
     name="mylisp",
     version="0.0.0.1",
-    description="my lisp"
+    description="my lisp",
     long_description=README,
     long_description_content_type="text/markdown",
     url="https://github.com/mattyonweb/<name>",
@@ -29,7 +29,7 @@ setup(
     ],
     packages=find_packages(),
     install_requires=[
-        "regex", "hypothesis"
+        "hypothesis"
     ],
     include_package_data=True, #TODO?
     # cmdclass={ #specifica azioni da intraprendere post-installazione
@@ -38,7 +38,9 @@ setup(
     # },
     entry_points={
         "console_scripts": [
-            "mylisp=<Project>.<filename-no-py>:<func-name>",
+            "mylisp=lisp.compiler:repl",
+            "mylisp-bench=benchmarks.suite:main",
+            "mylisp-server=lisp.server:main",
         ]
     },
     python_requires='>=3.9',
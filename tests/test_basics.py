@@ -1,17 +1,46 @@
 import unittest
+import contextlib
+import io
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+import unittest.mock
 from lisp.compiler import *
+from lisp import cache, compiler, hooks, lazy, macro, profiler
+from lisp.cache import load_stdlib
 from lisp.utils import *
 import random
 
+from hypothesis import given, strategies as st
+
+_environ = unittest.mock.patch.dict(os.environ)
+
+def setUpModule():
+    # The stdlib snapshots of the tests stay out of the user's cache
+    global _cache_dir
+    _cache_dir = tempfile.TemporaryDirectory()
+    _environ.start()
+    os.environ["MYLISP_CACHE_DIR"] = _cache_dir.name
+
+def tearDownModule():
+    _environ.stop()
+    _cache_dir.cleanup()
+
 class Basics(unittest.TestCase):
-    with open("lisp/stdlib.lisp", "r") as f:
-        userctx = eval_program(
-            f.read(),
-            what_to_print=Print.NOTHING
-        )
+    mode = "tree"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stdlib = load_stdlib(mode=cls.mode)
+
+    def setUp(self):
+        self.userctx = self.stdlib.fork() # defines stay in this test
 
     def eval(self, expr: str, debug=False):
-        return evalS(expr, context=Basics.userctx, debug=debug)
+        return evalS(expr, context=self.userctx, debug=debug, mode=self.mode)
 
     
     def evto(self, expr: str, obj: Any, debug=False, note:str=None):
@@ -25,12 +54,18 @@ class Basics(unittest.TestCase):
 
         return res
 
+    def evto_program(self, program, obj):
+        res = eval_program(program, self.userctx, what_to_print=Print.NOTHING,
+                           returns="val", mode=self.mode)
+        self.assertEqual(res, obj)
+        return res
+
     
     def compileError(self, expr,
                      exception_types: Union[Exception, Tuple]=None,
                      note:str=None):
         try:
-            evalS(expr, context=Basics.userctx)
+            evalS(expr, context=self.userctx, mode=self.mode)
         except Exception as e:
             if exception_types is None:
                 self.assertTrue(True)
@@ -57,7 +92,44 @@ class Basics(unittest.TestCase):
         self.evto("(* -2 (- 1 10))", +18)
 
     def test_wrong_parser(self):
-        pass #TODO
+        for source in ("(+ 1 2", ")", '"abc'):
+            with self.assertRaises(LispParseError):
+                self.eval(source)
+
+        # Errors point to where the problem starts
+        with self.assertRaisesRegex(LispParseError, "<string>:2:2"):
+            parse("(list 1\n (+ 2 3")
+
+    def test_reader(self):
+        self.assertEqual(parse("(a 'b \"c (d)\")"),
+                         ["a", ["quote", "b"], ["string", "c (d)"]])
+        self.assertEqual(parse("; comment\n(+ 1 2.5) ; trailing"), ["+", 1, 2.5])
+        self.assertIsInstance(parse("(foo)")[0], Symbol)
+
+        forms = list(Reader("(define x 1)\n;; doc\nx  '()"))
+        self.assertEqual(forms, [["define", "x", 1], "x", ["quote", []]])
+        self.assertEqual(parse("{a 1 b #{(c)}}"), ["hash-map", "a", 1, "b", ["hash-set", ["c"]]])
+        with self.assertRaisesRegex(LispParseError, "unexpected }"):
+            parse("(a }")
+
+    def test_streaming_reader(self):
+        with open("lisp/stdlib.lisp", "r") as f:
+            source = f.read()
+
+        # Tokens, strings and comments cut by chunk boundaries
+        for chunk_size in (1, 3, 64):
+            self.assertEqual(list(Reader(io.StringIO(source), chunk_size=chunk_size)),
+                             list(Reader(source)))
+
+        # Nested lambdas close in reverse order, across chunks too
+        source = "(define f\n  (lambda (x)\n    (lambda (y) (+ x y))))\n(lambda () 1)"
+        for reader in (Reader(source), Reader(io.StringIO(source), "<string>", 5)):
+            define, last = reader
+            self.assertEqual([define[2].location, define[2][2].location, last.location],
+                             ["<string>:2:3", "<string>:3:5", "<string>:4:1"])
+
+        self.evto_program(io.StringIO("(define streamed 41)\n(+ streamed 1)"), 42)
+        self.evto_program(pathlib.Path("tests/sample.file"), 20)
 
     def test_empty_lists(self):
         self.evto("()", [])
@@ -185,10 +257,653 @@ class Basics(unittest.TestCase):
 
         self.evto("(let ((h 1) (x (+ h 1))) x)", 2, note="Mutually binding let")
 
+    def test_let_shadowing(self):
+        self.evto("(let x 1 (let ((y x) (x 2)) (list x y)))", [2, 1])
+        self.evto("((lambda (x x) x) 1 2)", 2)
+
         
+    def test_tail_calls(self):
+        # Deeper than Python's recursion limit: only works if tail calls
+        # don't grow the stack
+        self.evto(
+            "(let count (lambda (n) (if (= n 0) 'done (count (- n 1)))) (count 5000))",
+            "done"
+        )
+        self.evto("(fact 1500)", self.eval("(* 1500 (fact 1499))"))
+        # So is the body of a let
+        self.evto("(let f (lambda (n) (let x n (if (= x 0) 'done (f (- x 1))))) (f 5000))",
+                  "done")
+
+    def test_tail_call_frames(self):
+        # A tail-recursive loop runs at the same frame-chain depth, and so
+        # in the same memory, whatever the number of iterations
+        self.eval("""
+          (define depth-after
+            (lambda (n) (if (= n 0) (debug depth) (depth-after (- n 1)))))""")
+        self.evto("(depth-after 10000)", self.eval("(depth-after 1)"))
+        self.evto("(let x 0 (depth-after 100))", self.eval("(depth-after 1)"))
+
+    def test_persistent_lists(self):
+        self.evto("(reverse (list 1 2 3))", [3, 2, 1])
+        self.evto("(tail (cons 0 '(1 2)))", [1, 2])
+        self.evto("(nth (seq 0 100) 57)", 57)
+        self.evto("(zip '(1 2) '(3 4))", [[2, 4], [1, 3]])
+        self.evto("(type? (cons 1 '()))", "lst")
+        self.evto("(empty-list? (tail (cons 1 '())))", True)
+
+    def test_lazy_sequences(self):
+        self.evto("(take 5 (iterate ++ 0))", [0, 1, 2, 3, 4])
+        self.evto("(take-while (lambda (x) (< x 20)) (iterate *2 1))", [1, 2, 4, 8, 16])
+        self.evto("(type? (map ++ (range 0 3)))", "seq")
+        self.evto("(= (range 0 5) (seq 0 5))", True)
+        self.evto("(nth (lazy-filter (lambda (x) (= (mod x 7) 0)) (range 1 100)) 2)", 21)
+        self.evto("(fold + 0 (map (lambda (x) (* x x)) (filter (lambda (x) (= (mod x 2) 0)) (range 0 10))))", 120)
+        self.evto("(take 2 (take 5 (lazy-map ++ (list 1 2 3))))", [2, 3])
+        self.evto("(cons 0 (range 1 3))", [0, 1, 2])
+        self.evto("(append 3 (map ++ (range 0 3)))", [1, 2, 3, 3])
+
+        # Stages only run once the sequence is walked, and forcing keeps the elements
+        self.eval("(define lazy-calls 0)")
+        self.eval("(define squares (map (lambda (x) (begin (define lazy-calls (++ lazy-calls)) (* x x))) (range 0 4)))")
+        self.evto("lazy-calls", 0)
+        self.evto("(list (head squares) (length squares) (force squares))", [0, 4, [0, 1, 4, 9]])
+        self.evto("lazy-calls", 4)
+
+    def test_hash_maps(self):
+        self.eval("(define ages {'ann 31 \"bob\" 27 (list 1 2) 'pair})")
+        self.evto("(list (get ages 'ann) (get ages 'bob) (get ages '(1 2)) (get ages (cons 1 '(2))))",
+                  [31, 27, "pair", "pair"])
+        self.evto("(list (get ages 'cid) (get ages 'cid 0) (contains? ages \"ann\"))", [False, 0, True])
+        self.evto("(type? ages)", "map")
+        self.evto("(= (assoc (dissoc ages 'ann) 'ann 31) ages)", True)
+        self.evto("(length (keys (assoc ages 'cid 40)))", 4)
+        self.evto("(length (keys ages))", 3) # untouched by assoc
+        self.evto("(fold + 0 (vals {'a 1 'b 2}))", 3)
+
+        self.evto("(type? #{1})", "set")
+        self.evto("(= (union #{1 2} #{2 3}) #{3 2 1})", True)
+        self.evto("(= (intersection #{1 2 '(3)} #{(list 3) 2 4}) #{2 '(3)})", True)
+        self.evto("(contains? (difference #{1 2} #{2}) 2)", False)
+        self.evto("(contains? #{(range 0 3)} (list 0 1 2))", True)
+        self.evto("(get (hash-map (array (list 1 2)) 'a) (list 1 2))", "a")
+        self.evto("(get (hash-map (array (list 1 2)) 'a) '(array (1 2)))", False)
+        self.evto("(contains? #{(array (list 1 2))} '(1 2))", True)
+        self.evto("(get {(map ++ (list 0 1)) 'lazy} '(1 2))", "lazy")
+        with self.assertRaises(LispError):
+            self.eval("(hash-map 1)")
+        with self.assertRaises(LispError):
+            self.eval("(get '(1 2) 1)")
+
+    def test_strings(self):
+        self.evto('(string-join (map show (list 1 2 3)) ", ")', "1, 2, 3")
+        self.evto('(string-join (list "a" (quote b)))', "ab")
+        self.evto('(list (string-split "a b  c") (string-split "a,,b" ","))', [["a", "b", "c"], ["a", "", "b"]])
+        self.evto('(list (substring "mandelbrot" 0 6) (substring "mandelbrot" 6))', ["mandel", "brot"])
+        self.evto('(format "{} x {} = {:.2f}" 2 3 6)', "2 x 3 = 6.00")
+        self.evto('(string->list "abc")', ["a", "b", "c"])
+        self.evto('(+ "a" "b" "c")', "abc")
+        with self.assertRaises(LispError):
+            self.eval('(substring "abc" 2 5)')
+        with self.assertRaises(LispError):
+            self.eval('(format "{} {}" 1)')
+
+        self.eval('(define sb (fold (lambda (x sb) (sb-append sb x " ")) (string-builder) (list 1 "b" 3)))')
+        self.evto("(sb->string sb)", "1 b 3 ")
+        self.evto('(sb->string (sb-append sb "!"))', "1 b 3 !")
+        self.evto("(type? sb)", "string-builder")
+        with self.assertRaises(LispError):
+            self.eval('(sb-append "not a builder" "x")')
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            text, image = os.path.join(tmp, "out.txt"), os.path.join(tmp, "out.pgm")
+            self.eval(f'(with-file "{text}" (lambda (f) (begin (write f "a ") (write-lines f (list 1 2)))))')
+            self.eval(f"(define f (open \"{text}\" 'a))")
+            self.eval('(write (flush f) "end")')
+            self.evto("(file? (close f))", True)
+            with open(text) as f:
+                self.assertEqual(f.read(), "a 1\n2\nend")
+            with self.assertRaises(LispError):
+                self.eval('(write f "more")')
+
+            self.eval(f'(write-pgm "{image}" (list (list 0 1 2) (array (list 3 4 5))) 3 2 5)')
+            with open(image, "rb") as f:
+                self.assertEqual(f.read(), b"P5\n3 2\n5\n" + bytes(range(6)))
+            self.eval(f'(write-ppm "{image}" (list 0 1 2 300 0 0) 2 1 300)')
+            with open(image, "rb") as f:
+                self.assertEqual(f.read(), b"P6\n2 1\n300\n\0\0\0\1\0\2\1\x2c\0\0\0\0")
+            with self.assertRaises(LispError): # over maxval
+                self.eval(f'(write-pgm "{image}" (list 0 1 9) 3 1 5)')
+            with self.assertRaises(LispError): # a pixel short
+                self.eval(f'(write-pgm "{image}" (list 0 1) 3 1 5)')
+
+    def test_help(self):
+        self.evto('(help (lambda (x) "Identity" x))', "Identity")
+        # Native builtins keep the help of their Lisp definitions
+        self.evto("(list (help length) (help reverse) (help empty-list?))",
+                  ["List length", "Reverse a list", "Checks if a list is empty."])
+        self.evto("(help +)", False)
+
+    def test_fork(self):
+        self.eval("(define base 1)")
+        self.eval("(define get-base (lambda () base))")
+        child = self.userctx.fork()
+        evalS("(define base 2)", child, mode=self.mode)
+        evalS("(define only-child 3)", child, mode=self.mode)
+        self.assertEqual(evalS("(list base (get-base) only-child (++ 1))", child, mode=self.mode),
+                         [2, 1, 3, 2])
+        self.evto("base", 1) # the parent's procedures see the parent
+        with self.assertRaises(LispSymbolError):
+            self.eval("only-child")
+
+        # The parent is frozen, a fork of the fork reads through both
+        with self.assertRaises(LispError):
+            self.eval("(define base 5)")
+        self.assertEqual(evalS("(list base only-child (get-base))", child.fork(), mode=self.mode),
+                         [2, 3, 1])
+        with self.assertRaises(LispError):
+            Context(["x"], [1], child).fork()
+
+    def test_complex_numbers(self):
+        self.evto("1+2i", 1+2j)
+        self.evto("(list -1.5-0.5i 2i)", [-1.5-0.5j, 2j])
+        self.evto("(* 1+2i 1+2i)", -3+4j)
+        self.evto("(+ 1 2i)", 1+2j)
+        self.evto("(magnitude 3+4i)", 5.0)
+        self.evto("(list (real-part 1+2i) (imag-part 1+2i))", [1.0, 2.0])
+        self.evto("(make-rectangular 1 2)", 1+2j)
+        self.evto("(type? 1+2i)", "number")
+        # Only tokens with digits are complex numbers
+        self.evto("'(i -i 1+i)", ["i", "-i", "1+i"])
+
+    def test_numeric_arrays(self):
+        self.evto("(+ (arange 0 4) 1)", [1, 2, 3, 4])
+        self.evto("(* 2 (array '(1 2.5)))", [2, 5.0])
+        self.evto("(< (arange 0 4) 2)", [1, 1, 0, 0])
+        self.evto("(where (> (arange 0 4) 1) (arange 0 4) 0)", [0, 0, 2, 3])
+        self.evto("(sum (linspace 0 1 5))", 2.5)
+        self.evto("(tile (arange 0 2) 2)", [0, 1, 0, 1])
+        self.evto("(repeat-each (arange 0 2) 2)", [0, 0, 1, 1])
+        self.evto("(type? (zeros 3))", "array")
+        with self.assertRaises(ValueError):
+            self.eval("(+ (arange 0 2) (arange 0 3))")
+
+    def test_parallel_map(self):
+        self.evto("(pmap fact (seq 0 6) 2 2)", [1, 1, 2, 6, 24, 120])
+        # Captured values travel with the procedure, and so do the
+        # procedures coming back
+        self.evto("(let k 10 (pmap (lambda (x) (+ x k)) (list 1 2 3) 2))", [11, 12, 13])
+        self.evto("(map (lambda (f) (f 1)) (pmap (lambda (x) (lambda (y) (+ x y))) '(1 2) 2))", [2, 3])
+        self.evto('(pfold (lambda (x acc) (+ acc x)) "" (map show (seq 0 10)) 2 3)', "0123456789")
+        self.evto("(pfold + 0 '() 2)", 0)
+        with self.assertRaisesRegex(LispError, r"pmap: cannot send lambda \(<string>:1:30\)"):
+            self.eval("(let f (compose ++ ++) (pmap (lambda (x) (f x)) '(1) 2))")
+        with self.assertRaisesRegex(LispError, "pmap: cannot send unsendable "):
+            self.eval("(define unsendable (let f (compose ++ ++) (lambda (x) (f x))))")
+            self.eval("(pmap unsendable '(1) 2)")
+
+    def test_memoize(self):
+        # Exponential without the cache
+        self.eval("(define memo-fib (memoize (lambda (n) (if (< n 2) n (+ (memo-fib (- n 1)) (memo-fib (- n 2)))))))")
+        self.evto("(memo-fib 90)", 2880067194370816120)
+        self.evto("(memo-stats memo-fib)",
+                  [["hits", 88], ["misses", 91], ["evictions", 0], ["entries", 91], ["bytes", 0]])
+
+        # Equal lists are the same key, and the least recently used goes first
+        self.eval("(define memo-len (memoize length 'size 2))")
+        self.evto("(list (memo-len '(1 2)) (memo-len (list 1 2)) (memo-len '(1)) (memo-len '(1 2 3)))", [2, 2, 1, 3])
+        self.evto("(memo-stats memo-len)",
+                  [["hits", 1], ["misses", 3], ["evictions", 1], ["entries", 2], ["bytes", 0]])
+        self.assertEqual(dict(self.eval("(memo-stats (memo-clear memo-len))"))["entries"], 0)
+
+        # An array is the key of the list of its numbers, not of a quoted (array ...)
+        self.eval("(define memo-type (memoize type?))")
+        self.evto("(list (memo-type '(array (1 2))) (memo-type (array (list 1 2))) (memo-type (list 1 2)))",
+                  ["lst", "array", "array"])
+
+        # Expired at once
+        self.eval("(define memo-id (memoize (lambda (x) x) 'bytes 1000 'ttl 0))")
+        stats = dict(self.eval("(begin (memo-id '(1 2)) (memo-id '(1 2)) (memo-stats memo-id))"))
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (0, 2, 1))
+        self.assertTrue(0 < stats["bytes"] <= 1000)
+        with self.assertRaises(LispError):
+            self.eval("(memoize length 'size)")
+        with self.assertRaises(LispError):
+            self.eval("(memo-stats length)")
+
+    def test_macros(self):
+        self.evto("(for (x) in '(1 2 3) do (* x x))", [1, 4, 9])
+        self.evto("(macroexpand '(for (x) in l do (for (y) in x do y)))",
+                  ["map", ["lambda", ["x"], ["map", ["lambda", ["y"], "y"], "x"]], "l"])
+
+        self.eval("(defmacro unless (c then else) (list 'if c else then))")
+        self.evto("(unless (> 1 2) 'yes 'no)", "yes")
+        # Bound names aren't expanded
+        self.evto("(let ((unless 1)) (+ unless 1))", 2)
+        with self.assertRaises(LispError):
+            self.eval("(map unless '(1))")
+
+        # Each form is expanded once, however many times a macro repeats it
+        self.eval("(defmacro twice (x) (list 'begin x x))")
+        before = macro.counts["twice"]
+        self.evto("(twice (twice (twice (twice (+ 1 2)))))", 3)
+        self.assertEqual(macro.counts["twice"] - before, 4)
+
+        # ...and an evalS program once per evalS
+        hits = macro.stats["cache-hits"]
+        self.evto("""(map (lambda (x) (evalS "(unless (= 1 1) 1 2)")) '(1 2 3))""", [2, 2, 2])
+        self.assertEqual(macro.stats["cache-hits"] - hits, 2 if self.mode == "tree" else 0)
+
+    def test_optimizer(self):
+        ctx = load_stdlib(mode=self.mode)
+        program = """
+          (define width 4)
+          (define cpx (lambda (a b) (list a b)))
+          (define real (lambda (z) (head z)))
+          (define area (lambda (x) (if (> x 2) (* x width) 'narrow)))
+          (list (* width (+ width 1)) (real (cpx (area 3) 0)) (cond ((< width 0) 1) (t 2)))"""
+        expected = eval_program(program, load_stdlib(mode=self.mode), Print.NOTHING,
+                                returns="val", mode=self.mode)
+        self.assertEqual(expected, [20, 12, 2])
+        self.assertEqual(eval_program(program, ctx, Print.NOTHING, returns="val",
+                                      mode=self.mode, opt_level=2), expected)
+
+        from lisp.optimizer import Optimizer
+        optimize = lambda src: Optimizer(ctx, 2).optimize_form(parse(src))
+        self.assertEqual(optimize("(+ 1 (* 2 width))"), 9)
+        self.assertEqual(optimize("(real (cpx (g x) (f y)))"), ["head", ["list", ["g", "x"], ["f", "y"]]])
+        self.assertEqual(optimize("(** z 2)"), ["*", "z", "z"])
+        # Locals and names the form defines aren't constants
+        self.assertEqual(optimize("(lambda (width) (+ width 1))"), ["lambda", ["width"], ["+", "width", 1]])
+        self.assertEqual(optimize("(begin (define width 3) width)"), ["begin", ["define", "width", 3], "width"])
+        # Arguments would be evaluated twice, or not at all
+        self.assertEqual(optimize("(area (f x))"), ["area", ["f", "x"]])
+        self.assertEqual(optimize("(/ 1 0)"), ["/", 1, 0])
+
+        with self.assertRaises(LispError):
+            evalS("(define width 5)", ctx, mode=self.mode)
+
+    def test_stdlib_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "stdlib.lisp"
+            path.write_text(STDLIB_PATH.read_text() +
+                            "(define pairs (let k 2 (lambda (l) (zip l (map (lambda (x) (* k x)) l)))))")
+
+            with unittest.mock.patch.dict(os.environ, {"MYLISP_CACHE_DIR": tmp}):
+                evaluated = load_stdlib(self.mode, path)
+                self.assertEqual(len(list(pathlib.Path(tmp).glob("*.pickle"))), 1)
+                cache._snapshots.clear()
+                loaded = load_stdlib(self.mode, path)
+
+            program = "(pairs (seq 1 4))"
+            self.assertEqual(evalS(program, loaded, mode=self.mode),
+                             evalS(program, evaluated, mode=self.mode))
+            # Every load is a context of its own
+            evalS("(define pairs 0)", loaded, mode=self.mode)
+            self.assertEqual(evalS("(pairs '(1))", load_stdlib(self.mode, path), mode=self.mode),
+                             [[1, 2]])
+
     def test_recursive_let(self):
         self.evto(
             "(let foo (lambda (x) (if (< x 0) 0 (foo (- x 1)))) (foo 5))",
             0
         )        
 
+
+class NativeLists(unittest.TestCase):
+    "The native list builtins agree with their Lisp definitions."
+    mode = "closure"
+
+    @classmethod
+    def setUpClass(cls):
+        from lisp.native import reference_context
+        cls.native = load_stdlib(mode=cls.mode)
+        cls.reference = reference_context(cls.mode)
+
+    def agree(self, name, *args):
+        reference = self.reference[name]
+        self.assertIsInstance(reference, Procedure) # the Lisp definition, not the builtin
+        self.assertEqual(self.native[name](*args), reference(*args))
+
+    @given(st.lists(st.integers(-50, 50), max_size=40))
+    def test_one_list(self, xs):
+        for name in ("length", "reverse", "last", "empty-list?"):
+            self.agree(name, xs)
+            self.agree(name, RList.from_iterable(xs))
+        self.agree("filter", lambda x: x % 3 == 0, xs)
+        self.agree("length", "".join(map(str, xs)))
+
+    @given(st.lists(st.integers()), st.lists(st.text(max_size=3)))
+    def test_zip(self, xs, ys):
+        self.agree("zip", xs, ys)
+        self.agree("zip", RList.from_iterable(ys), xs)
+
+    @given(st.integers(-30, 30), st.integers(1, 40))
+    def test_seq(self, start, size):
+        self.agree("seq", start, start + size)
+        self.agree("seq", start + size, start) # empty
+        self.assertEqual(self.native["seq"](start, start), []) # Lisp never returns
+
+    def test_lazy_filter(self):
+        evens = self.native["filter"](lambda x: x % 2 == 0, lazy.LazySeq(range(10)))
+        self.assertIsInstance(evens, lazy.LazySeq)
+        self.assertEqual(evens, self.reference["filter"](lambda x: x % 2 == 0, lazy.LazySeq(range(10))))
+
+
+class PersistentLists(unittest.TestCase):
+    def test_against_python_lists(self):
+        for _ in range(50):
+            l = [random.randint(-10, 10) for _ in range(random.randint(0, 40))]
+            r = RList.from_iterable(l)
+
+            self.assertEqual(r, l)
+            self.assertEqual(list(r), l)
+            self.assertEqual([r[i] for i in range(len(l))], l)
+            self.assertEqual(r.cons(99), [99] + l)
+            if l:
+                self.assertEqual(r.head(), l[0])
+                self.assertEqual(r.tail(), l[1:])
+                self.assertEqual(r[-1], l[-1])
+
+    def test_sharing(self):
+        base = RList.from_iterable([1, 2, 3])
+        longer = base.cons(0).cons(-1)
+        self.assertEqual(longer, [-1, 0, 1, 2, 3])
+        self.assertEqual(longer.tail().tail(), base)
+        self.assertEqual(base, [1, 2, 3]) # untouched
+
+
+class HashMaps(unittest.TestCase):
+    def test_against_python_dicts(self):
+        from lisp.hamt import HashMap
+        for _ in range(50):
+            m, d = HashMap(), {}
+            for _ in range(random.randint(0, 200)):
+                key = random.choice([random.randint(0, 50), str(random.randint(0, 50)),
+                                     (random.randint(0, 3), random.randint(0, 3))])
+                if random.random() < 0.3:
+                    m = m.dissoc(key)
+                    d.pop(key, None)
+                else:
+                    m = m.assoc(key, len(d))
+                    d[key] = len(d)
+            self.assertEqual(len(m), len(d))
+            self.assertEqual(dict(m.items()), d)
+            self.assertEqual(HashMap.of(d.items()), m)
+
+    def test_collisions(self):
+        from lisp import hamt
+        # Keys whose hashes are equal, or only differ past the first levels
+        keys = [f"k{i}" for i in range(6)]
+        m = hamt.HashMap()
+        with unittest.mock.patch.object(hamt, "key_hash", lambda key: (int(key[1:]) % 2 << 40, key)):
+            for i, key in enumerate(keys):
+                m = m.assoc(key, i)
+            self.assertEqual([m.get(key) for key in keys], list(range(6)))
+            m = m.dissoc("k2").dissoc("k3")
+            self.assertEqual(sorted(m.keys()), ["k0", "k1", "k4", "k5"])
+            self.assertIsNone(m.get("k2"))
+
+
+class EvalServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from lisp.server import Server
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.server = Server(workers=2)
+        cls.address = cls.server.start_thread(path=os.path.join(cls.tmp.name, "lisp.sock"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        cls.tmp.cleanup()
+
+    def client(self):
+        from lisp.server import Client
+        client = Client(self.address)
+        self.addCleanup(client.close)
+        return client
+
+    def test_sessions(self):
+        a, b = self.client(), self.client()
+        self.assertEqual(a.eval("(define x 2) (* x 21)", session="a"), "42")
+        self.assertEqual(a.eval("(map (lambda (y) (+ x y)) '(1 2))", session="a", result="json"), [3, 4])
+        with self.assertRaises(LispError):
+            b.eval("x", session="b")
+        with self.assertRaises(LispError):
+            a.eval("x") # no session, a new Context
+        self.assertNotIn("x", self.server.env)
+
+        response = b.request(program="(print (+ 1 2)) {1 #{2}}", result="json")
+        self.assertEqual((response["value"], response["output"]), ([[1, [2]]], "3\n"))
+        response = b.request(program="(/ 1 0)")
+        self.assertEqual((response["ok"], response["error"]), (False, "ZeroDivisionError"))
+        self.assertEqual(b.request(op="frobnicate")["error"], "RequestError")
+
+    def test_timeout(self):
+        client = self.client()
+        client.eval("(define n 1)", session="t")
+        response = client.request(program="(define loop (lambda (n) (loop (+ n 1)))) (loop 0)",
+                                  session="t", timeout=0.2)
+        self.assertEqual(response["error"], "Timeout")
+        self.assertEqual(client.eval("(+ n 1)", session="t"), "2") # interrupted, still usable
+
+        stats = client.stats()
+        self.assertGreaterEqual(stats["timeouts"], 1)
+        self.assertEqual(stats["queued"], 0)
+        self.assertLessEqual(stats["latency"]["p50"], stats["latency"]["max"])
+
+    def test_interrupt_on_return(self):
+        from lisp.server import Job
+        for _ in range(200):
+            job = Job(self.server)
+            def interrupted_as_it_returns():
+                job.interrupt()
+                return 42
+            self.assertIn(job.run(interrupted_as_it_returns), (42, None))
+            job.interrupt() # done: does nothing
+        self.assertEqual(self.server.running, 0)
+
+    def test_concurrent_hooks(self):
+        spinning = self.client().request(program="""
+(define tick (lambda (n) (- n 1)))
+(define spin (lambda (n) (if (= n 0) 'done (spin (tick n)))))
+(spin 10)""", session="spin")
+        self.assertEqual(spinning["value"], "done")
+
+        responses = {}
+        def spin():
+            responses["spin"] = self.client().request(program="(spin 100000)", session="spin")
+        thread = threading.Thread(target=spin)
+        thread.start()
+        try:
+            time.sleep(0.05)
+            client = self.client()
+            profiled = client.request(program="""
+(define count (lambda (n) (if (= n 0) 0 (count (- n 1)))))
+(profile (count 20000))""", session="probe")
+            debugged = client.request(program="(debug t) (count 3000) (debug f)", session="probe")
+        finally:
+            thread.join()
+
+        self.assertEqual((profiled["value"], responses["spin"]["value"]), ("0", "done"))
+        self.assertIn("count (", profiled["output"])
+        self.assertIn("-> (count 3000)", debugged["output"])
+        # Each session only sees its own calls
+        self.assertNotIn("tick", profiled["output"] + debugged["output"])
+        self.assertEqual(responses["spin"]["output"], "")
+
+
+class Tracing(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.userctx = load_stdlib()
+
+    def test_json_trace(self):
+        trace = io.StringIO()
+        with hooks.installed(hooks.JSONTraceHook(trace)):
+            self.assertEqual(evalS("(fact 3)", self.userctx), 6)
+            # Tail calls still run in constant stack
+            evalS("(let count (lambda (n) (if (= n 0) 0 (count (- n 1)))) (count 3000))",
+                  self.userctx)
+            evalS("(let f (lambda (n) (let x n (if (= x 0) 0 (f (- x 1))))) (f 3000))",
+                  self.userctx)
+        self.assertIs(compiler.eval_free, hooks._walk)
+
+        events = [json.loads(line) for line in trace.getvalue().splitlines()]
+        self.assertEqual(events[0], {**events[0], "event": "enter", "call": "(fact 3)", "depth": 0})
+        self.assertIn({"event": "exit", "call": "(* temp n)", "value": "6", "depth": 1},
+                      [{k: e[k] for k in ("event", "call", "value", "depth") if k in e}
+                       for e in events])
+        self.assertLessEqual(max(e["depth"] for e in events), 2)
+
+    def test_errors(self):
+        trace = io.StringIO()
+        with hooks.installed(hooks.JSONTraceHook(trace)):
+            self.assertRaises(TypeError, evalS, "(fact (+ 1 'a))", self.userctx)
+        errors = [e for e in map(json.loads, trace.getvalue().splitlines())
+                  if e["event"] == "error"]
+        self.assertEqual(len(errors), 1)
+
+    def test_debug_form(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            evalS("(debug t)", self.userctx)
+            evalS("(+ 1 2)", self.userctx)
+            evalS("(debug f)", self.userctx)
+            evalS("(* 3 3)", self.userctx)
+        self.assertIn("-> (+ 1 2)", out.getvalue())
+        self.assertNotIn("(* 3 3)", out.getvalue())
+
+    def test_repl_debug(self):
+        out = io.StringIO()
+        with unittest.mock.patch("builtins.input", side_effect=["(+ 1 2)", "q"]), \
+             contextlib.redirect_stdout(out):
+            compiler.repl(debug=True)
+        self.assertIn("-> (+ 1 2)", out.getvalue())
+
+    def test_sampler(self):
+        with hooks.Sampler(interval=0.0005) as sampler:
+            evalS("(let count (lambda (n) (if (= n 0) 0 (count (- n 1)))) (count 20000))",
+                  self.userctx)
+        self.assertTrue(sampler.samples)
+        # The let body and the calls are tail positions: the loop runs in a single frame
+        self.assertTrue(all(len(stack) <= 3 for stack in sampler.samples))
+        self.assertTrue(any(stack[0] == "(count (- n 1))" for stack in sampler.samples))
+
+
+class Profiling(unittest.TestCase):
+    mode = "tree"
+
+    def test_profiler(self):
+        profile = profiler.Profiler(allocations=True)
+        ctx = ev("""
+(define fib
+  (lambda (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))))
+(define fibs (lambda (n) (reverse (map fib (seq 0 n)))))
+(fibs 10)""", what_to_print=Print.NOTHING, mode=self.mode, profile=profile)
+
+        self.assertEqual(evalS("(fibs 3)", ctx, mode=self.mode), [1, 1, 0])
+        self.assertEqual(evalS("(fib 3)", ctx, mode=self.mode), 2) # outside the profile
+
+        calls, own, inclusive, _, _ = profile.stats["fib (<string>:3:3)"]
+        self.assertEqual(calls, sum(2 * fib - 1 for fib in (1, 1, 2, 3, 5, 8, 13, 21, 34, 55)))
+        self.assertLessEqual(own, inclusive)
+        # A tail call ends the caller: fibs only includes the map
+        self.assertLessEqual(inclusive, profile.stats["fibs (<string>:4:14)"][2])
+
+        flamegraph = io.StringIO()
+        profile.write_collapsed(flamegraph)
+        self.assertRegex(flamegraph.getvalue(), r"fibs \(<string>:4:14\);.*fib \(<string>:3:3\) \d+\n")
+
+    def test_profile_form(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(ev("(profile (fact 5))", Print.NOTHING, "val", self.mode), 120)
+        self.assertIn("fact-rec (", out.getvalue())
+
+    def test_profile_form_hooked(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            with hooks.installed(hooks.print_hook):
+                self.assertEqual(ev("(profile (fact 3))", Print.NOTHING, "val", self.mode), 6)
+        self.assertIn("-> (fact 3)", out.getvalue())
+
+
+class ClosureProfiling(Profiling):
+    mode = "closure"
+
+
+class ClosureBasics(Basics):
+    "The same tests, run by the closure compiler."
+    mode = "closure"
+
+    def test_unbound_before_execution(self):
+        # The misspelled name is found while compiling: nothing runs
+        with self.assertRaises(LispSymbolError):
+            self.eval("(begin (define not-yet 1) (lenght '(1 2)))")
+        self.assertNotIn("not-yet", self.userctx)
+
+        # Inside a lambda a name may still be defined later
+        self.eval("(define uses-later (lambda (x) (defined-later x)))")
+        self.eval("(define defined-later (lambda (x) (* x 2)))")
+        self.evto("(uses-later 21)", 42)
+
+    def test_jit(self):
+        from lisp import jit
+        program = """
+          (define converge?
+            (lambda (c iters)
+              (let escape
+                (lambda (n z)
+                  (if (or (>= n iters) (> (magnitude z) 2)) n
+                      (escape (++ n) (+ (* z z) c))))
+                (escape 0 c))))
+          (define sign (lambda (x) (cond ((< x 0) 'neg) ((> x 0) 'pos))))
+          (define adder (lambda (x) (lambda (y) (+ x y))))
+          (define count-down (lambda (n acc) (if (= n 0) acc (count-down (- n 1) (+ acc 1)))))
+          (list (map (lambda (c) (converge? c 50)) (list 0 1 0.4+0.6i))
+                (map sign (list -2 3 -1 4))
+                ((adder 1) 2) ((adder 2) 3) ((adder 3) 4) (count-down 3 0))"""
+        expected = [[50, 2, 14], ["neg", "pos", "neg", "pos"], 3, 5, 7, 3]
+        with unittest.mock.patch.object(jit, "THRESHOLD", 2):
+            ctx = load_stdlib(mode=self.mode)
+            self.assertEqual(eval_program(program, ctx, Print.NOTHING, returns="val",
+                                          mode=self.mode), expected)
+            # A self tail call loops, without growing the stack
+            self.assertEqual(evalS("(count-down 5000 0)", ctx, mode=self.mode), 5000)
+            self.assertIn("while True:", jit.source(ctx["count-down"]))
+            self.assertIsNotNone(jit.source(ctx["sign"]))
+            self.assertIsNone(jit.source(ctx["adder"])) # makes a lambda
+            with self.assertRaises(AssertionError):
+                evalS("(sign 0)", ctx, mode=self.mode)
+            with self.assertRaises(LispError):
+                evalS("(define magnitude 1)", ctx, mode=self.mode)
+
+
+class VMBasics(Basics):
+    "The same tests, run by the bytecode VM."
+    mode = "vm"
+
+    def test_deep_recursion(self):
+        # Calls between compiled procedures don't recurse in Python
+        self.eval("(define count-up (lambda (n) (if (= n 0) 0 (+ 1 (count-up (- n 1))))))")
+        self.evto("(count-up 20000)", 20000)
+
+    def test_module(self):
+        from lisp import vm
+        module = vm.compile_module("""
+(define square (lambda (x) (* x x)))
+(define squares (lambda (l) (map square l)))
+(squares (seq 1 4))""", self.userctx)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp) / "squares.lispc"
+            module.save(path)
+            ctx = load_stdlib(mode=self.mode)
+            self.assertEqual(vm.Module.load(path).run(ctx), [1, 4, 9])
+            self.assertEqual(evalS("(square 5)", ctx, mode=self.mode), 25)
+
+            path.write_bytes(b"not bytecode")
+            with self.assertRaises(LispError):
+                vm.Module.load(path)